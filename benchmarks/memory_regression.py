@@ -0,0 +1,333 @@
+"""
+Memory regression harness for streamed chat completions
+
+Runs thousands of chat completions through handle_chat against an in-process
+mock upstream while tracemalloc is tracing. For each round it reports the peak
+allocation per concurrent stream, the memory retained after the round (leaked
+bytes per request) with the source lines responsible, and the size of the
+long-lived containers that requests touch (TokenDatabase._cache,
+OAuthManager.oauth_states, in-flight traces, usage buffers, cooldowns).
+
+Exits non-zero when the per-stream peak or the retained growth exceeds the
+given limits, or when the peak regresses past --tolerance against the baseline
+committed in benchmarks/memory_baseline.json. The baseline is only compared
+when it was recorded with the same --streams, --concurrency and --tokens:
+
+    python benchmarks/memory_regression.py                     # check a change
+    python benchmarks/memory_regression.py --save-baseline     # accept a new baseline
+
+Re-record and commit the baseline together with changes that are expected to
+move the per-stream peak.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'memory_baseline.json')
+# 只有负载参数一致时峰值才可比
+BASELINE_KEYS = ('streams', 'concurrency', 'tokens')
+SRC_DIR = os.path.join(ROOT, 'src')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def configure_environment(upstream_port: int) -> str:
+    # 必须在导入 src 之前设置，配置在模块加载时读取
+    tmp = tempfile.mkdtemp(prefix="qwen-memory-")
+    os.environ.update(
+        DATABASE_URL=os.path.join(tmp, "tokens.db"),
+        QWEN_API_ENDPOINT=f"http://127.0.0.1:{upstream_port}/v1/chat/completions",
+        API_PASSWORD="bench",
+        ACCESS_LOG_PATH="",
+        ANALYTICS_DIR="",
+        BATCH_DIR=os.path.join(tmp, "batches")
+    )
+    return tmp
+
+
+async def start_mock_upstream(port: int, tokens: int, interval: float) -> web.AppRunner:
+    async def chat(request):
+        data = await request.json()
+        chunks = [{
+            "id": "memory", "object": "chat.completion.chunk", "model": data['model'],
+            "choices": [{"index": 0, "delta": {"content": f"token{i} "}, "finish_reason": None}]
+        } for i in range(tokens)]
+        if not data.get('stream'):
+            return web.json_response({
+                "id": "memory", "object": "chat.completion", "model": data['model'],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(
+                    chunk['choices'][0]['delta']['content'] for chunk in chunks)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 8, "completion_tokens": tokens, "total_tokens": tokens + 8}
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for chunk in chunks:
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if interval:
+                await asyncio.sleep(interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat)
+    app.router.add_route('*', '/{tail:.*}', lambda request: web.Response())
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def container_sizes() -> dict:
+    from src.api import routes
+    from src.utils.request_trace import in_flight, slow_request_log
+    from src.utils.event_bus import event_bus
+
+    return {
+        'dbCache': len(routes.db._cache),
+        'oauthStates': len(routes.oauth_manager.oauth_states),
+        'inFlight': in_flight.count(),
+        'slowRequestLog': len(slow_request_log._recent),
+        'usageBufferPending': routes.usage_buffer.pending,
+        'usageSeriesKeys': len(routes.usage_buffer._series),
+        'cooldowns': len(routes.token_manager._cooldowns),
+        'eventTopics': len(event_bus._subscribers)
+    }
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>")
+    ])
+
+
+def top_src_lines(stats, limit: int, attribute: str):
+    lines = []
+    for stat in stats:
+        frame = stat.traceback[0]
+        if not frame.filename.startswith(SRC_DIR):
+            continue
+        size = getattr(stat, attribute)
+        if size <= 0:
+            continue
+        lines.append((f"{os.path.relpath(frame.filename, ROOT)}:{frame.lineno}", size))
+        if len(lines) >= limit:
+            break
+    return lines
+
+
+async def run_request(index: int, stream_ratio: float) -> int:
+    from src.api.routes import handle_chat
+    from src.utils.request_trace import RequestTrace
+
+    stream = (index % 100) < stream_ratio * 100
+    data = {
+        'model': 'qwen3-coder-flash',
+        'stream': stream,
+        'messages': [{'role': 'user', 'content': f'memory regression request {index}'}]
+    }
+    response = await handle_chat(data, RequestTrace("/v1/chat/completions"), json.dumps(data).encode())
+    received = 0
+    if hasattr(response, 'body_iterator'):
+        async for chunk in response.body_iterator:
+            received += len(chunk)
+    else:
+        received = len(response.body)
+    return received
+
+
+async def run_round(streams: int, concurrency: int, stream_ratio: float, sample_peak: bool, top: int,
+                    retained_slack_kb: float):
+    from src.utils.request_trace import in_flight
+
+    semaphore = asyncio.Semaphore(concurrency)
+    peak_snapshot = {}
+
+    async def bounded(index: int):
+        async with semaphore:
+            return await run_request(index, stream_ratio)
+
+    async def sampler():
+        # 所有并发流都已在转发时拍一次快照，定位每个流持有的缓冲区
+        while in_flight.count() < concurrency * 0.9:
+            await asyncio.sleep(0.002)
+        peak_snapshot['snapshot'] = take_snapshot()
+
+    gc.collect()
+    before = take_snapshot()
+    baseline_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+    sampler_task = asyncio.create_task(sampler()) if sample_peak else None
+    started = time.perf_counter()
+    received = await asyncio.gather(*(bounded(index) for index in range(streams)))
+    elapsed = time.perf_counter() - started
+    if sampler_task:
+        sampler_task.cancel()
+
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    # 让被取消的任务和空闲连接回收完成后再计算残留
+    await asyncio.sleep(0.5)
+    gc.collect()
+    after = take_snapshot()
+    retained = after.compare_to(before, 'lineno')
+    # 事件循环、线程池与连接池的瞬时状态会带来几十 KiB 的抖动，只用 src/ 下的残留判断泄漏
+    retained_src = sum(stat.size_diff for stat in retained if stat.traceback[0].filename.startswith(SRC_DIR))
+    # 一次性的增长（时区缓存、字典扩容等）不随请求数增加，扣除固定额度后再按请求摊分
+    leaked_src = max(0.0, retained_src - retained_slack_kb * 1024)
+
+    result = {
+        'streams': streams,
+        'seconds': round(elapsed, 2),
+        'bytesReceived': sum(received),
+        'peakPerStreamKb': round((peak_bytes - baseline_bytes) / concurrency / 1024, 2),
+        'retainedKb': round(sum(stat.size_diff for stat in retained) / 1024, 2),
+        'retainedPerRequestBytes': round(sum(stat.size_diff for stat in retained) / streams, 1),
+        'retainedSrcPerRequestBytes': round(retained_src / streams, 1),
+        'leakedPerRequestBytes': round(leaked_src / streams, 1),
+        'retainedTop': top_src_lines(retained, top, 'size_diff'),
+        'containers': container_sizes()
+    }
+    if 'snapshot' in peak_snapshot:
+        result['inFlightTop'] = top_src_lines(peak_snapshot['snapshot'].compare_to(before, 'lineno'), top, 'size_diff')
+    return result
+
+
+def print_round(name: str, result: dict) -> None:
+    print(f"{name}: {result['streams']} requests in {result['seconds']} s, "
+          f"peak {result['peakPerStreamKb']} KiB/concurrent stream, "
+          f"retained {result['retainedKb']} KiB ({result['retainedPerRequestBytes']} B/request, "
+          f"{result['retainedSrcPerRequestBytes']} B/request from src/, "
+          f"{result['leakedPerRequestBytes']} B/request beyond the slack)")
+    print(f"    containers: {result['containers']}")
+    for title, key in (('held while streaming', 'inFlightTop'), ('retained after round', 'retainedTop')):
+        if result.get(key):
+            print(f"    {title}:")
+            for line, size in result[key]:
+                print(f"        {size / 1024:>10.1f} KiB  {line}")
+
+
+def check(results: list, args, baseline: dict) -> list:
+    failures = []
+    # 预热轮已填满有界缓存（慢请求窗口、连接池等），这里只看正式轮次
+    peak = max(result['peakPerStreamKb'] for result in results)
+    # 真正的泄漏每一轮都会残留，单轮的抖动取最小值后即被排除
+    leaked = min(result['leakedPerRequestBytes'] for result in results)
+
+    if args.max_stream_kb and peak > args.max_stream_kb:
+        failures.append(f"peak {peak} KiB per stream exceeds --max-stream-kb {args.max_stream_kb}")
+    if leaked > args.max_retained_bytes:
+        failures.append(f"src/ retained {leaked} B per request in every round, "
+                        f"exceeds --max-retained-bytes {args.max_retained_bytes}")
+    if baseline and any(baseline.get(key) != getattr(args, key) for key in BASELINE_KEYS):
+        print(f"baseline recorded with {', '.join(f'{key}={baseline.get(key)}' for key in BASELINE_KEYS)}, "
+              f"not comparable with this run; skipping the baseline check")
+    elif baseline:
+        limit = baseline['peakPerStreamKb'] * (1 + args.tolerance)
+        if peak > limit:
+            failures.append(f"peak {peak} KiB per stream regressed past baseline "
+                            f"{baseline['peakPerStreamKb']} KiB (+{args.tolerance:.0%})")
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=1000, help='requests per round')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=2, help='measured rounds after the warm-up round (at least 2)')
+    parser.add_argument('--tokens', type=int, default=200, help='deltas per upstream stream')
+    parser.add_argument('--interval', type=float, default=0.0005, help='seconds between upstream deltas')
+    parser.add_argument('--stream-ratio', type=float, default=0.8, help='share of streaming requests')
+    parser.add_argument('--top', type=int, default=8, help='source lines to show per report')
+    parser.add_argument('--max-stream-kb', type=float, default=0, help='absolute per-stream peak limit')
+    parser.add_argument('--max-retained-bytes', type=float, default=16,
+                        help='retained bytes per request allocated in src/, beyond --retained-slack-kb')
+    parser.add_argument('--retained-slack-kb', type=float, default=32,
+                        help='one-off src/ growth per round that is not counted as a leak')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression against the baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+    if args.rounds < 2:
+        parser.error("--rounds must be at least 2 to tell leaks from one-off growth")
+
+    upstream_port = free_port()
+    configure_environment(upstream_port)
+    runner = await start_mock_upstream(upstream_port, args.tokens, args.interval)
+
+    from src.main import app
+    from src.api.routes import token_manager
+    from src.models import TokenData
+    from src.config.settings import SLOW_REQUEST_WINDOW
+
+    tracemalloc.start(1)
+    results = []
+    try:
+        async with app.router.lifespan_context(app):
+            token_manager.save_token('memory00', TokenData(
+                access_token='memory', refresh_token='memory00-refresh',
+                expires_at=int(time.time() * 1000) + 3600_000
+            ))
+            # 预热轮：建立连接池、加载编码器，并至少填满一次慢请求窗口等有界缓存
+            warmup_streams = max(args.streams, SLOW_REQUEST_WINDOW)
+            warmup = await run_round(warmup_streams, args.concurrency, args.stream_ratio, False, args.top,
+                                     args.retained_slack_kb)
+            print_round("warm-up", warmup)
+            for index in range(args.rounds):
+                result = await run_round(args.streams, args.concurrency, args.stream_ratio, index == 0, args.top,
+                                         args.retained_slack_kb)
+                print_round(f"round {index + 1}", result)
+                results.append(result)
+    finally:
+        tracemalloc.stop()
+        await runner.cleanup()
+
+    summary = {
+        'peakPerStreamKb': max(result['peakPerStreamKb'] for result in results),
+        'retainedPerRequestBytes': max(result['retainedPerRequestBytes'] for result in results),
+        'retainedSrcPerRequestBytes': max(result['retainedSrcPerRequestBytes'] for result in results),
+        'leakedPerRequestBytes': min(result['leakedPerRequestBytes'] for result in results),
+        'streams': args.streams,
+        'concurrency': args.concurrency,
+        'tokens': args.tokens
+    }
+    print(f"summary: {summary}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    failures = check(results, args, baseline)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,180 @@
+"""
+Benchmark for SSE output coalescing
+
+Starts the server under uvicorn in a subprocess, points it at an in-process
+mock upstream that streams tiny deltas, and opens many concurrent streaming
+chat completions. Reports the downstream chunks received by the client and the
+server process CPU time per streamed token, once with X-Stream-Flush: immediate
+and once with the default coalescing policy.
+
+    python benchmarks/sse_coalesce_bench.py --streams 200 --tokens 200
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> float:
+    try:
+        import psutil
+        times = psutil.Process(pid).cpu_times()
+        return times.user + times.system
+    except ImportError:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def start_mock_upstream(port: int, tokens: int, interval: float) -> web.AppRunner:
+    async def chat(request):
+        data = await request.json()
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i in range(tokens):
+            chunk = {
+                "id": "bench", "object": "chat.completion.chunk", "model": data['model'],
+                "choices": [{"index": 0, "delta": {"content": f"t{i} "}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if interval:
+                await asyncio.sleep(interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat)
+    app.router.add_route('*', '/{tail:.*}', lambda request: web.Response())
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def seed_token(database_url: str) -> None:
+    os.environ["DATABASE_URL"] = database_url
+    from src.database import TokenDatabase
+    from src.models import TokenData
+    TokenDatabase(database_url).save_token('bench000', TokenData(
+        access_token='bench', refresh_token='bench000-refresh',
+        expires_at=int(time.time() * 1000) + 3600_000
+    ))
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen) -> None:
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            async with session.get(f"{base_url}/api/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.05)
+    raise RuntimeError("server did not become ready")
+
+
+async def run_stream(session: aiohttp.ClientSession, url: str, body: bytes, headers) -> int:
+    chunks = 0
+    async with session.post(url, data=body, headers=headers) as response:
+        async for _ in response.content.iter_any():
+            chunks += 1
+    return chunks
+
+
+async def run_round(session, base_url: str, pid: int, streams: int, tokens: int, immediate: bool):
+    headers = {'Authorization': f'Bearer {PASSWORD}', 'Content-Type': 'application/json'}
+    if immediate:
+        headers['X-Stream-Flush'] = 'immediate'
+    body = json.dumps({
+        'model': 'qwen3-coder-flash', 'stream': True,
+        'messages': [{'role': 'user', 'content': 'benchmark'}]
+    }).encode()
+    url = f"{base_url}/v1/chat/completions"
+
+    cpu_start, wall_start = process_cpu_seconds(pid), time.perf_counter()
+    chunks = await asyncio.gather(*(run_stream(session, url, body, headers) for _ in range(streams)))
+    cpu, wall = process_cpu_seconds(pid) - cpu_start, time.perf_counter() - wall_start
+
+    total_tokens = streams * tokens
+    return {
+        'chunks': sum(chunks),
+        'chunksPerToken': sum(chunks) / total_tokens,
+        'cpuUsPerToken': cpu / total_tokens * 1e6,
+        'wallSeconds': wall
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.002, help='seconds between upstream deltas')
+    args = parser.parse_args()
+
+    upstream_port, server_port = free_port(), free_port()
+    tmp = tempfile.mkdtemp(prefix="qwen-bench-")
+    database_url = os.path.join(tmp, "tokens.db")
+    seed_token(database_url)
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        QWEN_API_ENDPOINT=f"http://127.0.0.1:{upstream_port}/v1/chat/completions",
+        API_PASSWORD=PASSWORD,
+        ACCESS_LOG_PATH="",
+        BATCH_DIR=os.path.join(tmp, "batches")
+    )
+    runner = await start_mock_upstream(upstream_port, args.tokens, args.interval)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'src.main:app', '--host', '127.0.0.1',
+         '--port', str(server_port), '--log-level', 'warning', '--no-access-log'],
+        cwd=ROOT, env=env
+    )
+    base_url = f"http://127.0.0.1:{server_port}"
+
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await wait_until_ready(session, base_url, process)
+            # 先跑一轮预热连接池和编码器
+            await run_round(session, base_url, process.pid, 4, args.tokens, immediate=True)
+            results = {
+                'immediate': await run_round(session, base_url, process.pid, args.streams, args.tokens, True),
+                'coalesced': await run_round(session, base_url, process.pid, args.streams, args.tokens, False)
+            }
+    finally:
+        process.terminate()
+        process.wait()
+        await runner.cleanup()
+
+    print(f"{args.streams} streams x {args.tokens} tokens, upstream delta every {args.interval * 1000:.1f} ms")
+    for name, result in results.items():
+        print(f"{name:>10}: {result['chunks']:>8} chunks  {result['chunksPerToken']:.3f} chunks/token  "
+              f"{result['cpuUsPerToken']:.1f} us server CPU/token  {result['wallSeconds']:.2f} s")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+"""
+Throughput scaling benchmark for the multi-process launcher
+
+Starts `python -m src.launcher` once per worker count against a mock upstream
+running in its own process, drives it with closed-loop chat completions from
+several load-generator processes, and reports requests per second, latency
+percentiles and the speedup over the first worker count:
+
+    python benchmarks/worker_scaling_bench.py --workers 1,2,4 --duration 15
+
+The load generator and the mock upstream share the machine with the server,
+so leave cores free for them (or pin the server with taskset) when measuring
+scaling; the report prints the cores the launcher sees.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_mock_upstream(port: int, tokens: int, delay: float) -> None:
+    async def chat(request):
+        data = await request.json()
+        if delay:
+            await asyncio.sleep(delay)
+        usage = {"prompt_tokens": 8, "completion_tokens": tokens, "total_tokens": 8 + tokens}
+        if not data.get('stream'):
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "model": data['model'],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "t " * tokens},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            })
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i in range(tokens):
+            chunk = {
+                "id": "bench", "object": "chat.completion.chunk", "model": data['model'],
+                "choices": [{"index": 0, "delta": {"content": f"t{i} "}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = {"id": "bench", "object": "chat.completion.chunk", "model": data['model'],
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat)
+    app.router.add_route('*', '/{tail:.*}', lambda request: web.Response())
+    web.run_app(app, host='127.0.0.1', port=port, access_log=None, print=None)
+
+
+def seed_token(database_url: str) -> None:
+    os.environ["DATABASE_URL"] = database_url
+    from src.database import TokenDatabase
+    from src.models import TokenData
+    db = TokenDatabase(database_url)
+    db.save_token('bench000', TokenData(
+        access_token='bench', refresh_token='bench000-refresh',
+        expires_at=int(time.time() * 1000) + 3600_000
+    ))
+
+
+async def _drive(base_url: str, concurrency: int, duration: float, stream_ratio: float):
+    headers = {'Authorization': f'Bearer {PASSWORD}', 'Content-Type': 'application/json'}
+    bodies = [json.dumps({
+        'model': 'qwen3-coder-flash', 'stream': stream,
+        'messages': [{'role': 'user', 'content': 'benchmark'}]
+    }).encode() for stream in (False, True)]
+    url = f"{base_url}/v1/chat/completions"
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def loop(index: int):
+        nonlocal errors
+        sent = 0
+        while time.perf_counter() < deadline:
+            # 按比例交替发送流式与非流式请求，每个连接的序列固定，多次运行可比
+            stream = (index + sent) % 100 < stream_ratio * 100
+            sent += 1
+            started = time.perf_counter()
+            try:
+                async with session.post(url, data=bodies[stream], headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        await asyncio.gather(*(loop(index) for index in range(concurrency)))
+    return latencies, errors
+
+
+def load_client(args) -> tuple:
+    return asyncio.run(_drive(*args))
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen) -> None:
+    async def probe():
+        async with aiohttp.ClientSession() as session:
+            for _ in range(600):
+                if process.poll() is not None:
+                    raise RuntimeError("launcher exited during startup")
+                try:
+                    async with session.get(f"{base_url}/api/livez") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.05)
+        raise RuntimeError("server did not become ready")
+    asyncio.run(probe())
+
+
+def run_load(pool, base_url: str, clients: int, concurrency: int, duration: float, stream_ratio: float):
+    per_client = [concurrency // clients + (1 if index < concurrency % clients else 0) for index in range(clients)]
+    started = time.perf_counter()
+    results = pool.map(load_client, [(base_url, count, duration, stream_ratio) for count in per_client if count])
+    wall = time.perf_counter() - started
+    latencies = sorted(latency for result, _ in results for latency in result)
+    errors = sum(error for _, error in results)
+
+    def percentile(p: float):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / wall, 1),
+        'p50Ms': percentile(0.5),
+        'p99Ms': percentile(0.99)
+    }
+
+
+def main():
+    from src.launcher import available_cores, LOOP, HTTP
+
+    cores = available_cores()
+    defaults = sorted({1, 2, 4, cores} & set(range(1, cores + 1)))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default=','.join(map(str, defaults)), help='comma-separated worker counts')
+    parser.add_argument('--duration', type=float, default=10, help='measured seconds per worker count')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds before each measurement')
+    parser.add_argument('--concurrency', type=int, default=128, help='in-flight requests across all clients')
+    parser.add_argument('--clients', type=int, default=max(1, min(4, cores // 2)), help='load generator processes')
+    parser.add_argument('--tokens', type=int, default=32, help='completion deltas per upstream response')
+    parser.add_argument('--delay', type=float, default=0.0, help='upstream latency in seconds')
+    parser.add_argument('--stream-ratio', type=float, default=0.5, help='share of streaming requests')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    upstream_port = free_port()
+    upstream = context.Process(target=run_mock_upstream, args=(upstream_port, args.tokens, args.delay), daemon=True)
+    upstream.start()
+
+    tmp = tempfile.mkdtemp(prefix="qwen-scaling-")
+    database_url = os.path.join(tmp, "tokens.db")
+    seed_token(database_url)
+
+    results = []
+    try:
+        with context.Pool(args.clients) as pool:
+            for workers in [int(value) for value in args.workers.split(',')]:
+                port = free_port()
+                env = dict(
+                    os.environ,
+                    WORKERS=str(workers),
+                    HOST="127.0.0.1",
+                    PORT=str(port),
+                    LOG_LEVEL="warning",
+                    DATABASE_URL=database_url,
+                    QWEN_API_ENDPOINT=f"http://127.0.0.1:{upstream_port}/v1/chat/completions",
+                    API_PASSWORD=PASSWORD,
+                    ACCESS_LOG_PATH="",
+                    ANALYTICS_DIR="",
+                    BATCH_DIR=os.path.join(tmp, "batches")
+                )
+                process = subprocess.Popen([sys.executable, '-m', 'src.launcher'], cwd=ROOT, env=env)
+                base_url = f"http://127.0.0.1:{port}"
+                try:
+                    wait_until_ready(base_url, process)
+                    run_load(pool, base_url, args.clients, args.concurrency, args.warmup, args.stream_ratio)
+                    result = run_load(pool, base_url, args.clients, args.concurrency, args.duration, args.stream_ratio)
+                finally:
+                    process.send_signal(signal.SIGTERM)
+                    process.wait()
+                result['workers'] = workers
+                results.append(result)
+                print(f"workers={workers}: {result['rps']} req/s", flush=True)
+    finally:
+        upstream.terminate()
+        upstream.join()
+
+    baseline = results[0]['rps'] or 1
+    print(f"\n{cores} cores available, event loop {LOOP}, HTTP parser {HTTP}, "
+          f"{args.concurrency} concurrent requests from {args.clients} client processes, "
+          f"{args.stream_ratio:.0%} streaming")
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for result in results:
+        result['speedup'] = round(result['rps'] / baseline, 2)
+        print(f"{result['workers']:>8} {result['rps']:>10} {result['speedup']:>7}x "
+              f"{result['p50Ms']:>9} {result['p99Ms']:>9} {result['errors']:>7}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cores': cores, 'loop': LOOP, 'http': HTTP, 'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
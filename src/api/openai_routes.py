@@ -4,10 +4,14 @@ OpenAI-compatible API endpoints
 import json
 import time
 from fastapi import APIRouter, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 
 from ..utils import verify_password
-from .routes import handle_chat
+from ..utils.request_trace import RequestTrace
+from ..utils.fast_json import loads
+from ..utils.access_log import client_key_hash
+from ..config import AUTO_MODEL_NAME
+from .routes import handle_chat, batch_manager
 
 
 router = APIRouter()
@@ -36,19 +40,101 @@ async def get_models(request: Request):
             }
         ]
     }
+    if AUTO_MODEL_NAME:
+        models["data"].append({
+            "id": AUTO_MODEL_NAME,
+            "object": "model",
+            "created": int(time.time()),
+            "owned_by": "qwen"
+        })
     
     return JSONResponse(content=models)
 
 
 @router.post("/v1/chat/completions")
 async def chat_completions(request: Request):
+    trace = RequestTrace("/v1/chat/completions")
+    
+    with trace.phase("auth"):
+        auth_header = request.headers.get('Authorization')
+        authorized = verify_password(auth_header)
+    if not authorized:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    trace.set(clientKey=client_key_hash(auth_header))
+    
+    with trace.phase("parse"):
+        raw_body = await request.body()
+        try:
+            data = loads(raw_body)
+        except:
+            raise HTTPException(status_code=400, detail="Request format error")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Request format error")
+    
+    return await handle_chat(
+        data, trace, raw_body,
+        context_overflow=request.headers.get('X-Context-Overflow'),
+        coalesce=request.headers.get('X-Stream-Flush') != 'immediate'
+    )
+
+
+@router.post("/v1/batches")
+async def create_batch(request: Request):
     auth_header = request.headers.get('Authorization')
     if not verify_password(auth_header):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     try:
-        data = await request.json()
-    except:
-        raise HTTPException(status_code=400, detail="Request format error")
+        batch = await batch_manager.create_batch(request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return JSONResponse(content=batch)
+
+
+@router.get("/v1/batches")
+async def list_batches(request: Request):
+    auth_header = request.headers.get('Authorization')
+    if not verify_password(auth_header):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    return JSONResponse(content={"object": "list", "data": batch_manager.list_batches()})
+
+
+@router.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    auth_header = request.headers.get('Authorization')
+    if not verify_password(auth_header):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    batch = batch_manager.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    
+    return JSONResponse(content=batch)
+
+
+@router.get("/v1/batches/{batch_id}/output")
+async def get_batch_output(batch_id: str, request: Request):
+    auth_header = request.headers.get('Authorization')
+    if not verify_password(auth_header):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    output_path = batch_manager.get_output_path(batch_id)
+    if output_path is None:
+        raise HTTPException(status_code=404, detail="Batch output not found")
+    
+    return FileResponse(output_path, media_type="application/jsonl", filename=f"{batch_id}_output.jsonl")
+
+
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    auth_header = request.headers.get('Authorization')
+    if not verify_password(auth_header):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    batch = await batch_manager.cancel_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
     
-    return await handle_chat(data)
\ No newline at end of file
+    return JSONResponse(content=batch)
\ No newline at end of file
@@ -1,50 +1,116 @@
+import os
 import json
 import time
+import hashlib
+import tarfile
+import zipfile
 import asyncio
 import logging
 import aiohttp
 import tiktoken
-from typing import Dict, Any
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple, Callable, Awaitable
 from fastapi import APIRouter, HTTPException, Request, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 
 from ..auth import check_auth
 from ..oauth import OAuthManager, TokenManager
-from ..database import TokenDatabase
+from ..oauth.token_manager import parse_token_import
+from ..database import TokenDatabase, UsageBuffer
+from ..database.token_db import SERIES_GROUP_COLUMNS
+from ..batch import BatchManager
 from ..models import TokenData
 from ..utils import get_token_id
-from ..utils.timezone_utils import get_local_today_iso
-from ..config import API_PASSWORD, QWEN_API_ENDPOINT
+from ..utils.timezone_utils import get_local_today_iso, get_local_timezone, local_bucket_start
+from ..utils.request_trace import RequestTrace, slow_request_log, in_flight
+from ..utils.lifecycle import drain_controller
+from ..utils.upstream_pool import upstream_pool
+from ..utils.model_router import model_router, is_auto_model
+from ..utils.stream_assembler import ChatCompletionAssembler
+from ..utils.access_log import client_key_hash
+from ..utils.request_analytics import request_analytics, GROUP_FIELDS
+from ..utils.loop_monitor import loop_monitor
+from ..utils.sampling_profiler import sampling_profiler
+from ..utils.context_window import get_context_limit, resolve_overflow_policy, truncate_middle
+from ..utils.event_bus import event_bus, format_sse, SSE_KEEPALIVE, DASHBOARD_TOPIC
+from ..utils.fast_json import extract_usage, loads, dumps, rewrite_object
+from ..config import (
+    API_PASSWORD,
+    QWEN_API_ENDPOINT,
+    NON_STREAM_PASSTHROUGH,
+    NON_STREAM_INTERNAL_STREAMING,
+    UPSTREAM_TTFB_TIMEOUT,
+    UPSTREAM_FAILOVER_ATTEMPTS,
+    AUTO_MODEL_NAME,
+    SSE_COALESCE_MS,
+    SSE_COALESCE_BYTES,
+    READY_MIN_TOKENS,
+    READY_MAX_IN_FLIGHT,
+    READY_MAX_PING_FAILURES,
+    USAGE_SERIES_MINUTE_RETENTION_HOURS,
+    USAGE_SERIES_HOUR_RETENTION_DAYS,
+    WORKERS,
+    WORKER_ID
+)
 
 logger = logging.getLogger(__name__)
 
-_session = None
+# 这些状态码说明当前 Token 被限流或失效，或上游暂时不可用，出字前可以换 Token 重试
+FAILOVER_STATUSES = (401, 403, 429, 500, 502, 503, 504)
+# 只有 Token 自身被拒绝或限流时才冷却；5xx 是上游故障，与 Token 无关
+COOLDOWN_STATUSES = (401, 403, 429)
+
+class ClosingStreamingResponse(StreamingResponse):
+    # 客户端在开始迭代前断开时生成器不会执行，收尾回调在响应结束后（含断开、取消）总会执行
+    def __init__(self, content, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
 
 async def get_session() -> aiohttp.ClientSession:
-    global _session
-    if _session is None or _session.closed:
-        connector = aiohttp.TCPConnector(
-            limit=200,
-            limit_per_host=50,
-            ttl_dns_cache=300,
-            use_dns_cache=True,
-            keepalive_timeout=30,
-            enable_cleanup_closed=True
-        )
-        timeout = aiohttp.ClientTimeout(total=30, connect=5)
-        _session = aiohttp.ClientSession(
-            connector=connector,
-            timeout=timeout,
-            connector_owner=True
-        )
-    return _session
+    return await upstream_pool.get_session()
+
+async def close_session() -> None:
+    await upstream_pool.close()
+
+_encoding = None
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except:
+            _encoding = tiktoken.encoding_for_model("gpt-4")
+    return _encoding
+
+async def warmup_upstream() -> None:
+    # 预热失败也启动保活任务，上游恢复后由其补齐连接
+    upstream_pool.start()
+    warmed = await upstream_pool.warm()
+    logger.info(f"上游连接已预热: {warmed} 条")
 
 router = APIRouter()
 db = TokenDatabase()
+usage_buffer = UsageBuffer(db)
+startup_timings: Dict[str, float] = {}
 oauth_manager = OAuthManager()
 token_manager = TokenManager(db)
+batch_manager = BatchManager(token_manager)
 _version_manager = None
 
+def save_oauth_token(token_data: TokenData) -> str:
+    token_id = get_token_id(token_data.refresh_token)
+    token_manager.save_token(token_id, token_data)
+    return token_id
+
+oauth_manager.set_token_handler(save_oauth_token)
+
 def set_version_manager(version_manager):
     global _version_manager
     _version_manager = version_manager
@@ -57,6 +123,16 @@ async def parse_json(request: Request) -> Dict[str, Any]:
     except json.JSONDecodeError:
         raise HTTPException(400, "Invalid JSON")
 
+async def parse_chat_body(request: Request) -> Tuple[Dict[str, Any], bytes]:
+    raw_body = await request.body()
+    try:
+        data = loads(raw_body)
+    except ValueError:
+        raise HTTPException(400, "Invalid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(400, "Invalid JSON")
+    return data, raw_body
+
 @router.post("/login")
 async def api_login(request: Request):
     data = await parse_json(request)
@@ -84,10 +160,86 @@ async def api_upload_token(request: Request, auth: bool = Depends(check_auth)):
     token_manager.save_token(token_id, token_data)
     return JSONResponse({'success': True})
 
+@router.post("/upload-tokens")
+async def api_upload_tokens(request: Request, auth: bool = Depends(check_auth)):
+    raw = await request.body()
+    try:
+        tokens, errors = await asyncio.to_thread(parse_token_import, raw)
+    except (zipfile.BadZipFile, tarfile.TarError, UnicodeDecodeError) as e:
+        raise HTTPException(400, f"Invalid archive: {e}")
+    
+    if not tokens:
+        return JSONResponse({'success': False, 'error': 'No valid tokens found', 'errors': errors}, 400)
+    
+    token_manager.load_tokens()
+    token_manager.save_tokens(tokens)
+    result = {'success': True, 'imported': len(tokens), 'errors': errors}
+    
+    if request.query_params.get('validate', 'true').lower() != 'false':
+        result['validation'] = await token_manager.validate_tokens(list(tokens))
+    
+    return JSONResponse(result)
+
+@router.get("/export-tokens")
+async def api_export_tokens(auth: bool = Depends(check_auth)):
+    async def generate():
+        for token_id, token in db.iter_tokens():
+            yield dumps({
+                'id': token_id,
+                'access_token': token.access_token,
+                'refresh_token': token.refresh_token,
+                'expiry_date': token.expires_at,
+                'uploaded_at': token.uploaded_at,
+                'usage_count': token.usage_count
+            }) + b'\n'
+    
+    return StreamingResponse(generate(), media_type="application/jsonl", headers={
+        'Content-Disposition': 'attachment; filename="tokens.jsonl"'
+    })
+
+TOKEN_STATUS_FILTERS = ('all', 'healthy', 'expired', 'cooling')
+TOKEN_STATUS_SORTS = ('id', 'expiresAt', 'uploadedAt', 'usageCount', 'updatedAt')
+MAX_TOKEN_PAGE_SIZE = 500
+
+def int_param(request: Request, name: str, default: Optional[int]) -> Optional[int]:
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(400, f"Invalid {name}")
+
 @router.get("/token-status")
-async def api_token_status(auth: bool = Depends(check_auth)):
+async def api_token_status(request: Request, auth: bool = Depends(check_auth)):
+    status = request.query_params.get('status', 'all')
+    sort = request.query_params.get('sort', 'uploadedAt')
+    order = request.query_params.get('order', 'desc')
+    if status not in TOKEN_STATUS_FILTERS or sort not in TOKEN_STATUS_SORTS or order not in ('asc', 'desc'):
+        raise HTTPException(400, "Invalid status, sort or order")
+    page = max(int_param(request, 'page', 1), 1)
+    page_size = min(max(int_param(request, 'pageSize', 50), 1), MAX_TOKEN_PAGE_SIZE)
+    since = int_param(request, 'since', None)
+    
+    # 用数据库摘要生成 ETag，未变化时不加载也不格式化任何 Token
+    version = db.get_token_version()
+    cooling = token_manager.cooling_ids()
+    fingerprint = repr((version, cooling, sorted(request.query_params.items())))
+    etag = f'W/"{hashlib.sha1(fingerprint.encode()).hexdigest()[:16]}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status_code=304, headers=headers)
+    
+    # 到期和冷却随时间变化，游标取加载前的当前时间，之后发生的变化都会出现在下次增量结果里
+    cursor = int(time.time() * 1000)
     token_manager.load_tokens()
-    return JSONResponse(token_manager.get_token_status())
+    result = token_manager.get_token_status(status, sort, order, page, page_size, since)
+    result['cooling'] = cooling
+    # 下次增量请求把 cursor 作为 since 传回，deleted 为此后被删除的 Token
+    result['cursor'] = cursor
+    if since is not None:
+        result['deleted'] = db.get_deleted_token_ids(since)
+    return JSONResponse(result, headers=headers)
 
 @router.post("/refresh-single-token")
 async def api_refresh_single_token(request: Request, auth: bool = Depends(check_auth)):
@@ -163,16 +315,61 @@ async def api_oauth_poll(request: Request, auth: bool = Depends(check_auth)):
     if not state_id:
         raise HTTPException(400, "Missing stateId")
     
-    result = await oauth_manager.poll_oauth_status(state_id)
-    
-    if result.get('success') and result.get('tokenData'):
-        token_data = result['tokenData']
-        token_id = get_token_id(token_data.refresh_token)
-        token_manager.save_token(token_id, token_data)
-        return JSONResponse({'success': True, 'tokenId': token_id})
+    # 上游轮询由后台任务完成，这里只返回最新状态
+    result = oauth_manager.get_oauth_status(state_id)
+    if result is None:
+        return JSONResponse({'success': False, 'error': '无效的stateId'}, 404)
     
     return JSONResponse(result)
 
+@router.get("/oauth-events")
+async def api_oauth_events(request: Request, auth: bool = Depends(check_auth)):
+    state_id = request.query_params.get('stateId')
+    if not state_id:
+        raise HTTPException(400, "Missing stateId")
+    
+    async def generate():
+        with event_bus.subscribe(f"oauth:{state_id}") as queue:
+            result = oauth_manager.get_oauth_status(state_id)
+            if result is None:
+                yield format_sse('error', {'success': False, 'status': 'error', 'error': '无效的stateId'})
+                return
+            
+            event = oauth_event_name(result)
+            yield format_sse(event, result)
+            while event == 'status':
+                try:
+                    event, message = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield SSE_KEEPALIVE
+                    continue
+                yield message
+    
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+def oauth_event_name(result: Dict[str, Any]) -> str:
+    if result.get('success'):
+        return 'success'
+    if result.get('status') in ('error', 'cancelled'):
+        return result['status']
+    return 'status'
+
+@router.get("/events")
+async def api_events(auth: bool = Depends(check_auth)):
+    # 所有打开的面板共享一次内存广播，取代各自轮询数据库
+    async def generate():
+        with event_bus.subscribe(DASHBOARD_TOPIC) as queue:
+            yield format_sse('ready', {'subscribers': event_bus.subscriber_count(DASHBOARD_TOPIC)})
+            while not drain_controller.draining:
+                try:
+                    event, message = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield SSE_KEEPALIVE
+                    continue
+                yield message
+    
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
 @router.post("/oauth-cancel")
 async def api_oauth_cancel(request: Request, auth: bool = Depends(check_auth)):
     data = await parse_json(request)
@@ -180,24 +377,129 @@ async def api_oauth_cancel(request: Request, auth: bool = Depends(check_auth)):
 
 @router.post("/chat")
 async def api_chat(request: Request, auth: bool = Depends(check_auth)):
-    return await handle_chat(await parse_json(request))
+    trace = RequestTrace("/api/chat")
+    trace.set(clientKey=client_key_hash(request.headers.get('Authorization')))
+    with trace.phase("parse"):
+        data, raw_body = await parse_chat_body(request)
+    return await handle_chat(
+        data, trace, raw_body,
+        context_overflow=request.headers.get('X-Context-Overflow'),
+        coalesce=request.headers.get('X-Stream-Flush') != 'immediate'
+    )
 
 @router.get("/statistics/usage")
 async def get_usage_statistics(request: Request, auth: bool = Depends(check_auth)):
     date = request.query_params.get('date') or get_local_today_iso()
+    usage_buffer.flush()
     return JSONResponse(db.get_usage_stats(date))
 
 @router.get("/statistics/available-dates")
 async def get_available_dates(auth: bool = Depends(check_auth)):
+    usage_buffer.flush()
     return JSONResponse({"dates": db.get_available_dates()})
 
+SERIES_MAX_POINTS = 1500
+SERIES_BUCKET_SECONDS = {'minute': 60, 'hour': 3600, 'day': 86400}
+SERIES_FILTERS = {'model': 'model', 'tokenId': 'token', 'clientKey': 'client'}
+
+def time_param(request: Request, name: str, default: float) -> int:
+    # 支持 Unix 秒级时间戳或 ISO 日期/时间（无时区时按本地时区解释）
+    value = request.query_params.get(name)
+    if not value:
+        return int(default)
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(400, f"Invalid {name}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=get_local_timezone())
+    return int(parsed.timestamp())
+
+def pick_series_resolution(start: int, end: int) -> str:
+    # 选择点数不超过上限、且仍在保留期内的最细粒度
+    age = time.time() - start
+    for resolution, retention in (('minute', USAGE_SERIES_MINUTE_RETENTION_HOURS * 3600),
+                                  ('hour', USAGE_SERIES_HOUR_RETENTION_DAYS * 86400)):
+        if (end - start) / SERIES_BUCKET_SECONDS[resolution] <= SERIES_MAX_POINTS and (retention <= 0 or age <= retention):
+            return resolution
+    return 'day'
+
+@router.get("/statistics/series")
+async def get_usage_series(request: Request, auth: bool = Depends(check_auth)):
+    end = time_param(request, 'end', time.time())
+    start = time_param(request, 'start', end - 86400)
+    if start >= end:
+        raise HTTPException(400, "start must be before end")
+    
+    resolution = request.query_params.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = pick_series_resolution(start, end)
+    elif resolution not in SERIES_BUCKET_SECONDS:
+        raise HTTPException(400, "Invalid resolution")
+    
+    group_by = [group for group in request.query_params.get('groupBy', 'model').split(',') if group]
+    if any(group not in SERIES_GROUP_COLUMNS for group in group_by):
+        raise HTTPException(400, "Invalid groupBy")
+    filters = {group: request.query_params[name] for name, group in SERIES_FILTERS.items() if request.query_params.get(name)}
+    
+    usage_buffer.flush()
+    # 起点向下取整到桶边界，窗口首个桶不会被截掉
+    rows = db.query_usage_series(resolution, local_bucket_start(start, resolution), end, group_by, filters)
+    
+    series: Dict[Tuple, Dict[str, Any]] = {}
+    total_tokens = total_calls = 0
+    for row in rows:
+        bucket, keys, tokens, calls = row[0], tuple(row[1:-2]), row[-2], row[-1]
+        entry = series.setdefault(keys, {'key': dict(zip(group_by, keys)), 'points': []})
+        entry['points'].append([bucket, tokens, calls])
+        total_tokens += tokens
+        total_calls += calls
+    
+    return JSONResponse({
+        'resolution': resolution,
+        'start': start,
+        'end': end,
+        'groupBy': group_by,
+        'totals': {'tokens': total_tokens, 'calls': total_calls},
+        'series': list(series.values())
+    })
+
+ANALYTICS_FILTERS = {'model': 'model', 'tokenId': 'token', 'clientKey': 'client', 'outcome': 'outcome'}
+
+@router.get("/analytics/requests")
+async def get_request_analytics(request: Request, auth: bool = Depends(check_auth)):
+    if not request_analytics.enabled:
+        raise HTTPException(404, "Request analytics is disabled")
+    end = time_param(request, 'end', time.time() + 1)
+    start = time_param(request, 'start', end - 3600)
+    if start >= end:
+        raise HTTPException(400, "start must be before end")
+    
+    group_by = [group for group in request.query_params.get('groupBy', 'model').split(',') if group]
+    if any(group not in GROUP_FIELDS for group in group_by):
+        raise HTTPException(400, "Invalid groupBy")
+    filters = {group: request.query_params[name] for name, group in ANALYTICS_FILTERS.items() if request.query_params.get(name)}
+    
+    # 段文件扫描是顺序读，放到线程里避免阻塞事件循环
+    result = await asyncio.to_thread(request_analytics.query, start, end, group_by, filters)
+    return JSONResponse({'start': start, 'end': end, 'groupBy': group_by, **result})
+
 @router.delete("/statistics/usage")
 async def delete_usage_statistics(request: Request, auth: bool = Depends(check_auth)):
     data = await parse_json(request)
     date = data.get('date')
     if not date:
         raise HTTPException(400, "Missing date")
+    try:
+        datetime.fromisoformat(date)
+    except (TypeError, ValueError):
+        raise HTTPException(400, "Invalid date")
     
+    usage_buffer.flush()
     return JSONResponse({'success': True, 'deletedCount': db.delete_usage_stats(date)})
 
 @router.get("/health")
@@ -212,9 +514,51 @@ async def health_check():
     except Exception as e:
         return JSONResponse({"status": "error", "error": str(e)}, 503)
 
+@router.get("/livez")
+async def liveness_check():
+    # 只要事件循环能响应就视为存活，不做任何 I/O
+    return JSONResponse({"status": "ok"})
+
+@router.get("/readyz")
+async def readiness_check():
+    # 全部来自内存中的 Token 池、冷却表和连接池状态，探针不会给数据库增加负载
+    available = token_manager.count_available_tokens()
+    active = in_flight.count()
+    max_in_flight = READY_MAX_IN_FLIGHT or (available * token_manager.leases.slots if token_manager.leases.enabled else 0)
+    ping_failures = upstream_pool.consecutive_ping_failures
+    
+    reasons = []
+    if drain_controller.draining:
+        reasons.append('draining')
+    if available < READY_MIN_TOKENS:
+        reasons.append('no_available_tokens')
+    if ping_failures >= READY_MAX_PING_FAILURES:
+        reasons.append('upstream_unreachable')
+    if max_in_flight and active >= max_in_flight:
+        reasons.append('saturated')
+    
+    return JSONResponse({
+        "status": "not_ready" if reasons else "ready",
+        "reasons": reasons,
+        "tokens": {
+            "total": len(token_manager.token_store),
+            "available": available,
+            "cooling": len(token_manager.cooling_ids())
+        },
+        "inFlight": active,
+        "maxInFlight": max_in_flight or None,
+        "upstream": {
+            "idle": upstream_pool.idle(),
+            "inUse": upstream_pool.in_use(),
+            "consecutivePingFailures": ping_failures,
+            "lastPingAt": upstream_pool.last_ping_at
+        }
+    }, 503 if reasons else 200)
+
 @router.get("/metrics")
 async def get_metrics(auth: bool = Depends(check_auth)):
     try:
+        usage_buffer.flush()
         tokens = db.load_all_tokens()
         valid = sum(1 for _, token in tokens.items() 
                    if not (token.expires_at and time.time() * 1000 > token.expires_at))
@@ -222,7 +566,19 @@ async def get_metrics(auth: bool = Depends(check_auth)):
         return JSONResponse({
             "tokens": {"total": len(tokens), "valid": valid},
             "usage": {"today": db.get_usage_stats(get_local_today_iso())},
-            "performance": {"timestamp": time.time()}
+            "performance": {
+                "timestamp": time.time(),
+                "inFlight": in_flight.count(),
+                "pendingUsageWrites": usage_buffer.pending,
+                "upstreamPool": upstream_pool.stats(),
+                "modelRouter": model_router.stats(),
+                "tokenLeases": token_manager.leases.stats(),
+                "requestAnalytics": request_analytics.stats(),
+                "eventLoop": loop_monitor.stats()
+            },
+            # 多进程部署时进程内的指标只反映处理本次请求的工作进程
+            "worker": {"id": WORKER_ID, "workers": WORKERS, "pid": os.getpid()},
+            "startup": startup_timings
         })
     except Exception as e:
         return JSONResponse({"error": str(e)}, 500)
@@ -245,95 +601,401 @@ async def get_version(auth: bool = Depends(check_auth)):
         logger.error(f"版本接口错误: {e}")
         return JSONResponse({"version": "错误", "error": str(e)})
 
-async def handle_chat(data: Dict[str, Any]):
+@router.get("/drain")
+async def get_drain_status(auth: bool = Depends(check_auth)):
+    return JSONResponse(drain_controller.status())
+
+@router.post("/drain")
+async def start_drain(auth: bool = Depends(check_auth)):
+    drain_controller.start()
+    return JSONResponse(drain_controller.status())
+
+@router.get("/debug/in-flight")
+async def get_in_flight_requests(auth: bool = Depends(check_auth)):
+    requests = sorted((trace.to_dict() for trace in in_flight.active()), key=lambda item: item['durationMs'], reverse=True)
+    return JSONResponse({"count": len(requests), "requests": requests})
+
+@router.get("/debug/loop-stalls")
+async def get_loop_stalls(auth: bool = Depends(check_auth)):
+    return JSONResponse({**loop_monitor.stats(), 'recent': loop_monitor.recent_stalls()})
+
+PROFILE_FORMATS = ('collapsed', 'pstats', 'json')
+
+@router.get("/debug/profile")
+async def profile_event_loop(request: Request, auth: bool = Depends(check_auth)):
+    try:
+        seconds = float(request.query_params.get('seconds', '10'))
+        interval_ms = float(request.query_params.get('interval', '10'))
+    except ValueError:
+        raise HTTPException(400, "Invalid seconds or interval")
+    if not 0 < seconds <= sampling_profiler.max_seconds:
+        raise HTTPException(400, f"seconds must be between 0 and {sampling_profiler.max_seconds:g}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(400, "interval must be between 1 and 1000 ms")
+    output = request.query_params.get('format', 'collapsed')
+    if output not in PROFILE_FORMATS:
+        raise HTTPException(400, f"format must be one of: {', '.join(PROFILE_FORMATS)}")
+    include_idle = request.query_params.get('idle', '').lower() in ('1', 'true')
+    
+    try:
+        profile = await sampling_profiler.profile(seconds, interval_ms / 1000, include_idle)
+    except RuntimeError as e:
+        raise HTTPException(409, str(e))
+    
+    if output == 'json':
+        return JSONResponse(profile.summary())
+    filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{'txt' if output == 'collapsed' else 'pstats'}"
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if output == 'collapsed':
+        return Response(profile.collapsed(), media_type='text/plain', headers=headers)
+    return Response(profile.pstats(), media_type='application/octet-stream', headers=headers)
+
+@router.get("/debug/slow-requests")
+async def get_slow_requests(request: Request, auth: bool = Depends(check_auth)):
+    try:
+        limit = int(request.query_params.get('limit', '20'))
+    except ValueError:
+        raise HTTPException(400, "Invalid limit")
+    
+    return JSONResponse({
+        "window": len(slow_request_log),
+        "requests": slow_request_log.slowest(max(1, limit))
+    })
+
+def context_length_error(limit: int, prompt_tokens: int, max_tokens: int) -> JSONResponse:
+    requested = prompt_tokens + max_tokens
+    message = (f"This model's maximum context length is {limit} tokens. However, you requested "
+               f"{requested} tokens ({prompt_tokens} in the messages, {max_tokens} in the completion). "
+               f"Please reduce the length of the messages or completion.")
+    return JSONResponse(status_code=400, content={'error': {
+        'message': message,
+        'type': 'invalid_request_error',
+        'param': 'messages',
+        'code': 'context_length_exceeded'
+    }})
+
+async def handle_chat(data: Dict[str, Any], trace: Optional[RequestTrace] = None,
+                      raw_body: Optional[bytes] = None, context_overflow: Optional[str] = None,
+                      coalesce: bool = True):
+    if trace is None:
+        trace = RequestTrace("chat")
+    in_flight.add(trace)
+    
+    try:
+        return await _handle_chat(data, trace, raw_body, context_overflow, coalesce)
+    except BaseException:
+        trace.finish("error")
+        raise
+
+async def _handle_chat(data: Dict[str, Any], trace: RequestTrace, raw_body: Optional[bytes],
+                       context_overflow: Optional[str], coalesce: bool):
     messages = data.get('messages')
     model = data.get('model', 'qwen3-coder-plus')
     stream = data.get('stream', False)
+    trace.set(model=model, stream=bool(stream))
     
     if not messages or not isinstance(messages, list):
         raise HTTPException(400, "Invalid messages")
 
-    try:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    except:
-        encoding = tiktoken.encoding_for_model("gpt-4")
-
-    prompt_tokens = sum(len(encoding.encode(str(msg.get('content', '')))) for msg in messages)
-    token_manager.load_tokens()
+    with trace.phase("tokenize"):
+        encoding = get_encoding()
+        token_counts = [len(encoding.encode(str(msg.get('content', '')))) for msg in messages]
+        prompt_tokens = sum(token_counts)
+    trace.set(promptTokens=prompt_tokens)
     
-    valid_token = await token_manager.get_valid_token()
-    if not valid_token:
-        raise HTTPException(400, "No valid token")
+    if is_auto_model(model):
+        model = model_router.route(prompt_tokens)
+        trace.set(model=model, requestedModel=AUTO_MODEL_NAME)
     
-    token_id, current_token = valid_token
-    session = await get_session()
+    # 超出上下文窗口的请求在占用 Token 和上游往返之前就地处理
+    truncated = False
+    context_limit = get_context_limit(model)
+    if context_limit is not None:
+        max_tokens = data.get('max_tokens')
+        max_tokens = max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else 0
+        budget = context_limit - max_tokens
+        if prompt_tokens > budget:
+            kept = None
+            if resolve_overflow_policy(context_overflow) == 'truncate_middle':
+                kept = truncate_middle(messages, token_counts, budget)
+            if kept is None:
+                trace.finish("context_length_exceeded")
+                return context_length_error(context_limit, prompt_tokens, max_tokens)
+            trace.set(truncatedMessages=len(messages) - len(kept))
+            messages = kept
+            prompt_tokens = sum(len(encoding.encode(str(msg.get('content', '')))) for msg in messages)
+            trace.set(promptTokens=prompt_tokens)
+            truncated = True
     
-    headers = {
-        'Authorization': f'Bearer {current_token.access_token}',
-        'Content-Type': 'application/json',
-        'Accept': 'text/event-stream' if stream else 'application/json'
-    }
+    with trace.phase("load_tokens"):
+        token_manager.load_tokens()
     
-    if _version_manager:
-        headers['User-Agent'] = await _version_manager.get_user_agent_async()
-
-    body = {
+    session = await get_session()
+    # 非流式请求可改为流式请求上游，由代理组装完整响应
+    internal_stream = not stream and NON_STREAM_INTERNAL_STREAMING
+    upstream_stream = stream or internal_stream
+    
+    overrides = {
         'model': model,
-        'messages': messages,
         'temperature': data.get('temperature', 0.5),
         'top_p': data.get('top_p', 1),
-        'stream': stream
+        'stream': upstream_stream
     }
-
-    response = await session.post(QWEN_API_ENDPOINT, json=body, headers=headers)
+    if internal_stream:
+        overrides['stream_options'] = {'include_usage': True}
+    if truncated:
+        overrides['messages'] = messages
+    
+    if raw_body is not None:
+        # 大请求体只改写顶层字段后按字节转发，避免再次完整序列化
+        with trace.phase("rewrite_body"):
+            payload = rewrite_object(raw_body, overrides)
+    else:
+        payload = dumps({**overrides, 'messages': messages})
+    
+    # 流式上游不设总超时，由首个数据块的截止时间和数据块之间的读超时约束
+    request_timeout = aiohttp.ClientTimeout(total=None, connect=5, sock_read=UPSTREAM_TTFB_TIMEOUT) if upstream_stream else None
+    tried = set()
+    response = None
+    first_chunk = None
+    
+    # 流式上游在返回首个数据块之前失败或超时，换用其他 Token 重试；普通非流式请求只请求一次
+    attempts = UPSTREAM_FAILOVER_ATTEMPTS + 1 if upstream_stream else 1
+    for attempt in range(attempts):
+        with trace.phase("token_select"):
+            leased = await token_manager.lease_token(exclude=tried)
+        if not leased:
+            if attempt > 0:
+                break
+            if token_manager.leases.enabled and token_manager.count_valid_tokens() > 0:
+                raise HTTPException(429, "All tokens are at their concurrency limit", headers={'Retry-After': '1'})
+            raise HTTPException(400, "No valid token")
+        
+        token_id, current_token, lease_id = leased
+        tried.add(token_id)
+        if lease_id:
+            # 请求结束（含异常）时归还名额；出字前切换 Token 时提前归还
+            trace.add_finalizer(lambda lease_id=lease_id: token_manager.leases.release(lease_id))
+        trace.set(tokenId=token_id, attempts=attempt + 1)
+        
+        headers = {
+            'Authorization': f'Bearer {current_token.access_token}',
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream' if upstream_stream else 'application/json'
+        }
+        
+        if _version_manager:
+            with trace.phase("user_agent"):
+                headers['User-Agent'] = await _version_manager.get_user_agent_async()
+        
+        # 每次尝试单独计时：失败尝试的耗时累计到 failover 阶段，upstream_ttfb 只记录最终那次尝试
+        attempt_start = time.perf_counter()
+        try:
+            if upstream_stream:
+                async with asyncio.timeout(UPSTREAM_TTFB_TIMEOUT):
+                    response = await session.post(QWEN_API_ENDPOINT, data=payload, headers=headers,
+                                                  timeout=request_timeout)
+                    if response.status == 200:
+                        first_chunk = await response.content.readany()
+            else:
+                response = await session.post(QWEN_API_ENDPOINT, data=payload, headers=headers)
+        except (TimeoutError, aiohttp.ClientError) as e:
+            attempt_ms = (time.perf_counter() - attempt_start) * 1000
+            if not upstream_stream:
+                trace.add_phase("upstream_ttfb", attempt_ms)
+                raise
+            trace.add_phase("failover", attempt_ms)
+            if response is not None:
+                response.release()
+            response = None
+            logger.warning(f"Token {token_id} 上游请求失败，尝试切换: {e!r}")
+            token_manager.cool_down(token_id)
+            token_manager.leases.release(lease_id)
+            continue
+        
+        attempt_ms = (time.perf_counter() - attempt_start) * 1000
+        trace.set(upstreamStatus=response.status)
+        if upstream_stream and response.status in FAILOVER_STATUSES:
+            trace.add_phase("failover", attempt_ms)
+            response.release()
+            logger.warning(f"Token {token_id} 上游返回 {response.status}，尝试切换")
+            if response.status in COOLDOWN_STATUSES:
+                token_manager.cool_down(token_id)
+            token_manager.leases.release(lease_id)
+            continue
+        trace.add_phase("upstream_ttfb", attempt_ms)
+        break
+    del payload
+    
+    if response is None:
+        raise HTTPException(504, 'Upstream timeout')
+    # 只有流式上游的耗时是首个数据块的到达时间；普通非流式请求包含整段生成时间，不能作为首字延迟样本
+    if upstream_stream and response.status == 200:
+        model_router.observe(model, attempt_ms)
     if response.status != 200:
+        response.release()
         raise HTTPException(500, f'API error: {response.status}')
 
     if stream:
+        flush_window = SSE_COALESCE_MS / 1000 if coalesce else 0
+        
         async def generate():
             buffer = ""
             last_content = ""
             completion_text = ""
+            relay_start = time.perf_counter()
+            outcome = "error"
+            # 下游写入按时间窗口/字节阈值合并，首个内容片段到达时立即发出
+            pending = []
+            pending_size = 0
+            flushed_at = relay_start
+            first_token_sent = False
             
-            async for chunk in response.content.iter_any():
-                buffer += chunk.decode('utf-8')
-                
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.startswith('data:'):
-                        line_data = line[5:].strip()
-                        if line_data and line_data != '[DONE]':
+            try:
+                chunk = first_chunk
+                while True:
+                    if chunk is None:
+                        if pending:
+                            wait = flush_window - (time.perf_counter() - flushed_at)
                             try:
-                                json_data = json.loads(line_data)
-                                delta = json_data.get('choices', [{}])[0].get('delta', {})
-                                current_content = delta.get('content', '')
-                                
-                                if current_content and current_content != last_content:
-                                    last_content = current_content
-                                    completion_text += current_content
-                                    yield line + '\n'
-                                elif not current_content:
-                                    yield line + '\n'
-                            except:
-                                yield line + '\n'
+                                async with asyncio.timeout(wait):
+                                    chunk = await response.content.readany()
+                            except TimeoutError:
+                                yield ''.join(pending)
+                                pending, pending_size = [], 0
+                                flushed_at = time.perf_counter()
+                                continue
                         else:
-                            yield line + '\n'
-                    else:
-                        yield line + '\n'
-            
-            if buffer:
-                yield buffer
+                            chunk = await response.content.readany()
+                    if not chunk:
+                        break
+                    buffer += chunk.decode('utf-8')
+                    
+                    while '\n' in buffer:
+                        line, buffer = buffer.split('\n', 1)
+                        keep = True
+                        if line.startswith('data:'):
+                            line_data = line[5:].strip()
+                            if line_data and line_data != '[DONE]':
+                                try:
+                                    json_data = json.loads(line_data)
+                                    delta = json_data.get('choices', [{}])[0].get('delta', {})
+                                    current_content = delta.get('content', '')
+                                    
+                                    if current_content and current_content != last_content:
+                                        last_content = current_content
+                                        completion_text += current_content
+                                    elif current_content:
+                                        keep = False
+                                except:
+                                    pass
+                        if keep:
+                            pending.append(line + '\n')
+                            pending_size += len(line) + 1
+                    
+                    if pending and (
+                        flush_window <= 0
+                        or (completion_text and not first_token_sent)
+                        or pending_size >= SSE_COALESCE_BYTES
+                        or time.perf_counter() - flushed_at >= flush_window
+                    ):
+                        first_token_sent = first_token_sent or bool(completion_text)
+                        yield ''.join(pending)
+                        pending, pending_size = [], 0
+                        flushed_at = time.perf_counter()
+                    chunk = None
                 
-            if completion_text:
-                tokens = len(encoding.encode(completion_text))
-                db.update_token_usage(get_local_today_iso(), model, prompt_tokens + tokens)
-                db.increment_token_usage_count(token_id)
+                if buffer:
+                    pending.append(buffer)
+                if pending:
+                    yield ''.join(pending)
+                    
+                if completion_text:
+                    tokens = len(encoding.encode(completion_text))
+                    trace.set(completionTokens=tokens)
+                    usage_buffer.record(get_local_today_iso(), model, prompt_tokens + tokens, token_id, trace.attributes.get('clientKey'))
+                outcome = "ok"
+            finally:
+                trace.add_phase("relay", (time.perf_counter() - relay_start) * 1000)
+                trace.finish(outcome)
+        
+        body = generate()
         
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        async def close():
+            # 归还租约、移出进行中列表并释放上游连接
+            await body.aclose()
+            response.release()
+            trace.finish("error")
+        
+        return ClosingStreamingResponse(
+            body,
+            on_close=close,
+            media_type="text/event-stream",
+            headers={'Server-Timing': trace.server_timing()}
+        )
+    
+    if internal_stream:
+        return await assemble_stream(response, first_chunk, trace, model, prompt_tokens, encoding)
+    
+    if NON_STREAM_PASSTHROUGH:
+        with trace.phase("relay"):
+            raw = await response.read()
+        usage = extract_usage(raw)
+    else:
+        with trace.phase("relay"):
+            result = await response.json()
+        usage = result.get('usage')
+    
+    if usage is not None:
+        usage_buffer.record(get_local_today_iso(), model, usage.get('total_tokens', 0), token_id, trace.attributes.get('clientKey'))
+        trace.set(completionTokens=usage.get('completion_tokens'))
+    
+    trace.finish()
+    if NON_STREAM_PASSTHROUGH:
+        return Response(content=raw, headers={
+            'Content-Type': response.headers.get('Content-Type', 'application/json'),
+            'Server-Timing': trace.server_timing()
+        })
+    return JSONResponse(result, headers={'Server-Timing': trace.server_timing()})
+
+async def assemble_stream(response: aiohttp.ClientResponse, first_chunk: bytes, trace: RequestTrace,
+                          model: str, prompt_tokens: int, encoding) -> JSONResponse:
+    assembler = ChatCompletionAssembler()
+    buffer = b""
+    relay_start = time.perf_counter()
+    
+    with trace.phase("relay"):
+        chunk = first_chunk
+        while chunk:
+            buffer += chunk
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                if line.startswith(b'data:'):
+                    line_data = line[5:].strip()
+                    if line_data and line_data != b'[DONE]':
+                        try:
+                            assembler.add(loads(line_data))
+                        except ValueError:
+                            continue
+                        if 'firstTokenMs' not in trace.attributes and assembler.content:
+                            trace.set(firstTokenMs=round(trace.elapsed_ms(), 2))
+            # 长时间生成的进度可通过 /api/debug/in-flight 查看
+            trace.set(receivedChunks=assembler.chunks, relayMs=round((time.perf_counter() - relay_start) * 1000, 2))
+            chunk = await response.content.readany()
     
-    result = await response.json()
-    if 'usage' in result:
-        db.update_token_usage(get_local_today_iso(), model, result['usage'].get('total_tokens', 0))
-        db.increment_token_usage_count(token_id)
+    result = assembler.result()
+    usage = result.get('usage')
+    if usage is None:
+        completion_tokens = len(encoding.encode(assembler.content))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+        result['usage'] = usage
     
-    return JSONResponse(result)
\ No newline at end of file
+    usage_buffer.record(get_local_today_iso(), model, usage.get('total_tokens', 0), trace.attributes.get('tokenId'),
+                        trace.attributes.get('clientKey'))
+    trace.set(completionTokens=usage.get('completion_tokens'))
+    trace.finish()
+    return JSONResponse(result, headers={'Server-Timing': trace.server_timing()})
@@ -0,0 +1,4 @@
+"""
+Batch job module for Qwen Code API Server
+"""
+from .batch_manager import BatchManager
\ No newline at end of file
@@ -0,0 +1,354 @@
+"""
+Offline batch jobs for Qwen Code API Server
+"""
+import os
+import json
+import math
+import time
+import shutil
+import asyncio
+import logging
+import secrets
+from typing import Dict, Any, Optional, List, Tuple, Set, AsyncIterator
+
+from fastapi import HTTPException
+
+from ..oauth import TokenManager
+from ..utils.fast_json import loads, dumps
+from ..utils.request_trace import RequestTrace, in_flight
+from ..config import BATCH_DIR, BATCH_CONCURRENCY_PER_TOKEN, BATCH_MAX_RETRIES, BATCH_INTERACTIVE_RESERVE
+
+logger = logging.getLogger(__name__)
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+META_SAVE_INTERVAL = 1.0
+# Token 并发名额已满（429）时的最长退避时间（秒）
+MAX_THROTTLE_DELAY = 30.0
+# 取消请求可能落在未运行该任务的工作进程上，通过批处理目录中的标记文件通知任务所在进程
+CANCEL_MARKER = "cancel"
+
+
+class BatchManager:
+
+    def __init__(self, token_manager: TokenManager, batch_dir: str = BATCH_DIR):
+        self.token_manager = token_manager
+        self.batch_dir = batch_dir
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def _path(self, batch_id: str, name: str = "") -> str:
+        return os.path.join(self.batch_dir, batch_id, name)
+
+    def _load_meta(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(batch_id, 'meta.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _cancelled_at(self, batch_id: str) -> Optional[int]:
+        try:
+            return int(os.path.getmtime(self._path(batch_id, CANCEL_MARKER)))
+        except OSError:
+            return None
+
+    def _save_meta(self, meta: Dict[str, Any]) -> None:
+        # 以取消标记为准，避免运行中的任务写回进度时覆盖其他进程写入的取消状态
+        if meta['status'] == 'in_progress':
+            cancelled_at = self._cancelled_at(meta['id'])
+            if cancelled_at is not None:
+                meta['status'] = 'cancelled'
+                meta['cancelled_at'] = cancelled_at
+        path = self._path(meta['id'], 'meta.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    async def create_batch(self, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+        batch_id = f"batch_{secrets.token_hex(12)}"
+        os.makedirs(self._path(batch_id), exist_ok=True)
+        input_path = self._path(batch_id, 'input.jsonl')
+
+        with open(input_path, 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+
+        try:
+            total = await asyncio.to_thread(self._validate_input, input_path)
+        except ValueError:
+            shutil.rmtree(self._path(batch_id), ignore_errors=True)
+            raise
+
+        meta = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': CHAT_COMPLETIONS_URL,
+            'status': 'in_progress',
+            'created_at': int(time.time()),
+            'in_progress_at': int(time.time()),
+            'completed_at': None,
+            'cancelled_at': None,
+            'failed_at': None,
+            'errors': None,
+            'request_counts': {'total': total, 'completed': 0, 'failed': 0}
+        }
+        self._save_meta(meta)
+        self._start(batch_id)
+        return meta
+
+    def _validate_input(self, input_path: str) -> int:
+        custom_ids: Set[str] = set()
+        with open(input_path, 'rb') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = loads(line)
+                except ValueError:
+                    raise ValueError(f"Line {line_number}: invalid JSON")
+
+                if not isinstance(item, dict) or not isinstance(item.get('custom_id'), str):
+                    raise ValueError(f"Line {line_number}: missing custom_id")
+                if item['custom_id'] in custom_ids:
+                    raise ValueError(f"Line {line_number}: duplicate custom_id {item['custom_id']}")
+                if item.get('url', CHAT_COMPLETIONS_URL) != CHAT_COMPLETIONS_URL:
+                    raise ValueError(f"Line {line_number}: unsupported url {item.get('url')}")
+                body = item.get('body')
+                if not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+                    raise ValueError(f"Line {line_number}: invalid body")
+                custom_ids.add(item['custom_id'])
+
+        if not custom_ids:
+            raise ValueError("Empty batch input")
+        return len(custom_ids)
+
+    def _read_progress(self, output_path: str) -> Tuple[Set[str], int, int]:
+        done: Set[str] = set()
+        completed = failed = 0
+        if not os.path.exists(output_path):
+            return done, completed, failed
+
+        valid_size = 0
+        with open(output_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = loads(line)
+                except ValueError:
+                    break
+                valid_size += len(line)
+                done.add(record['custom_id'])
+                if record.get('error') is None:
+                    completed += 1
+                else:
+                    failed += 1
+
+        # 进程中断可能留下半行，截断后该请求会被重新执行
+        if valid_size != os.path.getsize(output_path):
+            with open(output_path, 'r+b') as f:
+                f.truncate(valid_size)
+        return done, completed, failed
+
+    def _start(self, batch_id: str) -> None:
+        task = asyncio.create_task(self._run_guarded(batch_id))
+        self._tasks[batch_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch_id, None))
+
+    async def _run_guarded(self, batch_id: str) -> None:
+        try:
+            await self._run(batch_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"批处理任务 {batch_id} 失败: {e}")
+            meta = self._load_meta(batch_id)
+            if meta:
+                meta['status'] = 'failed'
+                meta['failed_at'] = int(time.time())
+                meta['errors'] = {'data': [{'message': str(e)}]}
+                self._save_meta(meta)
+
+    async def _run(self, batch_id: str) -> None:
+        meta = self._load_meta(batch_id)
+        output_path = self._path(batch_id, 'output.jsonl')
+        done, completed, failed = await asyncio.to_thread(self._read_progress, output_path)
+        counts = meta['request_counts']
+        counts['completed'], counts['failed'] = completed, failed
+
+        self.token_manager.load_tokens()
+        # 总并发中预留一部分给交互请求，批处理的并发和让出阈值都取剩余部分
+        capacity = max(1, self.token_manager.count_valid_tokens() * BATCH_CONCURRENCY_PER_TOKEN)
+        reserved = max(1, math.ceil(capacity * BATCH_INTERACTIVE_RESERVE))
+        concurrency = max(1, capacity - reserved)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+        logger.info(f"批处理任务 {batch_id} 开始: 已完成 {len(done)}/{counts['total']}，并发 {concurrency}，"
+                    f"为交互请求保留 {reserved}")
+
+        async def produce():
+            with open(self._path(batch_id, 'input.jsonl'), 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    item = loads(line)
+                    if item['custom_id'] not in done:
+                        await queue.put(item)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        last_saved = time.monotonic()
+        with open(output_path, 'ab') as output:
+            async def work():
+                nonlocal last_saved
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+
+                    record, succeeded = await self._execute(item, concurrency)
+                    output.write(record + b'\n')
+                    output.flush()
+
+                    if succeeded:
+                        counts['completed'] += 1
+                    else:
+                        counts['failed'] += 1
+                    if time.monotonic() - last_saved > META_SAVE_INTERVAL:
+                        last_saved = time.monotonic()
+                        self._save_meta(meta)
+                        if meta['status'] == 'cancelled':
+                            logger.info(f"批处理任务 {batch_id} 已被取消，停止执行")
+                            self._tasks[batch_id].cancel()
+
+            try:
+                await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+            finally:
+                self._save_meta(meta)
+
+        if meta['status'] != 'in_progress':
+            return
+        meta['status'] = 'completed'
+        meta['completed_at'] = int(time.time())
+        self._save_meta(meta)
+        logger.info(f"批处理任务 {batch_id} 完成: 成功 {counts['completed']}，失败 {counts['failed']}")
+
+    async def _execute(self, item: Dict[str, Any], budget: int) -> Tuple[bytes, bool]:
+        from ..api.routes import handle_chat
+
+        body = dict(item['body'])
+        body['stream'] = False
+        # 按原始请求体转发，messages 以外的字段（tools、max_tokens 等）原样保留
+        raw_body = dumps(body)
+
+        attempt = 0
+        throttled = 0
+        while True:
+            # 交互请求优先：总并发达到预算时批处理让出名额
+            await in_flight.wait_below(budget)
+            trace = RequestTrace("batch", priority="batch")
+            retry_after = None
+            try:
+                response = await handle_chat(body, trace, raw_body=raw_body)
+                status_code, response_body = response.status_code, response.body
+                retry_after = response.headers.get('Retry-After')
+            except HTTPException as e:
+                status_code, response_body = e.status_code, dumps({'error': {'message': e.detail}})
+                retry_after = (e.headers or {}).get('Retry-After')
+            except Exception as e:
+                status_code, response_body = 500, dumps({'error': {'message': str(e)}})
+
+            # 429 表示 Token 并发名额已满，属于暂时状态：按 Retry-After 持续退避，不消耗 5xx 的重试次数
+            if status_code == 429:
+                throttled += 1
+                await asyncio.sleep(throttle_delay(retry_after, throttled))
+                continue
+            if status_code < 500 or attempt == BATCH_MAX_RETRIES:
+                break
+            await asyncio.sleep(2 ** attempt)
+            attempt += 1
+
+        error = None
+        try:
+            parsed = loads(response_body)
+        except ValueError:
+            # 非 JSON 响应体不能拼进结果行，否则整个输出文件从这一行起无法解析
+            error = {'code': 'invalid_response', 'message': f'Upstream returned a non-JSON body with status {status_code}'}
+            response_body = dumps(response_body.decode('utf-8', 'replace'))
+        else:
+            # 上游返回的 JSON 不含换行时直接拼接原始字节，避免重新序列化
+            if b'\n' in response_body:
+                response_body = dumps(parsed)
+        if error is None and status_code != 200:
+            error = {'code': str(status_code), 'message': f'Request failed with status {status_code}'}
+        succeeded = error is None
+        record = b''.join([
+            b'{"id":', dumps(f"batch_req_{secrets.token_hex(12)}"),
+            b',"custom_id":', dumps(item['custom_id']),
+            b',"response":{"status_code":', str(status_code).encode(),
+            b',"body":', response_body,
+            b'},"error":', b'null' if succeeded else dumps(error), b'}'
+        ])
+        return record, succeeded
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        if not batch_id.startswith('batch_') or os.path.basename(batch_id) != batch_id:
+            return None
+        return self._load_meta(batch_id)
+
+    def list_batches(self) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.batch_dir):
+            return []
+        batches = [self._load_meta(name) for name in os.listdir(self.batch_dir)]
+        return sorted((meta for meta in batches if meta), key=lambda meta: meta['created_at'], reverse=True)
+
+    def get_output_path(self, batch_id: str) -> Optional[str]:
+        if self.get_batch(batch_id) is None:
+            return None
+        path = self._path(batch_id, 'output.jsonl')
+        return path if os.path.exists(path) else None
+
+    async def cancel_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        meta = self.get_batch(batch_id)
+        if meta is None:
+            return None
+        if meta['status'] == 'in_progress':
+            open(self._path(batch_id, CANCEL_MARKER), 'w').close()
+
+        task = self._tasks.get(batch_id)
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        meta = self._load_meta(batch_id)
+        if meta['status'] == 'in_progress':
+            # 写回时按取消标记更新状态；任务所在的其他工作进程下次保存进度时发现标记并停止
+            self._save_meta(meta)
+        return meta
+
+    def resume_pending(self) -> int:
+        resumed = 0
+        for meta in self.list_batches():
+            if meta['status'] == 'in_progress' and meta['id'] not in self._tasks:
+                self._start(meta['id'])
+                resumed += 1
+        if resumed:
+            logger.info(f"恢复了 {resumed} 个未完成的批处理任务")
+        return resumed
+
+    async def shutdown(self) -> None:
+        # 保持 in_progress 状态，下次启动时从输出文件断点续跑
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def throttle_delay(retry_after: Optional[str], throttled: int) -> float:
+    # 优先使用服务端给出的 Retry-After，缺失或无法解析时按次数指数退避
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2 ** min(throttled - 1, 5)
+    return min(max(delay, 0.0), MAX_THROTTLE_DELAY)
@@ -27,6 +27,14 @@ API_PASSWORD = os.getenv("API_PASSWORD", "qwen123")  # 默认密码，生产环
 DATABASE_URL = os.getenv("DATABASE_URL", "data/tokens.db")
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+# 工作进程数（python -m src.launcher 启动时生效），0 表示按可用 CPU 核数自动决定
+WORKERS = int(os.getenv("WORKERS", "1"))
+# 当前工作进程编号，由启动器设置；编号 0 为主进程，定时刷新 Token 等后台任务只在主进程运行
+WORKER_ID = int(os.getenv("WORKER_ID", "0"))
+IS_PRIMARY_WORKER = WORKER_ID == 0
+# SQLite 日志模式与锁等待时间（秒），WAL 模式下多个进程可以同时读写
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "wal")
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
 
 # OAuth2 Configuration
 QWEN_OAUTH_BASE_URL = os.getenv("QWEN_OAUTH_BASE_URL", "https://chat.qwen.ai")
@@ -40,14 +48,116 @@ QWEN_OAUTH_GRANT_TYPE = "urn:ietf:params:oauth:grant-type:device_code"
 
 # API Configuration
 QWEN_API_ENDPOINT = os.getenv("QWEN_API_ENDPOINT", "https://portal.qwen.ai/v1/chat/completions")
+# 非流式请求也以流式方式请求上游并在代理内组装完整响应，可获得首字节超时与出字前故障转移
+NON_STREAM_INTERNAL_STREAMING = os.getenv("NON_STREAM_INTERNAL_STREAMING", "false").lower() == "true"
+# 流式上游首个数据块的超时（秒），同时作为数据块之间的最长等待时间
+UPSTREAM_TTFB_TIMEOUT = float(os.getenv("UPSTREAM_TTFB_TIMEOUT", "30"))
+# 流式上游出字前失败/超时时换用其他 Token 重试的次数
+UPSTREAM_FAILOVER_ATTEMPTS = int(os.getenv("UPSTREAM_FAILOVER_ATTEMPTS", "2"))
+# 上游连接池: 启动时预热的连接数、空闲连接保留时间（秒）与保活间隔（秒），连接数为 0 时关闭保活
+UPSTREAM_WARM_CONNECTIONS = int(os.getenv("UPSTREAM_WARM_CONNECTIONS", "4"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "120"))
+UPSTREAM_PING_INTERVAL = float(os.getenv("UPSTREAM_PING_INTERVAL", "25"))
+# 非流式响应直接透传上游原始字节，不做解析与重新序列化
+NON_STREAM_PASSTHROUGH = os.getenv("NON_STREAM_PASSTHROUGH", "true").lower() == "true"
+
+# 各模型上下文窗口（token），可用 MODEL_CONTEXT_LIMITS="model=limit,model=limit" 覆盖
+MODEL_CONTEXT_LIMITS = {
+    "qwen3-coder-plus": 1000000,
+    "qwen3-coder-flash": 1000000
+}
+for _item in os.getenv("MODEL_CONTEXT_LIMITS", "").split(","):
+    if "=" in _item:
+        _model, _limit = _item.split("=", 1)
+        MODEL_CONTEXT_LIMITS[_model.strip()] = int(_limit)
+# 虚拟模型: 按提示长度、各模型排队深度与首字节延迟在 plus/flash 之间路由，留空关闭
+AUTO_MODEL_NAME = os.getenv("AUTO_MODEL_NAME", "qwen3-coder-auto")
+AUTO_MODEL_TTFB_SLO_MS = float(os.getenv("AUTO_MODEL_TTFB_SLO_MS", "3000"))
+AUTO_MODEL_SMALL_PROMPT_TOKENS = int(os.getenv("AUTO_MODEL_SMALL_PROMPT_TOKENS", "2000"))
+AUTO_MODEL_MAX_IN_FLIGHT = int(os.getenv("AUTO_MODEL_MAX_IN_FLIGHT", "32"))
+# 超出上下文窗口时的默认处理: reject 直接拒绝，truncate_middle 丢弃中间的历史消息
+# 客户端可通过 X-Context-Overflow 请求头按请求指定
+CONTEXT_OVERFLOW_POLICY = os.getenv("CONTEXT_OVERFLOW_POLICY", "reject")
+
+# 流式输出合并: 在时间窗口（毫秒）或字节阈值内合并下游写入，窗口为 0 时每个上游分片立即写出
+# 客户端可通过请求头 X-Stream-Flush: immediate 按请求关闭
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "20"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "4096"))
 
 # Database Configuration
 DATABASE_TABLE_NAME = "tokens"
 
+# 用量统计写入缓冲间隔（秒）
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+# 用量时间序列各粒度的保留时长，0 表示永久保留
+USAGE_SERIES_MINUTE_RETENTION_HOURS = float(os.getenv("USAGE_SERIES_MINUTE_RETENTION_HOURS", "48"))
+USAGE_SERIES_HOUR_RETENTION_DAYS = float(os.getenv("USAGE_SERIES_HOUR_RETENTION_DAYS", "90"))
+USAGE_SERIES_DAY_RETENTION_DAYS = float(os.getenv("USAGE_SERIES_DAY_RETENTION_DAYS", "0"))
+
+# Token Configuration
+TOKEN_VALIDATE_CONCURRENCY = int(os.getenv("TOKEN_VALIDATE_CONCURRENCY", "16"))
+# Token 租约: 每个 Token 的最大并发（0 不限制）、租约有效期（秒）、名额占满时的最长等待（秒）
+# 多个节点共享同一数据库文件时使用 sqlite 后端，单节点可用 memory
+TOKEN_MAX_CONCURRENCY = int(os.getenv("TOKEN_MAX_CONCURRENCY", "0"))
+TOKEN_LEASE_BACKEND = os.getenv("TOKEN_LEASE_BACKEND", "memory")
+# memory 租约只在单个进程内有效，多进程时改用 sqlite，避免多个进程用同一个 refresh_token 同时刷新
+if WORKERS != 1 and TOKEN_LEASE_BACKEND == "memory":
+    TOKEN_LEASE_BACKEND = "sqlite"
+TOKEN_LEASE_TTL = float(os.getenv("TOKEN_LEASE_TTL", "60"))
+TOKEN_LEASE_WAIT = float(os.getenv("TOKEN_LEASE_WAIT", "10"))
+# 上游限流或出错后该 Token 暂停调度的时间（秒）
+TOKEN_COOLDOWN_SECONDS = float(os.getenv("TOKEN_COOLDOWN_SECONDS", "60"))
+
+# Batch Configuration
+BATCH_DIR = os.getenv("BATCH_DIR", "data/batches")
+BATCH_CONCURRENCY_PER_TOKEN = int(os.getenv("BATCH_CONCURRENCY_PER_TOKEN", "2"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "2"))
+# 为交互请求保留的并发比例（至少 1 个名额），总并发达到其余部分时批处理暂停发起新请求
+BATCH_INTERACTIVE_RESERVE = float(os.getenv("BATCH_INTERACTIVE_RESERVE", "0.25"))
+
 # Security Configuration
 HASH_ALGORITHM = "sha256"
 PKCE_VERIFIER_LENGTH = 32
 STATE_ID_LENGTH = 32
 
 # Web Interface Configuration
-HTML_TEMPLATE_PATH = "templates/index.html"
\ No newline at end of file
+HTML_TEMPLATE_PATH = "templates/index.html"
+
+# Shutdown Configuration
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+
+# Readiness Configuration
+# 可调度（未过期且未冷却）的 Token 少于该数量时 /api/readyz 返回 503
+READY_MIN_TOKENS = int(os.getenv("READY_MIN_TOKENS", "1"))
+# 进行中请求超过该数量时视为未就绪；0 表示按 Token 并发上限推算，未启用上限时不限制
+READY_MAX_IN_FLIGHT = int(os.getenv("READY_MAX_IN_FLIGHT", "0"))
+# 上游保活连续失败达到该次数时视为上游不可用
+READY_MAX_PING_FAILURES = int(os.getenv("READY_MAX_PING_FAILURES", "3"))
+
+# Access Log Configuration
+# 留空则关闭访问日志
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH", "data/logs/access.log")
+ACCESS_LOG_MAX_BYTES = int(os.getenv("ACCESS_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+ACCESS_LOG_BACKUP_COUNT = int(os.getenv("ACCESS_LOG_BACKUP_COUNT", "10"))
+# 设置后按时间轮转 (如 midnight、H)，否则按文件大小轮转
+ACCESS_LOG_ROTATE_WHEN = os.getenv("ACCESS_LOG_ROTATE_WHEN", "")
+
+# Request Analytics Configuration
+# 逐请求定长二进制记录的段文件目录，留空则关闭
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "data/analytics")
+ANALYTICS_SEGMENT_MAX_BYTES = int(os.getenv("ANALYTICS_SEGMENT_MAX_BYTES", str(16 * 1024 * 1024)))
+# 段文件最长写入时间（秒），按时间切段便于按时间窗口跳过与清理
+ANALYTICS_SEGMENT_MAX_SECONDS = float(os.getenv("ANALYTICS_SEGMENT_MAX_SECONDS", "3600"))
+# 段文件保留天数，0 表示永久保留
+ANALYTICS_RETENTION_DAYS = float(os.getenv("ANALYTICS_RETENTION_DAYS", "14"))
+
+# Diagnostics Configuration
+SLOW_REQUEST_WINDOW = int(os.getenv("SLOW_REQUEST_WINDOW", "1000"))
+# 事件循环心跳间隔（秒）
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# 事件循环阻塞超过该时间（毫秒）时记录调用栈与进行中的请求，0 表示关闭
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200"))
+# 保留的最近阻塞记录数
+LOOP_STALL_WINDOW = int(os.getenv("LOOP_STALL_WINDOW", "20"))
+# 采样分析单次最长持续时间（秒）
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
@@ -1,4 +1,6 @@
 """
 Database module for Qwen Code API Server
 """
-from .token_db import TokenDatabase
\ No newline at end of file
+from .token_db import TokenDatabase
+from .usage_buffer import UsageBuffer
+from .lease_store import LeaseBackend, MemoryLeaseBackend, SQLiteLeaseBackend, create_lease_backend
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+Lease backends for sharing the token pool between proxy nodes
+"""
+import abc
+import time
+import sqlite3
+import asyncio
+import secrets
+import threading
+from typing import Dict, Tuple, Optional
+
+from ..config import DATABASE_URL, SQLITE_BUSY_TIMEOUT
+
+
+# 每个资源（Token 并发名额或刷新锁）同时最多存在 slots 个未过期租约
+class LeaseBackend(abc.ABC):
+
+    @abc.abstractmethod
+    async def acquire(self, resource: str, holder: str, slots: int, ttl: float) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    async def renew_holder(self, holder: str, ttl: float) -> int:
+        ...
+
+    @abc.abstractmethod
+    async def release(self, lease_id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def count(self, resource: str) -> int:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryLeaseBackend(LeaseBackend):
+
+    def __init__(self):
+        self._leases: Dict[str, Tuple[str, str, float]] = {}
+
+    def _expire(self, now: float) -> None:
+        for lease_id in [lease_id for lease_id, (_, _, expires_at) in self._leases.items() if expires_at <= now]:
+            del self._leases[lease_id]
+
+    async def acquire(self, resource: str, holder: str, slots: int, ttl: float) -> Optional[str]:
+        now = time.time()
+        self._expire(now)
+        if sum(1 for leased, _, _ in self._leases.values() if leased == resource) >= slots:
+            return None
+        lease_id = secrets.token_hex(8)
+        self._leases[lease_id] = (resource, holder, now + ttl)
+        return lease_id
+
+    async def renew_holder(self, holder: str, ttl: float) -> int:
+        expires_at = time.time() + ttl
+        renewed = 0
+        for lease_id, (resource, leased_by, _) in list(self._leases.items()):
+            if leased_by == holder:
+                self._leases[lease_id] = (resource, leased_by, expires_at)
+                renewed += 1
+        return renewed
+
+    async def release(self, lease_id: str) -> None:
+        self._leases.pop(lease_id, None)
+
+    async def count(self, resource: str) -> int:
+        self._expire(time.time())
+        return sum(1 for leased, _, _ in self._leases.values() if leased == resource)
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+
+    def __init__(self, db_path: str = DATABASE_URL):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        # 各操作在线程池中执行，共用一个连接时需要串行
+        self._lock = threading.Lock()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS token_leases (
+                    lease_id TEXT PRIMARY KEY,
+                    resource TEXT NOT NULL,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_token_leases_resource ON token_leases (resource)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # 多个节点共享同一个数据库文件，写锁竞争时等待而不是立即报错；等待发生在线程池里，不阻塞事件循环
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+        return self._conn
+
+    def _acquire(self, resource: str, holder: str, slots: int, ttl: float) -> Optional[str]:
+        now = time.time()
+        lease_id = secrets.token_hex(8)
+        with self._lock:
+            conn = self._connection()
+            try:
+                # IMMEDIATE 事务在计数前就拿到写锁，保证多节点下名额不会超发
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM token_leases WHERE resource = ? AND expires_at <= ?', (resource, now))
+                (active,) = conn.execute('SELECT COUNT(*) FROM token_leases WHERE resource = ?', (resource,)).fetchone()
+                if active >= slots:
+                    conn.execute('COMMIT')
+                    return None
+                conn.execute(
+                    'INSERT INTO token_leases (lease_id, resource, holder, expires_at) VALUES (?, ?, ?, ?)',
+                    (lease_id, resource, holder, now + ttl)
+                )
+                conn.execute('COMMIT')
+                return lease_id
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+
+    def _execute(self, sql: str, parameters: Tuple) -> int:
+        with self._lock:
+            return self._connection().execute(sql, parameters).rowcount
+
+    def _count(self, resource: str) -> int:
+        with self._lock:
+            (active,) = self._connection().execute(
+                'SELECT COUNT(*) FROM token_leases WHERE resource = ? AND expires_at > ?', (resource, time.time())
+            ).fetchone()
+            return active
+
+    async def acquire(self, resource: str, holder: str, slots: int, ttl: float) -> Optional[str]:
+        return await asyncio.to_thread(self._acquire, resource, holder, slots, ttl)
+
+    async def renew_holder(self, holder: str, ttl: float) -> int:
+        return await asyncio.to_thread(
+            self._execute, 'UPDATE token_leases SET expires_at = ? WHERE holder = ?', (time.time() + ttl, holder)
+        )
+
+    async def release(self, lease_id: str) -> None:
+        await asyncio.to_thread(self._execute, 'DELETE FROM token_leases WHERE lease_id = ?', (lease_id,))
+
+    async def count(self, resource: str) -> int:
+        return await asyncio.to_thread(self._count, resource)
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+
+
+def create_lease_backend(name: str, db_path: str = DATABASE_URL) -> LeaseBackend:
+    if name == 'sqlite':
+        return SQLiteLeaseBackend(db_path)
+    if name == 'memory':
+        return MemoryLeaseBackend()
+    raise ValueError(f"Unknown lease backend: {name}")
@@ -3,28 +3,73 @@ Database management for Qwen Code API Server
 """
 import sqlite3
 import time
-from typing import Dict
+from typing import Dict, List, Tuple, Iterator, Optional
 from ..models import TokenData
 import os
-from ..config import DATABASE_URL, DATABASE_TABLE_NAME
+from ..config import DATABASE_URL, DATABASE_TABLE_NAME, SQLITE_JOURNAL_MODE, SQLITE_BUSY_TIMEOUT
+from ..utils.timezone_utils import local_bucket_start, local_day_range, local_bucket_date
+
+TOKEN_COLUMNS = "id, access_token, refresh_token, expires_at, uploaded_at, usage_count, updated_at"
+# 删除记录保留时间（毫秒），供增量查询返回被删除的 Token
+TOMBSTONE_RETENTION_MS = 7 * 24 * 3600 * 1000
+SERIES_RESOLUTIONS = ('minute', 'hour', 'day')
+SERIES_GROUP_COLUMNS = {'model': 'model_name', 'token': 'token_id', 'client': 'client_key'}
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _row_to_token(row) -> Tuple[str, TokenData]:
+    token_id, access_token, refresh_token, expires_at, uploaded_at, usage_count, updated_at = row
+    return token_id, TokenData(
+        access_token=access_token,
+        refresh_token=refresh_token,
+        expires_at=expires_at,
+        uploaded_at=uploaded_at,
+        usage_count=usage_count,
+        updated_at=updated_at
+    )
+
 
 class TokenDatabase:
     
+    # 同一进程内每个数据库文件只建表/迁移一次
+    _initialized_paths = set()
+    
     def __init__(self, db_path: str = DATABASE_URL):
         self.db_path = db_path
-        self._ensure_directory_exists()
-        self.init_db()
-        self._migrate_db()
+        db_key = os.path.abspath(db_path)
+        if db_key not in TokenDatabase._initialized_paths:
+            self._ensure_directory_exists()
+            self._set_journal_mode()
+            self.init_db()
+            self._migrate_db()
+            TokenDatabase._initialized_paths.add(db_key)
         self._cache = {}
         self._cache_ttl = 60
+        self._read_signatures = {}
     
+    def _connect(self) -> sqlite3.Connection:
+        # 多个工作进程共享数据库文件，写锁竞争时等待而不是立即报错
+        return sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT)
+
+    def _set_journal_mode(self):
+        # 日志模式持久化在数据库文件里，每个进程启动时设置一次即可
+        if SQLITE_JOURNAL_MODE:
+            conn = self._connect()
+            try:
+                conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            finally:
+                conn.close()
+
     def _ensure_directory_exists(self):
         db_dir = os.path.dirname(os.path.abspath(self.db_path))
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
 
     def _migrate_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='token_usage_stats'")
             if cursor.fetchone():
@@ -33,6 +78,21 @@ class TokenDatabase:
                 if 'call_count' not in columns:
                     cursor.execute("ALTER TABLE token_usage_stats ADD COLUMN call_count INTEGER DEFAULT 0")
             
+            # 时间序列为空时把已有的按日用量写入天粒度汇总，可用日期和面板统计都只读 usage_series
+            cursor.execute('SELECT 1 FROM usage_series LIMIT 1')
+            if not cursor.fetchone():
+                cursor.execute('SELECT date, model_name, total_tokens, call_count FROM token_usage_stats')
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO usage_series (resolution, bucket, model_name, total_tokens, call_count)
+                    VALUES ('day', ?, ?, ?, ?)
+                ''', [(local_day_range(day)[0], model_name, tokens or 0, calls or 0)
+                      for day, model_name, tokens, calls in cursor.fetchall()])
+            
+            cursor.execute(f"PRAGMA table_info({DATABASE_TABLE_NAME})")
+            if 'updated_at' not in [info[1] for info in cursor.fetchall()]:
+                cursor.execute(f"ALTER TABLE {DATABASE_TABLE_NAME} ADD COLUMN updated_at INTEGER")
+                cursor.execute(f"UPDATE {DATABASE_TABLE_NAME} SET updated_at = COALESCE(uploaded_at, 0)")
+            
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='app_versions'")
             if not cursor.fetchone():
                 cursor.execute('''
@@ -45,7 +105,7 @@ class TokenDatabase:
             conn.commit()
 
     def init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS {DATABASE_TABLE_NAME} (
@@ -54,7 +114,14 @@ class TokenDatabase:
                     refresh_token TEXT NOT NULL,
                     expires_at INTEGER,
                     uploaded_at INTEGER,
-                    usage_count INTEGER NOT NULL DEFAULT 0
+                    usage_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at INTEGER
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS token_tombstones (
+                    id TEXT PRIMARY KEY,
+                    deleted_at INTEGER NOT NULL
                 )
             ''')
             cursor.execute('''
@@ -73,37 +140,110 @@ class TokenDatabase:
                     updated_at INTEGER NOT NULL
                 )
             ''')
+            # 主键以 (粒度, 桶起始时间) 开头，任意时间窗口的查询都是一次索引范围扫描
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_series (
+                    resolution TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    model_name TEXT NOT NULL,
+                    token_id TEXT NOT NULL DEFAULT '',
+                    client_key TEXT NOT NULL DEFAULT '',
+                    total_tokens INTEGER NOT NULL DEFAULT 0,
+                    call_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (resolution, bucket, model_name, token_id, client_key)
+                ) WITHOUT ROWID
+            ''')
             conn.commit()
     
     def _get_cache_key(self, method: str, *args) -> str:
         return f"{method}:{':'.join(str(arg) for arg in args)}"
     
+    def _file_signature(self) -> Tuple:
+        # 其他进程写入后数据库或 WAL 文件的修改时间与大小会变化，据此让本进程的缓存失效
+        signature = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+    
     def _get_cached_result(self, key: str):
+        signature = self._file_signature()
         if key in self._cache:
             cached = self._cache[key]
-            if time.time() - cached['timestamp'] < self._cache_ttl:
+            if time.time() - cached['timestamp'] < self._cache_ttl and cached['signature'] == signature:
                 return cached['data']
             del self._cache[key]
+        # 记录读取前的文件状态，读取期间其他进程的写入会让下次查询重新加载
+        self._read_signatures[key] = signature
         return None
     
     def _cache_result(self, key: str, result):
-        self._cache[key] = {'data': result, 'timestamp': time.time()}
+        signature = self._read_signatures.pop(key, None) or self._file_signature()
+        self._cache[key] = {'data': result, 'timestamp': time.time(), 'signature': signature}
     
     def _invalidate_cache(self):
         self._cache.clear()
 
     def save_token(self, token_id: str, token_data: TokenData) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        token_data.updated_at = _now_ms()
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f'''
                 INSERT OR REPLACE INTO {DATABASE_TABLE_NAME} 
-                (id, access_token, refresh_token, expires_at, uploaded_at, usage_count)
-                VALUES (?, ?, ?, ?, ?, ?)
+                (id, access_token, refresh_token, expires_at, uploaded_at, usage_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (token_id, token_data.access_token, token_data.refresh_token, 
-                  token_data.expires_at, token_data.uploaded_at, token_data.usage_count))
+                  token_data.expires_at, token_data.uploaded_at, token_data.usage_count, token_data.updated_at))
+            cursor.execute('DELETE FROM token_tombstones WHERE id = ?', (token_id,))
             conn.commit()
         self._invalidate_cache()
 
+    def save_tokens(self, tokens: Dict[str, TokenData]) -> None:
+        now = _now_ms()
+        for token_data in tokens.values():
+            token_data.updated_at = now
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(f'''
+                INSERT OR REPLACE INTO {DATABASE_TABLE_NAME} 
+                (id, access_token, refresh_token, expires_at, uploaded_at, usage_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(token_id, token_data.access_token, token_data.refresh_token,
+                   token_data.expires_at, token_data.uploaded_at, token_data.usage_count, now)
+                  for token_id, token_data in tokens.items()])
+            cursor.executemany('DELETE FROM token_tombstones WHERE id = ?', [(token_id,) for token_id in tokens])
+            conn.commit()
+        self._invalidate_cache()
+
+    def iter_tokens(self, batch_size: int = 500) -> Iterator[Tuple[str, TokenData]]:
+        # 按主键分页读取，每页独立连接，生成器可以跨线程/跨 await 使用
+        last_id = ''
+        while True:
+            with self._connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT {TOKEN_COLUMNS}
+                    FROM {DATABASE_TABLE_NAME} WHERE id > ? ORDER BY id LIMIT ?
+                ''', (last_id, batch_size))
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield _row_to_token(row)
+            last_id = rows[-1][0]
+
+    def get_token(self, token_id: str) -> Optional[TokenData]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {TOKEN_COLUMNS} FROM {DATABASE_TABLE_NAME} WHERE id = ?', (token_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return _row_to_token(row)[1]
+
     def load_all_tokens(self) -> Dict[str, TokenData]:
         cache_key = self._get_cache_key("load_all_tokens")
         cached = self._get_cached_result(cache_key)
@@ -111,38 +251,66 @@ class TokenDatabase:
             return cached
         
         tokens = {}
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(f'SELECT * FROM {DATABASE_TABLE_NAME}')
+            cursor.execute(f'SELECT {TOKEN_COLUMNS} FROM {DATABASE_TABLE_NAME}')
             for row in cursor.fetchall():
-                token_id, access_token, refresh_token, expires_at, uploaded_at, usage_count = row
-                tokens[token_id] = TokenData(
-                    access_token=access_token,
-                    refresh_token=refresh_token,
-                    expires_at=expires_at,
-                    uploaded_at=uploaded_at,
-                    usage_count=usage_count
-                )
+                token_id, token = _row_to_token(row)
+                tokens[token_id] = token
         
         self._cache_result(cache_key, tokens)
         return tokens
 
+    def _record_tombstones(self, cursor: sqlite3.Cursor, token_ids: List[str]) -> None:
+        now = _now_ms()
+        cursor.executemany('INSERT OR REPLACE INTO token_tombstones (id, deleted_at) VALUES (?, ?)',
+                           [(token_id, now) for token_id in token_ids])
+        cursor.execute('DELETE FROM token_tombstones WHERE deleted_at < ?', (now - TOMBSTONE_RETENTION_MS,))
+
     def delete_token(self, token_id: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        self.delete_tokens([token_id])
+
+    def delete_tokens(self, token_ids: List[str]) -> None:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(f'DELETE FROM {DATABASE_TABLE_NAME} WHERE id = ?', (token_id,))
+            cursor.executemany(f'DELETE FROM {DATABASE_TABLE_NAME} WHERE id = ?', [(token_id,) for token_id in token_ids])
+            self._record_tombstones(cursor, token_ids)
             conn.commit()
         self._invalidate_cache()
 
     def delete_all_tokens(self) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            cursor.execute(f'SELECT id FROM {DATABASE_TABLE_NAME}')
+            self._record_tombstones(cursor, [row[0] for row in cursor.fetchall()])
             cursor.execute(f'DELETE FROM {DATABASE_TABLE_NAME}')
             conn.commit()
         self._invalidate_cache()
 
+    def get_token_version(self) -> Tuple[int, int, int, int, int]:
+        # 不加载 Token 即可判断列表是否变化：数量、最近更新/删除时间、已过期数量（随时间变化）以及用量总数
+        # 用量落盘不更新 updated_at，由用量总数单独反映，增量查询不会因此返回所有被使用过的 Token
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT COUNT(*), COALESCE(MAX(updated_at), 0),
+                       SUM(CASE WHEN expires_at IS NOT NULL AND expires_at < ? THEN 1 ELSE 0 END),
+                       COALESCE(SUM(usage_count), 0)
+                FROM {DATABASE_TABLE_NAME}
+            ''', (_now_ms(),))
+            count, last_updated, expired, usage = cursor.fetchone()
+            cursor.execute('SELECT COALESCE(MAX(deleted_at), 0) FROM token_tombstones')
+            (last_deleted,) = cursor.fetchone()
+        return count, last_updated, last_deleted, expired or 0, usage
+
+    def get_deleted_token_ids(self, since: int) -> List[str]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id FROM token_tombstones WHERE deleted_at > ? ORDER BY deleted_at', (since,))
+            return [row[0] for row in cursor.fetchall()]
+
     def update_token_usage(self, date: str, model_name: str, tokens: int):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO token_usage_stats (date, model_name, total_tokens, call_count)
@@ -154,13 +322,80 @@ class TokenDatabase:
             conn.commit()
         self._invalidate_cache()
 
+    def apply_usage_batch(self, model_usage: Dict[Tuple[str, str], Tuple[int, int]], token_calls: Dict[str, int],
+                          series: Optional[Dict[Tuple[int, str, str, str], Tuple[int, int]]] = None) -> None:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            if series:
+                self._write_usage_series(cursor, series)
+            cursor.executemany('''
+                INSERT INTO token_usage_stats (date, model_name, total_tokens, call_count)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(date, model_name) DO UPDATE SET 
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    call_count = call_count + excluded.call_count
+            ''', [(date, model_name, tokens, calls) for (date, model_name), (tokens, calls) in model_usage.items()])
+            # 用量计数不改变 Token 状态，不更新 updated_at，避免每次落盘都让增量查询返回所有被使用过的 Token；ETag 由用量总数感知变化
+            cursor.executemany(f"UPDATE {DATABASE_TABLE_NAME} SET usage_count = usage_count + ? WHERE id = ?",
+                               [(calls, token_id) for token_id, calls in token_calls.items()])
+            conn.commit()
+        self._invalidate_cache()
+
+    def _write_usage_series(self, cursor: sqlite3.Cursor, series: Dict[Tuple[int, str, str, str], Tuple[int, int]]) -> None:
+        # 写入时同时汇总到小时与天粒度，查询长时间窗口不需要再扫描分钟数据
+        rollup: Dict[Tuple[str, int, str, str, str], List[int]] = {}
+        buckets: Dict[Tuple[int, str], int] = {}
+        for (minute, model_name, token_id, client_key), (tokens, calls) in series.items():
+            for resolution in SERIES_RESOLUTIONS:
+                if (minute, resolution) not in buckets:
+                    buckets[(minute, resolution)] = local_bucket_start(minute, resolution)
+                totals = rollup.setdefault((resolution, buckets[(minute, resolution)], model_name, token_id, client_key), [0, 0])
+                totals[0] += tokens
+                totals[1] += calls
+        cursor.executemany('''
+            INSERT INTO usage_series (resolution, bucket, model_name, token_id, client_key, total_tokens, call_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(resolution, bucket, model_name, token_id, client_key) DO UPDATE SET
+                total_tokens = total_tokens + excluded.total_tokens,
+                call_count = call_count + excluded.call_count
+        ''', [key + (tokens, calls) for key, (tokens, calls) in rollup.items()])
+
+    def query_usage_series(self, resolution: str, start: int, end: int, group_by: List[str],
+                           filters: Dict[str, str]) -> List[Tuple]:
+        columns = [SERIES_GROUP_COLUMNS[group] for group in group_by]
+        where = ['resolution = ?', 'bucket >= ?', 'bucket < ?']
+        params: List = [resolution, start, end]
+        for group, value in filters.items():
+            where.append(f"{SERIES_GROUP_COLUMNS[group]} = ?")
+            params.append(value)
+        select = ', '.join(['bucket'] + columns)
+        
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {select}, SUM(total_tokens), SUM(call_count) FROM usage_series
+                WHERE {' AND '.join(where)}
+                GROUP BY {select} ORDER BY bucket
+            ''', params)
+            return cursor.fetchall()
+
+    def prune_usage_series(self, cutoffs: Dict[str, int]) -> int:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            deleted = 0
+            for resolution, cutoff in cutoffs.items():
+                cursor.execute('DELETE FROM usage_series WHERE resolution = ? AND bucket < ?', (resolution, cutoff))
+                deleted += cursor.rowcount
+            conn.commit()
+        return deleted
+
     def get_usage_stats(self, date: str) -> Dict:
         cache_key = self._get_cache_key("get_usage_stats", date)
         cached = self._get_cached_result(cache_key)
         if cached:
             return cached
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM token_usage_stats WHERE date = ?', (date,))
             rows = cursor.fetchall()
@@ -180,16 +415,20 @@ class TokenDatabase:
             return result
 
     def delete_usage_stats(self, date: str) -> int:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM token_usage_stats WHERE date = ?', (date,))
             deleted_count = cursor.rowcount
+            # 同一天的各粒度时间序列一并删除，面板与可用日期都从时间序列读取
+            start, end = local_day_range(date)
+            cursor.executemany('DELETE FROM usage_series WHERE resolution = ? AND bucket >= ? AND bucket < ?',
+                               [(resolution, start, end) for resolution in SERIES_RESOLUTIONS])
             conn.commit()
         self._invalidate_cache()
         return deleted_count
 
     def increment_token_usage_count(self, token_id: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f"UPDATE {DATABASE_TABLE_NAME} SET usage_count = usage_count + 1 WHERE id = ?", (token_id,))
             conn.commit()
@@ -200,16 +439,17 @@ class TokenDatabase:
         if cached:
             return cached
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT DISTINCT date FROM token_usage_stats ORDER BY date DESC')
-            dates = [row[0] for row in cursor.fetchall()]
+            # 天粒度汇总的每个桶就是一个有用量的日期，按主键顺序扫描，不必遍历明细
+            cursor.execute("SELECT DISTINCT bucket FROM usage_series WHERE resolution = 'day' ORDER BY bucket DESC")
+            dates = [local_bucket_date(row[0]) for row in cursor.fetchall()]
             
             self._cache_result(cache_key, dates)
             return dates
 
     def save_app_version(self, version: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT OR REPLACE INTO app_versions (key, version, updated_at)
@@ -224,7 +464,7 @@ class TokenDatabase:
         if cached:
             return cached
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT version FROM app_versions WHERE key = ?', ('qwen_code',))
             row = cursor.fetchone()
@@ -0,0 +1,114 @@
+"""
+Write-behind buffer for usage counters
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, Tuple, Optional
+
+from .token_db import TokenDatabase
+from ..config import (
+    USAGE_FLUSH_INTERVAL,
+    USAGE_SERIES_MINUTE_RETENTION_HOURS,
+    USAGE_SERIES_HOUR_RETENTION_DAYS,
+    USAGE_SERIES_DAY_RETENTION_DAYS,
+    IS_PRIMARY_WORKER
+)
+from ..utils.event_bus import event_bus, DASHBOARD_TOPIC
+
+logger = logging.getLogger(__name__)
+
+# 过期时间序列的清理间隔（秒）
+SERIES_PRUNE_INTERVAL = 3600
+SERIES_RETENTION_SECONDS = {
+    'minute': USAGE_SERIES_MINUTE_RETENTION_HOURS * 3600,
+    'hour': USAGE_SERIES_HOUR_RETENTION_DAYS * 86400,
+    'day': USAGE_SERIES_DAY_RETENTION_DAYS * 86400
+}
+
+
+class UsageBuffer:
+
+    def __init__(self, db: TokenDatabase, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._model_usage: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self._token_calls: Dict[str, int] = {}
+        self._series: Dict[Tuple[int, str, str, str], Tuple[int, int]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+    def record(self, date: str, model_name: str, tokens: int, token_id: Optional[str] = None,
+               client_key: Optional[str] = None) -> None:
+        key = (date, model_name)
+        total_tokens, call_count = self._model_usage.get(key, (0, 0))
+        self._model_usage[key] = (total_tokens + tokens, call_count + 1)
+        series_key = (int(time.time() // 60 * 60), model_name, token_id or '', client_key or '')
+        total_tokens, call_count = self._series.get(series_key, (0, 0))
+        self._series[series_key] = (total_tokens + tokens, call_count + 1)
+        if token_id:
+            self._token_calls[token_id] = self._token_calls.get(token_id, 0) + 1
+        # 面板直接累加增量，无需等待落盘后重新查询
+        event_bus.publish(DASHBOARD_TOPIC, 'usage', {
+            'date': date, 'model': model_name, 'tokens': tokens, 'calls': 1, 'tokenId': token_id
+        })
+
+    @property
+    def pending(self) -> int:
+        return sum(calls for _, calls in self._model_usage.values())
+
+    def flush(self) -> None:
+        if not self._model_usage and not self._token_calls and not self._series:
+            return
+
+        model_usage, self._model_usage = self._model_usage, {}
+        token_calls, self._token_calls = self._token_calls, {}
+        series, self._series = self._series, {}
+        try:
+            self.db.apply_usage_batch(model_usage, token_calls, series)
+        except Exception as e:
+            # 写入失败时合并回缓冲区，等待下次重试
+            logger.error(f"用量统计写入失败: {e}")
+            for key, (tokens, calls) in model_usage.items():
+                total_tokens, call_count = self._model_usage.get(key, (0, 0))
+                self._model_usage[key] = (total_tokens + tokens, call_count + calls)
+            for token_id, calls in token_calls.items():
+                self._token_calls[token_id] = self._token_calls.get(token_id, 0) + calls
+            for key, (tokens, calls) in series.items():
+                total_tokens, call_count = self._series.get(key, (0, 0))
+                self._series[key] = (total_tokens + tokens, call_count + calls)
+
+    def prune(self) -> None:
+        now = time.time()
+        cutoffs = {resolution: int(now - seconds) for resolution, seconds in SERIES_RETENTION_SECONDS.items() if seconds > 0}
+        if not cutoffs:
+            return
+        try:
+            deleted = self.db.prune_usage_series(cutoffs)
+            if deleted:
+                logger.info(f"已清理过期用量时间序列 {deleted} 条")
+        except Exception as e:
+            logger.error(f"用量时间序列清理失败: {e}")
+
+    def start(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            # 多进程时只由主进程清理，避免重复执行同样的删除
+            if IS_PRIMARY_WORKER and time.monotonic() - self._pruned_at >= SERIES_PRUNE_INTERVAL:
+                self._pruned_at = time.monotonic()
+                self.prune()
+
+    async def stop(self) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        self.flush()
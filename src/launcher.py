@@ -0,0 +1,176 @@
+"""
+Multi-process launcher for Qwen Code API Server
+"""
+import os
+import sys
+import math
+import time
+import signal
+import socket
+import logging
+import importlib.util
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Dict, Optional
+
+import uvicorn
+
+from .config.settings import HOST, PORT, WORKERS, LOG_LEVEL, DRAIN_TIMEOUT
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+APP = "src.main:app"
+# 已安装时使用 uvloop 事件循环与 httptools 解析器，否则回退到标准库 asyncio 与 h11
+LOOP = "uvloop" if sys.platform != "win32" and importlib.util.find_spec("uvloop") else "asyncio"
+HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
+# 只有 Linux 的 SO_REUSEPORT 会在多个监听套接字之间按连接做负载均衡
+REUSE_PORT = sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+# 启动后很快退出的工作进程延迟重启，避免配置错误时反复拉起
+MIN_UPTIME = 5.0
+RESTART_BACKOFF = 1.0
+# 收到停止信号后等待工作进程排空请求的额外时间（秒）
+SHUTDOWN_GRACE = 10.0
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    # 容器的 --cpus 限制体现在 cgroup 配额上，os.cpu_count() 看到的是宿主机核数
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cores() -> int:
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota:
+        cores = min(cores, math.ceil(quota))
+    return max(1, cores)
+
+
+def resolve_workers(requested: int) -> int:
+    cores = available_cores()
+    if requested <= 0:
+        return cores
+    if requested > cores:
+        logger.warning(f"工作进程数 {requested} 超过可用 CPU 核数 {cores}，进程之间会争抢 CPU")
+    return requested
+
+
+def bind_socket(reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in HOST else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, PORT))
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: Optional[socket.socket]) -> None:
+    # 脱离启动器的进程组，终端 Ctrl+C 只发给启动器，由它统一转发一次停止信号
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    if sock is None:
+        sock = bind_socket(reuse_port=True)
+    # 收到停止信号后 lifespan 立即开始排空，超过 DRAIN_TIMEOUT 仍未结束的连接由 uvicorn 取消
+    config = uvicorn.Config(APP, loop=LOOP, http=HTTP, log_level=LOG_LEVEL, timeout_graceful_shutdown=DRAIN_TIMEOUT)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+
+    def __init__(self, workers: int, sock: Optional[socket.socket]):
+        self.workers = workers
+        self.sock = sock
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+        self._started_at: Dict[int, float] = {}
+        self._stopping = False
+
+    def _spawn(self, worker_id: int) -> None:
+        # 配置在模块导入时读取，spawn 出的子进程继承此刻的环境变量
+        os.environ.update(WORKERS=str(self.workers), WORKER_ID=str(worker_id))
+        process = self._context.Process(target=run_worker, args=(self.sock,), name=f"qwen-worker-{worker_id}")
+        process.start()
+        self._processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+
+    def _handle_signal(self, signum, frame) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        while not self._stopping:
+            wait([process.sentinel for process in self._processes.values()], timeout=1)
+            for worker_id, process in list(self._processes.items()):
+                if process.is_alive() or self._stopping:
+                    continue
+                logger.warning(f"工作进程 {worker_id} (pid {process.pid}) 已退出，退出码 {process.exitcode}，正在重启")
+                if time.monotonic() - self._started_at[worker_id] < MIN_UPTIME:
+                    time.sleep(RESTART_BACKOFF)
+                self._spawn(worker_id)
+
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        # 每个工作进程收到 SIGTERM 后按 lifespan 排空进行中的请求、落盘用量再退出
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + DRAIN_TIMEOUT + SHUTDOWN_GRACE
+        for worker_id, process in self._processes.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"工作进程 {worker_id} 未在限定时间内退出，强制结束")
+                process.kill()
+                process.join()
+        if self.sock:
+            self.sock.close()
+        logger.info("所有工作进程已退出")
+
+
+def main() -> None:
+    workers = resolve_workers(WORKERS)
+    reuse_port = REUSE_PORT and workers > 1
+    if reuse_port:
+        # 每个工作进程各自绑定监听套接字，由内核分发连接；这里先试绑一次，端口被占用时尽早报错
+        bind_socket(reuse_port=True).close()
+        sock = None
+    else:
+        sock = bind_socket(reuse_port=False)
+
+    if workers > 1:
+        logger.warning("多进程模式下 OAuth 登录状态和面板实时事件只在各进程内有效，通过面板登录或查看实时数据时请使用 WORKERS=1")
+    logger.info(
+        f"启动 {workers} 个工作进程 (可用 CPU 核数 {available_cores()})，监听 {HOST}:{PORT}，"
+        f"事件循环: {LOOP}，HTTP 解析: {HTTP}，端口共享: {'SO_REUSEPORT' if reuse_port else '共享监听套接字'}"
+    )
+    Supervisor(workers, sock).run()
+
+
+if __name__ == "__main__":
+    main()
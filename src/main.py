@@ -1,6 +1,9 @@
+import time
+
+_boot_started = time.perf_counter()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
 import asyncio
@@ -9,10 +12,25 @@ from contextlib import asynccontextmanager
 
 from src.config.settings import PORT, HOST, DEBUG
 from src.api import api_router, openai_router
-from src.web import web_router
-from src.oauth import TokenManager
-from src.database import TokenDatabase
+from src.web import web_router, preload_static_assets
+from src.api.routes import (
+    db as _db,
+    token_manager as _token_manager,
+    batch_manager as _batch_manager,
+    oauth_manager as _oauth_manager,
+    usage_buffer as _usage_buffer,
+    close_session,
+    set_version_manager,
+    get_encoding,
+    warmup_upstream,
+    startup_timings
+)
 from src.utils.version_manager import initialize_version_manager, get_version_manager
+from src.utils.lifecycle import drain_controller, drain_on_signal, DrainMiddleware
+from src.utils.access_log import access_log
+from src.utils.request_analytics import request_analytics
+from src.utils.loop_monitor import loop_monitor
+from src.config.settings import DRAIN_TIMEOUT, IS_PRIMARY_WORKER, HTML_TEMPLATE_PATH
 from src.config.settings import os
 
 # 设置日志
@@ -20,32 +38,57 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 全局变量
-_db = TokenDatabase()
-_token_manager = TokenManager(_db)
 _refresh_task = None
+_warmup_task = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     initialize_version_manager(_db)
     version_manager = get_version_manager()
-    
-    from src.api.routes import set_version_manager
     set_version_manager(version_manager)
     
-    try:
-        initial_version = await version_manager.get_version()
-        logger.info(f"QwenCode版本初始化完成: {initial_version}")
-    except Exception as e:
-        logger.warning(f"版本号获取失败: {e}")
+    # 先使用持久化的版本号和Token开始服务，网络相关的初始化放到后台
+    initial_version = version_manager.load_persisted_version()
+    logger.info(f"QwenCode版本(本地): {initial_version}")
     
     _token_manager.load_tokens()
     
-    global _refresh_task
-    _refresh_task = asyncio.create_task(auto_refresh_tokens())
-    logger.info("自动Token刷新任务已启动，每4小时执行一次")
+    global _refresh_task, _warmup_task
+    # 多进程时定时刷新与批处理恢复只在主进程执行，避免重复刷新和重复处理
+    if IS_PRIMARY_WORKER:
+        _refresh_task = asyncio.create_task(auto_refresh_tokens())
+        logger.info("自动Token刷新任务已启动，每4小时执行一次")
+        _batch_manager.resume_pending()
+    _warmup_task = asyncio.create_task(background_warmup())
+    _usage_buffer.start()
+    _token_manager.leases.start()
+    access_log.start()
+    request_analytics.start()
+    loop_monitor.start()
+    drain_on_signal(drain_controller)
+    
+    startup_timings['coldStartMs'] = round((time.perf_counter() - _boot_started) * 1000, 2)
+    logger.info(f"服务启动完成，耗时 {startup_timings['coldStartMs']} ms")
     
     yield
     
+    # 通常收到信号时已进入排空，这里兜底其他关闭方式；等待不超过从排空开始计算的 DRAIN_TIMEOUT，随后落盘用量并关闭连接
+    drain_controller.start()
+    await _batch_manager.shutdown()
+    await drain_controller.wait_for_idle(DRAIN_TIMEOUT)
+    await _usage_buffer.stop()
+    await _token_manager.leases.stop()
+    access_log.stop()
+    request_analytics.stop()
+    await loop_monitor.stop()
+    
+    if _warmup_task and not _warmup_task.done():
+        _warmup_task.cancel()
+    
+    await close_session()
+    await _oauth_manager.close()
+    await _token_manager.close()
+    
     if _refresh_task:
         _refresh_task.cancel()
         try:
@@ -54,6 +97,35 @@ async def lifespan(app: FastAPI):
             pass
         logger.info("自动Token刷新任务已停止")
 
+async def background_warmup():
+    warmup_started = time.perf_counter()
+    
+    async def refresh_version():
+        version = await get_version_manager().refresh_version()
+        logger.info(f"QwenCode版本初始化完成: {version}")
+    
+    async def load_encoding():
+        await asyncio.to_thread(get_encoding)
+        logger.info("tiktoken编码已加载")
+    
+    async def compress_assets():
+        count = await preload_static_assets(HTML_TEMPLATE_PATH)
+        logger.info(f"静态资源已压缩: {count} 个")
+    
+    results = await asyncio.gather(
+        refresh_version(),
+        load_encoding(),
+        warmup_upstream(),
+        compress_assets(),
+        return_exceptions=True
+    )
+    for name, result in zip(('版本号获取', 'tiktoken加载', '上游连接预热', '静态资源压缩'), results):
+        if isinstance(result, Exception):
+            logger.warning(f"{name}失败: {result}")
+    
+    startup_timings['warmupMs'] = round((time.perf_counter() - warmup_started) * 1000, 2)
+    logger.info(f"后台预热完成，耗时 {startup_timings['warmupMs']} ms")
+
 async def auto_refresh_tokens():
     refresh_interval = int(os.getenv('TOKEN_REFRESH_INTERVAL', '14400'))
     
@@ -88,6 +160,7 @@ async def auto_refresh_tokens():
 
 app = FastAPI(title="Qwen Code API Server", lifespan=lifespan)
 
+app.add_middleware(DrainMiddleware, controller=drain_controller)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -96,13 +169,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-static_path = os.path.join(os.path.dirname(__file__), '..', 'static')
-if os.path.exists(static_path):
-    app.mount("/static", StaticFiles(directory=static_path), name="static")
-
 app.include_router(web_router)
 app.include_router(api_router, prefix="/api")
 app.include_router(openai_router)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host=HOST, port=PORT, reload=DEBUG)
\ No newline at end of file
+    uvicorn.run("main:app", host=HOST, port=PORT, reload=DEBUG, timeout_graceful_shutdown=DRAIN_TIMEOUT)
\ No newline at end of file
@@ -13,6 +13,7 @@ class TokenData:
     expires_at: Optional[int] = field(default_factory=lambda: int(time.time() * 1000) + 3600 * 1000)
     uploaded_at: Optional[int] = field(default_factory=lambda: int(time.time() * 1000))
     usage_count: int = 0
+    updated_at: Optional[int] = None
     
     def to_dict(self) -> Dict[str, Any]:
         return {
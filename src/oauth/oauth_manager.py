@@ -5,9 +5,10 @@ import time
 import aiohttp
 import asyncio
 import logging
-from typing import Dict, Optional, Any
+from typing import Dict, Optional, Any, Callable
 from ..models import OAuthState, TokenData
 from ..utils import generate_state_id, generate_pkce_pair
+from ..utils.event_bus import event_bus
 from ..config import (
     QWEN_OAUTH_DEVICE_CODE_ENDPOINT,
     QWEN_OAUTH_TOKEN_ENDPOINT,
@@ -21,14 +22,29 @@ logger = logging.getLogger(__name__)
 
 class OAuthManager:
     
+    RESULT_TTL = 300
+    MAX_POLL_INTERVAL = 10
+    
     def __init__(self):
         self.oauth_states: Dict[str, OAuthState] = {}
+        self.oauth_results: Dict[str, Dict[str, Any]] = {}
+        self._pollers: Dict[str, asyncio.Task] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
         self._version_manager = None
+        self._token_handler: Optional[Callable[[TokenData], str]] = None
         self.REQUEST_TIMEOUT = 10
     
     def set_version_manager(self, version_manager):
         self._version_manager = version_manager
     
+    def set_token_handler(self, token_handler: Callable[[TokenData], str]):
+        self._token_handler = token_handler
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=8))
+        return self._session
+    
     async def init_oauth(self) -> Dict[str, Any]:
         try:
             return await asyncio.wait_for(
@@ -64,46 +80,112 @@ class OAuthManager:
             except asyncio.TimeoutError:
                 headers['User-Agent'] = 'QwenCode/unknown'
         
-        timeout = aiohttp.ClientTimeout(total=8)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            data = aiohttp.FormData()
-            data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
-            data.add_field('scope', QWEN_OAUTH_SCOPE)
-            data.add_field('code_challenge', code_challenge)
-            data.add_field('code_challenge_method', 'S256')
+        self._evict_expired()
+        session = self._get_session()
+        data = aiohttp.FormData()
+        data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
+        data.add_field('scope', QWEN_OAUTH_SCOPE)
+        data.add_field('code_challenge', code_challenge)
+        data.add_field('code_challenge_method', 'S256')
+        
+        async with session.post(QWEN_OAUTH_DEVICE_CODE_ENDPOINT, data=data, headers=headers) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f'Device authorization failed: {response.status} {response.reason}. Response: {error_text}')
             
-            async with session.post(QWEN_OAUTH_DEVICE_CODE_ENDPOINT, data=data, headers=headers) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f'Device authorization failed: {response.status} {response.statusText}. Response: {error_text}')
-                
-                result = await response.json()
-                
-                if 'error' in result:
-                    raise Exception(f'Device authorization failed: {result["error"]} - {result.get("error_description", "")}')
+            result = await response.json()
+            
+            if 'error' in result:
+                raise Exception(f'Device authorization failed: {result["error"]} - {result.get("error_description", "")}')
+            
+            auth_state = OAuthState(
+                device_code=result['device_code'],
+                user_code=result['user_code'],
+                verification_uri=result['verification_uri'],
+                verification_uri_complete=result['verification_uri_complete'],
+                code_verifier=code_verifier,
+                expires_at=int(time.time() * 1000) + result['expires_in'] * 1000,
+                poll_interval=result.get('interval', 2)
+            )
+            
+            state_id = generate_state_id()
+            self.oauth_states[state_id] = auth_state
+            self._set_result(state_id, 'status', {
+                'success': False,
+                'status': 'pending',
+                'remainingTime': result['expires_in']
+            })
+            self._pollers[state_id] = asyncio.create_task(self._poll_loop(state_id))
+            
+            return {
+                'success': True,
+                'stateId': state_id,
+                'userCode': auth_state.user_code,
+                'verificationUri': auth_state.verification_uri,
+                'verificationUriComplete': auth_state.verification_uri_complete,
+                'expiresAt': auth_state.expires_at,
+                'expiresIn': int((auth_state.expires_at - time.time() * 1000) / 1000)
+            }
+    
+    async def _poll_loop(self, state_id: str) -> None:
+        # 每个设备码只有一个后台轮询任务，按服务端要求的间隔访问上游
+        try:
+            while state_id in self.oauth_states:
+                await asyncio.sleep(self.oauth_states[state_id].poll_interval)
+                if state_id not in self.oauth_states:
+                    break
                 
-                auth_state = OAuthState(
-                    device_code=result['device_code'],
-                    user_code=result['user_code'],
-                    verification_uri=result['verification_uri'],
-                    verification_uri_complete=result['verification_uri_complete'],
-                    code_verifier=code_verifier,
-                    expires_at=int(time.time() * 1000) + result['expires_in'] * 1000,
-                    poll_interval=result.get('interval', 2)
-                )
+                try:
+                    result = await self.poll_oauth_status(state_id)
+                except Exception as error:
+                    self._set_result(state_id, 'error', {
+                        'success': False,
+                        'status': 'error',
+                        'error': str(error)
+                    })
+                    break
                 
-                state_id = generate_state_id()
-                self.oauth_states[state_id] = auth_state
+                if result.get('success'):
+                    token_id = self._token_handler(result['tokenData']) if self._token_handler else None
+                    self._set_result(state_id, 'success', {
+                        'success': True,
+                        'tokenId': token_id,
+                        'message': result['message']
+                    })
+                    break
                 
-                return {
-                    'success': True,
-                    'stateId': state_id,
-                    'userCode': auth_state.user_code,
-                    'verificationUri': auth_state.verification_uri,
-                    'verificationUriComplete': auth_state.verification_uri_complete,
-                    'expiresAt': auth_state.expires_at,
-                    'expiresIn': int((auth_state.expires_at - time.time() * 1000) / 1000)
-                }
+                self._set_result(state_id, 'status', result)
+        except asyncio.CancelledError:
+            pass
+        except Exception as error:
+            logger.error(f"OAuth轮询任务异常: {error}")
+            self.oauth_states.pop(state_id, None)
+            self._set_result(state_id, 'error', {'success': False, 'status': 'error', 'error': str(error)})
+        finally:
+            self._pollers.pop(state_id, None)
+    
+    def _set_result(self, state_id: str, event: str, result: Dict[str, Any]) -> None:
+        result['updatedAt'] = int(time.time() * 1000)
+        self.oauth_results[state_id] = result
+        event_bus.publish(f"oauth:{state_id}", event, result)
+    
+    def _evict_expired(self) -> None:
+        now = int(time.time() * 1000)
+        for state_id, state in list(self.oauth_states.items()):
+            if state.expires_at and now > state.expires_at + 10000:
+                self.oauth_states.pop(state_id, None)
+                poller = self._pollers.pop(state_id, None)
+                if poller:
+                    poller.cancel()
+                self._set_result(state_id, 'error', {'success': False, 'status': 'error', 'error': '设备授权码已过期'})
+        
+        for state_id, result in list(self.oauth_results.items()):
+            if state_id not in self.oauth_states and now - result['updatedAt'] > self.RESULT_TTL * 1000:
+                self.oauth_results.pop(state_id, None)
+    
+    def get_oauth_status(self, state_id: str) -> Optional[Dict[str, Any]]:
+        self._evict_expired()
+        return self.oauth_results.get(state_id)
     
     async def poll_oauth_status(self, state_id: str) -> Dict[str, Any]:
         state = self.oauth_states.get(state_id)
@@ -116,82 +198,86 @@ class OAuthManager:
             self.oauth_states.pop(state_id, None)
             raise Exception("设备授权码已过期")
         
+        pending = {
+            'success': False,
+            'status': 'pending',
+            'remainingTime': max(0, int((state.expires_at - now) / 1000)) if state.expires_at else 0,
+            'pollInterval': state.poll_interval
+        }
         # 如果接近过期，提醒用户
         if state.expires_at and now > state.expires_at - 60000:
-            return {
-                'success': False,
-                'status': 'pending',
-                'warning': '设备授权码即将过期，请尽快完成授权'
-            }
+            pending['warning'] = '设备授权码即将过期，请尽快完成授权'
         
         try:
             headers = {}
             if self._version_manager:
                 headers['User-Agent'] = await self._version_manager.get_user_agent_async()
+            
+            form_data = aiohttp.FormData()
+            form_data.add_field('grant_type', QWEN_OAUTH_GRANT_TYPE)
+            form_data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
+            form_data.add_field('device_code', state.device_code)
+            form_data.add_field('code_verifier', state.code_verifier)
+            
+            async with self._get_session().post(QWEN_OAUTH_TOKEN_ENDPOINT, data=form_data, headers=headers) as response:
+                if response.status != 200:
+                    try:
+                        error_data = await response.json()
+                        
+                        if error_data.get('error') == 'authorization_pending':
+                            return pending
+                        
+                        if error_data.get('error') == 'slow_down':
+                            state.poll_interval = min(state.poll_interval * 1.5, self.MAX_POLL_INTERVAL)
+                            pending['pollInterval'] = state.poll_interval
+                            return pending
+                        
+                        raise Exception(f'Device token poll failed: {error_data.get("error")} - {error_data.get("error_description", "")}')
+                    except:
+                        error_text = await response.text()
+                        raise Exception(f'Device token poll failed: {response.status} {response.reason}. Response: {error_text}')
                 
-            async with aiohttp.ClientSession() as session:
-                form_data = aiohttp.FormData()
-                form_data.add_field('grant_type', QWEN_OAUTH_GRANT_TYPE)
-                form_data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
-                form_data.add_field('device_code', state.device_code)
-                form_data.add_field('code_verifier', state.code_verifier)
+                token_response = await response.json()
                 
-                async with session.post(QWEN_OAUTH_TOKEN_ENDPOINT, data=form_data, headers=headers) as response:
-                    if response.status != 200:
-                        try:
-                            error_data = await response.json()
-                            
-                            if response.status == 400 and error_data.get('error') == 'authorization_pending':
-                                return {
-                                    'success': False,
-                                    'status': 'pending',
-                                    'remainingTime': max(0, int((state.expires_at - now) / 1000)) if state.expires_at else 0
-                                }
-                            
-                            if response.status == 429 and error_data.get('error') == 'slow_down':
-                                state.pollInterval = min(state.pollInterval * 1.5, 10)
-                                return {
-                                    'success': False,
-                                    'status': 'pending',
-                                    'remainingTime': max(0, int((state.expires_at - now) / 1000)) if state.expires_at else 0
-                                }
-                            
-                            raise Exception(f'Device token poll failed: {error_data.get("error")} - {error_data.get("error_description", "")}')
-                        except:
-                            error_text = await response.text()
-                            raise Exception(f'Device token poll failed: {response.status} {response.statusText}. Response: {error_text}')
-                    
-                    token_response = await response.json()
-                    
-                    token_data = TokenData(
-                        access_token=token_response['access_token'],
-                        refresh_token=token_response['refresh_token'],
-                        expires_at=int(time.time() * 1000) + token_response.get('expires_in', 3600) * 1000,
-                        uploaded_at=int(time.time() * 1000)
-                    )
-                    
-                    self.oauth_states.pop(state_id, None)
-                    
-                    return {
-                        'success': True,
-                        'tokenData': token_data,
-                        'message': '认证成功'
-                    }
+                token_data = TokenData(
+                    access_token=token_response['access_token'],
+                    refresh_token=token_response['refresh_token'],
+                    expires_at=int(time.time() * 1000) + token_response.get('expires_in', 3600) * 1000,
+                    uploaded_at=int(time.time() * 1000)
+                )
+                
+                self.oauth_states.pop(state_id, None)
+                
+                return {
+                    'success': True,
+                    'tokenData': token_data,
+                    'message': '认证成功'
+                }
         except Exception as error:
             if any(keyword in str(error).lower() for keyword in ['timed out', 'expired', 'invalid', '401']):
                 self.oauth_states.pop(state_id, None)
                 raise Exception(str(error))
             else:
-                return {
-                    'success': False,
-                    'status': 'pending'
-                }
+                return pending
     
     def cancel_oauth(self, state_id: str) -> Dict[str, Any]:
         if state_id:
             self.oauth_states.pop(state_id, None)
+            poller = self._pollers.pop(state_id, None)
+            if poller:
+                poller.cancel()
+            if state_id in self.oauth_results:
+                self._set_result(state_id, 'cancelled', {'success': False, 'status': 'cancelled'})
         
         return {
             'success': True,
             'message': 'OAuth认证已取消'
-        }
\ No newline at end of file
+        }
+    
+    async def close(self) -> None:
+        pollers = list(self._pollers.values())
+        for poller in pollers:
+            poller.cancel()
+        await asyncio.gather(*pollers, return_exceptions=True)
+        if self._session and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,97 @@
+"""
+Token slot leasing for Qwen Code API Server
+"""
+import os
+import socket
+import asyncio
+import secrets
+import logging
+from typing import Dict, Any, Optional, Set
+
+from ..database import LeaseBackend
+from ..config import TOKEN_MAX_CONCURRENCY, TOKEN_LEASE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class TokenLeases:
+
+    def __init__(self, backend: LeaseBackend, slots: int = TOKEN_MAX_CONCURRENCY, ttl: float = TOKEN_LEASE_TTL):
+        self.backend = backend
+        self.slots = slots
+        self.ttl = ttl
+        # 节点标识，续约与崩溃后的过期回收都按持有者进行
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._held: Set[str] = set()
+        self._releasing: Set[asyncio.Task] = set()
+        self._renew_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slots > 0
+
+    async def _acquire(self, resource: str, slots: int) -> Optional[str]:
+        lease_id = await self.backend.acquire(resource, self.holder, slots, self.ttl)
+        if lease_id:
+            self._held.add(lease_id)
+        return lease_id
+
+    async def acquire(self, token_id: str) -> Optional[str]:
+        return await self._acquire(f"token:{token_id}", self.slots)
+
+    async def acquire_refresh(self, token_id: str) -> Optional[str]:
+        return await self._acquire(f"refresh:{token_id}", 1)
+
+    def release(self, lease_id: Optional[str]) -> None:
+        # 请求结束的回调是同步的，归还在后台任务中完成，stop() 时等待全部归还
+        if lease_id in self._held:
+            self._held.discard(lease_id)
+            task = asyncio.get_running_loop().create_task(self._release(lease_id))
+            self._releasing.add(task)
+            task.add_done_callback(self._releasing.discard)
+
+    async def _release(self, lease_id: str) -> None:
+        try:
+            await self.backend.release(lease_id)
+        except Exception as e:
+            # 未归还的租约在 TTL 到期后由其他节点回收
+            logger.warning(f"Token租约归还失败: {e}")
+
+    async def active(self, token_id: str) -> int:
+        return await self.backend.count(f"token:{token_id}")
+
+    def start(self) -> None:
+        if self._renew_task is None or self._renew_task.done():
+            self._renew_task = asyncio.create_task(self._renew_loop())
+
+    async def _renew_loop(self) -> None:
+        # 所有本节点持有的租约一次续约，长时间的流式请求不会因 TTL 到期被其他节点抢走名额
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self._held:
+                continue
+            try:
+                await self.backend.renew_holder(self.holder, self.ttl)
+            except Exception as e:
+                logger.warning(f"Token租约续约失败: {e}")
+
+    async def stop(self) -> None:
+        if self._renew_task:
+            self._renew_task.cancel()
+            try:
+                await self._renew_task
+            except asyncio.CancelledError:
+                pass
+            self._renew_task = None
+        for lease_id in list(self._held):
+            self.release(lease_id)
+        await asyncio.gather(*self._releasing)
+        await self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backend': type(self.backend).__name__,
+            'holder': self.holder,
+            'slotsPerToken': self.slots,
+            'held': len(self._held)
+        }
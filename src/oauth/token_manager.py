@@ -1,23 +1,130 @@
 """
 Token management for Qwen Code API Server
 """
+import io
 import time
+import json
 import random
+import asyncio
+import tarfile
+import zipfile
 import aiohttp
 from typing import Dict, Optional, Tuple, List, Any
 from ..models import TokenData, RefreshResult
-from ..database import TokenDatabase
+from ..database import TokenDatabase, create_lease_backend
+from .token_lease import TokenLeases
 from ..utils import get_token_id
+from ..utils.event_bus import event_bus, DASHBOARD_TOPIC
 from ..utils.timezone_utils import timestamp_to_local_datetime, format_local_datetime
-from ..config import QWEN_OAUTH_TOKEN_ENDPOINT, QWEN_OAUTH_CLIENT_ID
+from ..config import (
+    QWEN_OAUTH_TOKEN_ENDPOINT,
+    QWEN_OAUTH_CLIENT_ID,
+    TOKEN_VALIDATE_CONCURRENCY,
+    TOKEN_COOLDOWN_SECONDS,
+    TOKEN_LEASE_BACKEND,
+    TOKEN_LEASE_WAIT
+)
+
+LEASE_POLL_INTERVAL = 0.2
+REFRESH_WAIT_SECONDS = 10
+
+
+class RefreshInProgress(Exception):
+    # 其他节点持有刷新租约且在等待时间内没有写回新 Token，刷新结果未知，调用方不能据此删除 Token
+    pass
+
+
+class TokenRejected(Exception):
+    # 授权服务明确拒绝了 refresh_token（invalid_grant 或 401/403），Token 已不可能恢复
+    pass
+
+
+# 只有这些响应说明 refresh_token 本身失效；网络错误、超时和 5xx 都可能是暂时的
+REJECTED_STATUSES = (401, 403)
+REJECTED_GRANT_ERRORS = ('invalid_grant',)
+
+
+# 单个事件里携带的 Token ID 上限，批量导入时只附带数量
+EVENT_TOKEN_ID_LIMIT = 100
+
+def _credential_to_token(creds: Any) -> Optional[TokenData]:
+    if not isinstance(creds, dict) or not creds.get('access_token') or not creds.get('refresh_token'):
+        return None
+    return TokenData(
+        access_token=creds['access_token'],
+        refresh_token=creds['refresh_token'],
+        expires_at=creds.get('expiry_date', creds.get('expires_at')),
+        uploaded_at=creds.get('uploaded_at') or int(time.time() * 1000),
+        usage_count=creds.get('usage_count', 0)
+    )
+
+
+def _iter_credential_documents(raw: bytes) -> List[Tuple[str, bytes]]:
+    if raw[:4] == b'PK\x03\x04':
+        with zipfile.ZipFile(io.BytesIO(raw)) as archive:
+            return [(info.filename, archive.read(info)) for info in archive.infolist()
+                    if not info.is_dir() and info.filename.endswith(('.json', '.jsonl'))]
+    
+    if raw[:2] == b'\x1f\x8b' or raw[257:262] == b'ustar':
+        with tarfile.open(fileobj=io.BytesIO(raw)) as archive:
+            return [(member.name, archive.extractfile(member).read()) for member in archive.getmembers()
+                    if member.isfile() and member.name.endswith(('.json', '.jsonl'))]
+    
+    return [('upload', raw)]
+
+
+# 支持 JSONL、JSON 数组/对象，以及包含 oauth_creds.json 的 zip / tar(.gz) 压缩包
+def parse_token_import(raw: bytes) -> Tuple[Dict[str, TokenData], List[str]]:
+    tokens: Dict[str, TokenData] = {}
+    errors: List[str] = []
+    
+    for name, content in _iter_credential_documents(raw):
+        text = content.decode('utf-8-sig').strip()
+        if not text:
+            continue
+        try:
+            documents = json.loads(text)
+            documents = documents if isinstance(documents, list) else [documents]
+        except ValueError:
+            documents = []
+            for line_number, line in enumerate(text.splitlines(), 1):
+                if not line.strip():
+                    continue
+                try:
+                    documents.append(json.loads(line))
+                except ValueError:
+                    errors.append(f"{name}:{line_number}: invalid JSON")
+        
+        for index, creds in enumerate(documents, 1):
+            token = _credential_to_token(creds)
+            if token is None:
+                errors.append(f"{name}:{index}: missing access_token or refresh_token")
+                continue
+            tokens[get_token_id(token.refresh_token)] = token
+    
+    return tokens, errors
 
 
 class TokenManager:
     
-    def __init__(self, db: TokenDatabase):
+    def __init__(self, db: TokenDatabase, leases: Optional[TokenLeases] = None):
         self.db = db
+        self.leases = leases or TokenLeases(create_lease_backend(TOKEN_LEASE_BACKEND, db.db_path))
         self.token_store: Dict[str, TokenData] = {}
         self._version_manager = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._cooldowns: Dict[str, float] = {}
+        # 最近一次冷却的起止时间（毫秒时间戳），增量查询据此返回冷却状态有变化的 Token
+        self._cooling_windows: Dict[str, Tuple[float, float]] = {}
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+    
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
     
     def set_version_manager(self, version_manager):
         self._version_manager = version_manager
@@ -25,52 +132,139 @@ class TokenManager:
     def load_tokens(self) -> None:
         self.token_store = self.db.load_all_tokens()
     
+    def _publish_tokens(self, action: str, token_ids: List[str]) -> None:
+        # 只推送变化摘要，面板收到后再按需拉取当前页
+        event_bus.publish(DASHBOARD_TOPIC, 'tokens', {
+            'action': action,
+            'tokenIds': token_ids[:EVENT_TOKEN_ID_LIMIT],
+            'changed': len(token_ids),
+            'tokenCount': len(self.token_store)
+        })
+    
     def save_token(self, token_id: str, token_data: TokenData) -> None:
         self.token_store[token_id] = token_data
         self.db.save_token(token_id, token_data)
+        self._publish_tokens('saved', [token_id])
+    
+    def save_tokens(self, tokens: Dict[str, TokenData]) -> None:
+        self.token_store.update(tokens)
+        self.db.save_tokens(tokens)
+        self._publish_tokens('saved', list(tokens))
     
     def delete_token(self, token_id: str) -> None:
         self.token_store.pop(token_id, None)
         self.db.delete_token(token_id)
+        self._publish_tokens('deleted', [token_id])
+    
+    def delete_tokens(self, token_ids: List[str]) -> None:
+        for token_id in token_ids:
+            self.token_store.pop(token_id, None)
+        self.db.delete_tokens(token_ids)
+        self._publish_tokens('deleted', token_ids)
     
     def delete_all_tokens(self) -> None:
+        token_ids = list(self.token_store)
         self.token_store.clear()
         self.db.delete_all_tokens()
+        self._publish_tokens('deleted', token_ids)
     
-    def get_token_status(self) -> Dict[str, Any]:
-        token_list = []
+    def cool_down(self, token_id: str, seconds: float = TOKEN_COOLDOWN_SECONDS) -> None:
+        self._cooldowns[token_id] = time.monotonic() + seconds
+        now = time.time() * 1000
+        self._cooling_windows[token_id] = (now, now + seconds * 1000)
+        self._publish_tokens('cooling', [token_id])
+    
+    def is_cooling(self, token_id: str) -> bool:
+        until = self._cooldowns.get(token_id)
+        if until is None:
+            return False
+        if time.monotonic() >= until:
+            del self._cooldowns[token_id]
+            return False
+        return True
+    
+    def count_valid_tokens(self) -> int:
+        now = time.time() * 1000
+        return sum(1 for token in self.token_store.values()
+                   if not (token.expires_at and now > token.expires_at))
+    
+    def count_available_tokens(self) -> int:
+        now = time.time() * 1000
+        return sum(1 for token_id, token in self.token_store.items()
+                   if not (token.expires_at and now > token.expires_at) and not self.is_cooling(token_id))
+    
+    def cooling_ids(self) -> List[str]:
+        return sorted(token_id for token_id in list(self._cooldowns) if self.is_cooling(token_id))
+    
+    def _token_state(self, token_id: str, token: TokenData, now: float) -> str:
+        if token.expires_at and now > token.expires_at:
+            return 'expired'
+        return 'cooling' if self.is_cooling(token_id) else 'healthy'
+    
+    def _state_changed_at(self, token_id: str, token: TokenData, now: float) -> float:
+        # 状态变化时间：写库时间、到期时间、冷却开始与结束时间中已发生的最大值
+        changed_at = token.updated_at or 0
+        if token.expires_at and token.expires_at <= now:
+            changed_at = max(changed_at, token.expires_at)
+        window = self._cooling_windows.get(token_id)
+        if window:
+            started_at, ended_at = window
+            changed_at = max(changed_at, ended_at if ended_at <= now else started_at)
+        return changed_at
+    
+    def _token_entry(self, token_id: str, token: TokenData, state: str) -> Dict[str, Any]:
+        entry = {
+            'id': token_id,
+            'expiresAt': token.expires_at,
+            'expiresAtDisplay': format_local_datetime(timestamp_to_local_datetime(token.expires_at)) if token.expires_at else "未知",
+            'isExpired': state == 'expired',
+            'uploadedAt': token.uploaded_at,
+            'uploadedAtDisplay': format_local_datetime(timestamp_to_local_datetime(token.uploaded_at)) if token.uploaded_at else "未知",
+            'usageCount': token.usage_count,
+            'updatedAt': token.updated_at,
+            'status': state
+        }
+        if state == 'expired':
+            entry['refreshFailed'] = True
+        else:
+            entry['isCooling'] = state == 'cooling'
+        return entry
+    
+    def get_token_status(self, status: str = 'all', sort: str = 'uploadedAt', order: str = 'desc',
+                         page: int = 1, page_size: Optional[int] = None, since: Optional[int] = None) -> Dict[str, Any]:
+        now = time.time() * 1000
+        counts = {'healthy': 0, 'expired': 0, 'cooling': 0}
+        matched = []
         for token_id, token in self.token_store.items():
-            is_expired = token.expires_at and (time.time() * 1000) > token.expires_at
-            
-            expires_at_str = format_local_datetime(timestamp_to_local_datetime(token.expires_at)) if token.expires_at else "未知"
-            uploaded_at_str = format_local_datetime(timestamp_to_local_datetime(token.uploaded_at)) if token.uploaded_at else "未知"
-            
-            if is_expired:
-                token_list.append({
-                    'id': token_id,
-                    'expiresAt': token.expires_at,
-                    'expiresAtDisplay': expires_at_str,
-                    'isExpired': True,
-                    'uploadedAt': token.uploaded_at,
-                    'uploadedAtDisplay': uploaded_at_str,
-                    'usageCount': token.usage_count,
-                    'refreshFailed': True
-                })
-            else:
-                token_list.append({
-                    'id': token_id,
-                    'expiresAt': token.expires_at,
-                    'expiresAtDisplay': expires_at_str,
-                    'isExpired': False,
-                    'uploadedAt': token.uploaded_at,
-                    'uploadedAtDisplay': uploaded_at_str,
-                    'usageCount': token.usage_count
-                })
+            state = self._token_state(token_id, token, now)
+            counts[state] += 1
+            if status != 'all' and state != status:
+                continue
+            if since is not None and self._state_changed_at(token_id, token, now) <= since:
+                continue
+            matched.append((token_id, token, state))
+        
+        sort_keys = {
+            'id': lambda item: item[0],
+            'expiresAt': lambda item: item[1].expires_at or 0,
+            'uploadedAt': lambda item: item[1].uploaded_at or 0,
+            'usageCount': lambda item: item[1].usage_count,
+            'updatedAt': lambda item: item[1].updated_at or 0
+        }
+        matched.sort(key=sort_keys.get(sort, sort_keys['uploadedAt']), reverse=order == 'desc')
         
+        # 只格式化当前页，时间显示的开销与总 Token 数无关
+        page_size = page_size or max(len(matched), 1)
+        start = (max(page, 1) - 1) * page_size
         return {
             'hasToken': len(self.token_store) > 0,
             'tokenCount': len(self.token_store),
-            'tokens': token_list
+            'counts': counts,
+            'total': len(matched),
+            'page': max(page, 1),
+            'pageSize': page_size,
+            'pages': (len(matched) + page_size - 1) // page_size,
+            'tokens': [self._token_entry(token_id, token, state) for token_id, token, state in matched[start:start + page_size]]
         }
     
     async def refresh_single_token(self, token_id: str) -> Dict[str, Any]:
@@ -79,7 +273,12 @@ class TokenManager:
             raise Exception("Token不存在")
         
         # 强制刷新单个token
-        refreshed_token = await self._force_refresh_token(token_id, token)
+        try:
+            refreshed_token = await self._force_refresh_token(token_id, token)
+        except RefreshInProgress:
+            raise Exception("Token正在由其他进程刷新，请稍后重试")
+        except TokenRejected:
+            refreshed_token = None
         
         if refreshed_token:
             return {
@@ -92,44 +291,117 @@ class TokenManager:
             self.delete_token(token_id)
             raise Exception("Token刷新失败，已删除")
     
-    async def _force_refresh_token(self, token_id: str, token: TokenData) -> Optional[TokenData]:
+    async def _force_refresh_token(self, token_id: str, token: TokenData, persist: bool = True) -> Optional[TokenData]:
+        # 只有拿到刷新租约的节点才会调用刷新接口，其他节点等待其写回数据库
+        lease_id = await self.leases.acquire_refresh(token_id)
+        if lease_id is None:
+            return await self._wait_for_refresh(token_id, token)
+        try:
+            # 其他进程可能刚刷新完并释放租约，数据库里已是新 Token 时直接使用，不再用已轮换的 refresh_token 刷新
+            current = self.db.get_token(token_id)
+            if current is not None and current.access_token != token.access_token:
+                self.token_store[token_id] = current
+                return current
+            refreshed = await self._refresh_token(token_id, token, persist)
+        except TokenRejected:
+            event_bus.publish(DASHBOARD_TOPIC, 'refresh', {'tokenId': token_id, 'success': False})
+            raise
+        finally:
+            self.leases.release(lease_id)
+        event_bus.publish(DASHBOARD_TOPIC, 'refresh', {'tokenId': token_id, 'success': refreshed is not None})
+        return refreshed
+    
+    async def _wait_for_refresh(self, token_id: str, token: TokenData) -> Optional[TokenData]:
+        deadline = time.monotonic() + REFRESH_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LEASE_POLL_INTERVAL * 5)
+            current = self.db.get_token(token_id)
+            if current is None:
+                # 持有租约的节点刷新被拒后已删除该 Token
+                raise TokenRejected(token_id)
+            if current.access_token != token.access_token:
+                self.token_store[token_id] = current
+                return current
+        raise RefreshInProgress(token_id)
+    
+    async def _refresh_token(self, token_id: str, token: TokenData, persist: bool) -> Optional[TokenData]:
         try:
             headers = {}
             if self._version_manager:
                 headers['User-Agent'] = await self._version_manager.get_user_agent_async()
             
-            async with aiohttp.ClientSession() as session:
-                data = aiohttp.FormData()
-                data.add_field('grant_type', 'refresh_token')
-                data.add_field('refresh_token', token.refresh_token)
-                data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
+            data = aiohttp.FormData()
+            data.add_field('grant_type', 'refresh_token')
+            data.add_field('refresh_token', token.refresh_token)
+            data.add_field('client_id', QWEN_OAUTH_CLIENT_ID)
+            
+            async with self._get_session().post(QWEN_OAUTH_TOKEN_ENDPOINT, data=data, headers=headers) as response:
+                if response.status in REJECTED_STATUSES:
+                    raise TokenRejected(token_id)
+                
+                try:
+                    result = await response.json(content_type=None)
+                except Exception as json_error:
+                    return None
+                
+                if isinstance(result, dict) and result.get('error') in REJECTED_GRANT_ERRORS:
+                    raise TokenRejected(token_id)
+                if response.status != 200 or 'error' in result:
+                    return None
                 
-                async with session.post(QWEN_OAUTH_TOKEN_ENDPOINT, data=data, headers=headers) as response:
-                    if response.status != 200:
-                        return None
-                    
-                    try:
-                        result = await response.json()
-                    except Exception as json_error:
-                        return None
-                    
-                    if 'error' in result:
-                        return None
-                    
-                    updated_token = TokenData(
-                        access_token=result['access_token'],
-                        refresh_token=result.get('refresh_token', token.refresh_token),
-                        expires_at=int(time.time() * 1000) + result.get('expires_in', 3600) * 1000,
-                        uploaded_at=token.uploaded_at,
-                        usage_count=token.usage_count
-                    )
-                    
+                updated_token = TokenData(
+                    access_token=result['access_token'],
+                    refresh_token=result.get('refresh_token', token.refresh_token),
+                    expires_at=int(time.time() * 1000) + result.get('expires_in', 3600) * 1000,
+                    uploaded_at=token.uploaded_at,
+                    usage_count=token.usage_count
+                )
+                
+                if persist:
                     self.save_token(token_id, updated_token)
-                    
-                    return updated_token
+                
+                return updated_token
+        except TokenRejected:
+            raise
         except Exception as error:
             return None
     
+    async def validate_tokens(self, token_ids: List[str], concurrency: int = TOKEN_VALIDATE_CONCURRENCY) -> Dict[str, Any]:
+        # 并发刷新校验，结果统一在一个事务中写回
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        
+        async def validate(token_id: str) -> Tuple[str, Optional[TokenData], str]:
+            async with semaphore:
+                try:
+                    refreshed_token = await self._force_refresh_token(token_id, self.token_store[token_id], persist=False)
+                except RefreshInProgress:
+                    return token_id, None, 'pending'
+                except TokenRejected:
+                    return token_id, None, 'invalid'
+                return token_id, refreshed_token, 'valid' if refreshed_token else 'failed'
+        
+        results = await asyncio.gather(*(validate(token_id) for token_id in token_ids if token_id in self.token_store))
+        refreshed = {token_id: token for token_id, token, _ in results if token}
+        # 只删除被明确拒绝的 Token；暂时性失败只报告，保留给下次刷新
+        invalid = [token_id for token_id, _, state in results if state == 'invalid']
+        failed = [token_id for token_id, _, state in results if state == 'failed']
+        pending = [token_id for token_id, _, state in results if state == 'pending']
+        
+        if refreshed:
+            self.save_tokens(refreshed)
+        if invalid:
+            self.delete_tokens(invalid)
+        
+        return {
+            'valid': len(refreshed),
+            'invalid': len(invalid),
+            'invalidTokenIds': invalid,
+            'failed': len(failed),
+            'failedTokenIds': failed,
+            'pending': len(pending),
+            'pendingTokenIds': pending
+        }
+    
     async def refresh_all_tokens(self) -> Dict[str, Any]:
         if not self.token_store:
             raise Exception("没有可用的token")
@@ -137,8 +409,14 @@ class TokenManager:
         refresh_results = []
         tokens_to_remove = []
         
-        for token_id, token in self.token_store.items():
-            refreshed_token = await self._force_refresh_token(token_id, token)
+        for token_id, token in list(self.token_store.items()):
+            try:
+                refreshed_token = await self._force_refresh_token(token_id, token)
+            except RefreshInProgress:
+                refresh_results.append({'id': token_id, 'success': False, 'error': 'Token正在由其他进程刷新'})
+                continue
+            except TokenRejected:
+                refreshed_token = None
             
             if refreshed_token:
                 refresh_results.append({'id': token_id, 'success': True})
@@ -156,12 +434,17 @@ class TokenManager:
             'isForcedRefresh': True
         }
     
-    async def get_valid_token(self) -> Optional[Tuple[str, TokenData]]:
+    async def get_valid_token(self, exclude: Optional[set] = None) -> Optional[Tuple[str, TokenData]]:
         if not self.token_store:
             return None
         
         valid_tokens = []
-        token_entries = list(self.token_store.items())
+        token_entries = [(token_id, token) for token_id, token in self.token_store.items()
+                         if not exclude or token_id not in exclude]
+        
+        # 冷却中的 Token 只在没有其他可用 Token 时才会被选中
+        ready = [(token_id, token) for token_id, token in token_entries if not self.is_cooling(token_id)]
+        token_entries = ready or token_entries
         
         random.shuffle(token_entries)
         
@@ -171,11 +454,36 @@ class TokenManager:
             if not is_expired:
                 valid_tokens.append((token_id, token))
             else:
-                refreshed_token = await self._force_refresh_token(token_id, token)
+                try:
+                    refreshed_token = await self._force_refresh_token(token_id, token)
+                except (RefreshInProgress, TokenRejected):
+                    continue
                 if refreshed_token:
                     valid_tokens.append((token_id, refreshed_token))
         
         if valid_tokens:
             return random.choice(valid_tokens)
         
-        return None
\ No newline at end of file
+        return None
+    
+    async def lease_token(self, exclude: Optional[set] = None,
+                          wait: float = TOKEN_LEASE_WAIT) -> Optional[Tuple[str, TokenData, Optional[str]]]:
+        # 返回 (token_id, token, lease_id)；未启用并发限制时 lease_id 为 None
+        deadline = time.monotonic() + wait
+        while True:
+            saturated = set(exclude or ())
+            while True:
+                valid_token = await self.get_valid_token(exclude=saturated)
+                if not valid_token:
+                    break
+                token_id, token = valid_token
+                if not self.leases.enabled:
+                    return token_id, token, None
+                lease_id = await self.leases.acquire(token_id)
+                if lease_id:
+                    return token_id, token, lease_id
+                saturated.add(token_id)
+            
+            if saturated == set(exclude or ()) or time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
\ No newline at end of file
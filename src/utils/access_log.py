@@ -0,0 +1,134 @@
+"""
+Structured access log for Qwen Code API Server
+"""
+import os
+import queue
+import hashlib
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Dict, Any, Optional
+
+from .fast_json import dumps
+from .timezone_utils import get_local_timezone
+from ..config.settings import (
+    ACCESS_LOG_PATH,
+    ACCESS_LOG_MAX_BYTES,
+    ACCESS_LOG_BACKUP_COUNT,
+    ACCESS_LOG_ROTATE_WHEN,
+    WORKERS,
+    WORKER_ID
+)
+
+logger = logging.getLogger(__name__)
+
+
+def client_key_hash(authorization: Optional[str]) -> Optional[str]:
+    if not authorization:
+        return None
+    return hashlib.sha256(authorization.encode('utf-8')).hexdigest()[:12]
+
+
+class _RawQueueHandler(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 默认实现会在调用方线程里格式化消息，这里原样入队，序列化交给写入线程
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__()
+        self._tz = get_local_timezone()
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(record.msg)
+        entry['ts'] = datetime.fromtimestamp(entry['ts'], self._tz).isoformat(timespec='milliseconds')
+        return dumps(entry).decode('utf-8')
+
+
+class AccessLog:
+
+    def __init__(self, path: str = ACCESS_LOG_PATH, max_bytes: int = ACCESS_LOG_MAX_BYTES,
+                 backup_count: int = ACCESS_LOG_BACKUP_COUNT, rotate_when: str = ACCESS_LOG_ROTATE_WHEN):
+        if path and WORKERS != 1:
+            # 多进程时每个工作进程写各自的文件，避免轮转时互相覆盖
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{WORKER_ID}{ext}"
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_when = rotate_when
+        self._logger = logging.getLogger("qwen.access")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._queue_handler: Optional[QueueHandler] = None
+        self._listener: Optional[QueueListener] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._listener is not None
+
+    def start(self) -> None:
+        if self.enabled or not self.path:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if self.rotate_when:
+            file_handler = TimedRotatingFileHandler(
+                self.path, when=self.rotate_when, backupCount=self.backup_count, encoding='utf-8'
+            )
+        else:
+            file_handler = RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding='utf-8'
+            )
+        file_handler.setFormatter(JsonLinesFormatter())
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener = QueueListener(log_queue, file_handler)
+        self._listener.start()
+        self._queue_handler = _RawQueueHandler(log_queue)
+        self._logger.addHandler(self._queue_handler)
+        logger.info(f"访问日志已启用: {self.path}")
+
+    def record(self, trace) -> None:
+        if self._listener is None:
+            return
+
+        attributes = trace.attributes
+        entry: Dict[str, Any] = {
+            'ts': trace.started_at,
+            'route': trace.route,
+            'priority': trace.priority,
+            'clientKey': attributes.get('clientKey'),
+            'model': attributes.get('model'),
+            'stream': attributes.get('stream'),
+            'tokenId': attributes.get('tokenId'),
+            'promptTokens': attributes.get('promptTokens'),
+            'completionTokens': attributes.get('completionTokens'),
+            'upstreamStatus': attributes.get('upstreamStatus'),
+            'ttfbMs': round(trace.phases['upstream_ttfb'], 2) if 'upstream_ttfb' in trace.phases else None,
+            'failoverMs': round(trace.phases['failover'], 2) if 'failover' in trace.phases else None,
+            'durationMs': round(trace.duration_ms, 2),
+            'outcome': attributes.get('outcome')
+        }
+        self._logger.info(entry)
+
+    def stop(self) -> None:
+        if self._listener is None:
+            return
+
+        # QueueListener.stop 会先写完队列中剩余的记录
+        self._logger.removeHandler(self._queue_handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        self._queue_handler = None
+
+
+access_log = AccessLog()
@@ -0,0 +1,42 @@
+"""
+Context window limits for Qwen Code API Server
+"""
+from typing import Dict, Any, List, Optional
+
+from ..config.settings import MODEL_CONTEXT_LIMITS, CONTEXT_OVERFLOW_POLICY
+
+CONTEXT_OVERFLOW_POLICIES = ("reject", "truncate_middle")
+
+
+def get_context_limit(model: str) -> Optional[int]:
+    return MODEL_CONTEXT_LIMITS.get(model)
+
+
+def resolve_overflow_policy(requested: Optional[str]) -> str:
+    if requested in CONTEXT_OVERFLOW_POLICIES:
+        return requested
+    return CONTEXT_OVERFLOW_POLICY
+
+
+def truncate_middle(messages: List[Dict[str, Any]], token_counts: List[int],
+                    budget: int) -> Optional[List[Dict[str, Any]]]:
+    # 保留开头的 system 消息和第一条对话消息，以及最后一条消息，从最早的中间历史开始丢弃
+    head = 0
+    while head < len(messages) and messages[head].get('role') == 'system':
+        head += 1
+    head = min(head + 1, len(messages) - 1)
+
+    total = sum(token_counts)
+    drop_end = head
+    while total > budget and drop_end < len(messages) - 1:
+        total -= token_counts[drop_end]
+        drop_end += 1
+
+    # 不能留下失去对应 tool_calls 的 tool 消息
+    while drop_end < len(messages) - 1 and messages[drop_end].get('role') == 'tool':
+        total -= token_counts[drop_end]
+        drop_end += 1
+
+    if total > budget or (drop_end > head and messages[drop_end].get('role') == 'tool'):
+        return None
+    return messages[:head] + messages[drop_end:]
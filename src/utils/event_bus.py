@@ -0,0 +1,57 @@
+"""
+In-memory event fan-out for server-sent events
+"""
+import json
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, Set, Iterator
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 256
+SSE_KEEPALIVE = b": keepalive\n\n"
+# 管理面板共用的事件频道：Token 池变化、用量增量与刷新结果
+DASHBOARD_TOPIC = "dashboard"
+
+
+class EventBus:
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def publish(self, topic: str, event: str, data: Dict[str, Any]) -> None:
+        subscribers = self._subscribers.get(topic)
+        if not subscribers:
+            return
+
+        message = (event, format_sse(event, data))
+        for queue in list(subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # 消费过慢的订阅者直接丢弃事件，不阻塞发布方
+                logger.warning(f"事件订阅队列已满，丢弃事件: {topic}/{event}")
+
+    @contextmanager
+    def subscribe(self, topic: str) -> Iterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.setdefault(topic, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    self._subscribers.pop(topic, None)
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._subscribers.get(topic, ()))
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+event_bus = EventBus()
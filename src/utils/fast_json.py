@@ -0,0 +1,113 @@
+"""
+JSON helpers for Qwen Code API Server
+"""
+import re
+import json
+from json.decoder import scanstring
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_USAGE_KEY = b'"usage"'
+_USAGE_WINDOW = 2048
+_decoder = json.JSONDecoder()
+_STRUCTURE_TOKEN = re.compile(r'["{}\[\],]')
+
+
+def loads(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def extract_usage(raw: bytes) -> Optional[Dict[str, Any]]:
+    # usage 通常位于响应末尾，只解码其附近的一小段，避免整段解析
+    end = len(raw)
+    candidate = False
+    while True:
+        index = raw.rfind(_USAGE_KEY, 0, end)
+        if index == -1:
+            break
+        end = index
+        if index > 0 and raw[index - 1:index] == b'\\':
+            continue
+
+        colon = raw.find(b':', index + len(_USAGE_KEY), index + len(_USAGE_KEY) + 16)
+        if colon == -1:
+            continue
+
+        candidate = True
+        window = raw[colon + 1:colon + 1 + _USAGE_WINDOW].decode('utf-8', errors='ignore').lstrip()
+        try:
+            usage, _ = _decoder.raw_decode(window)
+        except ValueError:
+            continue
+        if isinstance(usage, dict) and 'total_tokens' in usage:
+            return usage
+
+    if not candidate:
+        return None
+
+    try:
+        result = loads(raw)
+    except ValueError:
+        return None
+    usage = result.get('usage') if isinstance(result, dict) else None
+    return usage if isinstance(usage, dict) else None
+
+
+def rewrite_object(raw: bytes, overrides: Dict[str, Any]) -> bytes:
+    # 只改写顶层字段，其余成员按原始字节切片拼接，不重新序列化 messages 等大字段
+    # latin-1 解码保证字符下标与字节偏移一一对应，字符串由 C 实现的 scanstring 整段跳过
+    text = raw.decode('latin-1')
+    members = []
+    depth = 0
+    key = None
+    member_start = None
+    position = 0
+
+    while True:
+        match = _STRUCTURE_TOKEN.search(text, position)
+        if match is None:
+            break
+        start = match.start()
+        char = text[start]
+        if char == '"':
+            value, position = scanstring(text, start + 1)
+            if depth == 1 and member_start is None:
+                # 键可能含 \uXXXX 转义，按原始字节重新解码，才能与 overrides 中的键名比较
+                key = loads(raw[start:position])
+                member_start = start
+            continue
+
+        position = start + 1
+        if char == '{' or char == '[':
+            depth += 1
+        elif char == '}' or char == ']':
+            depth -= 1
+            if depth == 0:
+                if member_start is not None:
+                    members.append((key, member_start, start))
+                break
+        elif depth == 1:
+            members.append((key, member_start, start))
+            key = None
+            member_start = None
+
+    if depth != 0:
+        raise ValueError("Invalid JSON object")
+
+    view = memoryview(raw)
+    parts = [dumps(name) + b':' + dumps(value) for name, value in overrides.items()]
+    parts.extend(view[begin:end] for name, begin, end in members if name not in overrides)
+    return b'{' + b','.join(parts) + b'}'
@@ -0,0 +1,102 @@
+"""
+Graceful drain support for Qwen Code API Server
+"""
+import time
+import signal
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+import uvicorn
+
+from .request_trace import in_flight
+from .event_bus import event_bus, DASHBOARD_TOPIC
+
+logger = logging.getLogger(__name__)
+
+# 排空期间仍然放行的探针/管理接口
+DRAIN_EXEMPT_PATHS = ("/api/health", "/api/livez", "/api/readyz", "/api/drain")
+
+
+class DrainController:
+
+    def __init__(self):
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self._started_monotonic: Optional[float] = None
+
+    def start(self) -> None:
+        if not self.draining:
+            self.draining = True
+            self.started_at = time.time()
+            self._started_monotonic = time.monotonic()
+            logger.info(f"进入排空模式，当前进行中的请求: {in_flight.count()}")
+            # 通知长连接的面板事件流结束，避免它们拖住进程退出
+            event_bus.publish(DASHBOARD_TOPIC, 'drain', self.status())
+
+    async def wait_for_idle(self, timeout: float) -> bool:
+        # 超时从进入排空时算起，收到信号后等待连接结束的时间也计入其中
+        deadline = (self._started_monotonic or time.monotonic()) + timeout
+        while in_flight.count() > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"排空超时，仍有 {in_flight.count()} 个请求未完成")
+                return False
+            try:
+                await asyncio.wait_for(in_flight.wait_below(in_flight.count()), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'draining': self.draining,
+            'startedAt': self.started_at,
+            'inFlight': in_flight.count()
+        }
+
+
+def drain_on_signal(controller: DrainController) -> None:
+    # uvicorn 收到信号后先关闭监听并等待所有连接结束，之后才执行 lifespan 关闭；
+    # 在它的信号处理函数之前进入排空，新请求立即返回 503，面板事件流也能及时结束
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not isinstance(getattr(previous, '__self__', None), uvicorn.Server):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(controller.start)
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+
+class DrainMiddleware:
+
+    def __init__(self, app, controller: 'DrainController'):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.controller.draining:
+            await self.app(scope, receive, send)
+            return
+
+        if scope['path'].startswith(DRAIN_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 503,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'retry-after', b'5'),
+                (b'connection', b'close')
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': b'{"detail":"Server is draining"}'})
+
+
+drain_controller = DrainController()
@@ -0,0 +1,138 @@
+"""
+Event loop lag watchdog for Qwen Code API Server
+"""
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+from .request_trace import in_flight
+from ..config.settings import (
+    LOOP_LAG_INTERVAL,
+    LOOP_LAG_THRESHOLD_MS,
+    LOOP_STALL_WINDOW
+)
+
+logger = logging.getLogger(__name__)
+
+# 延迟分位数统计使用的心跳样本数
+LAG_SAMPLE_WINDOW = 600
+STACK_LIMIT = 30
+
+
+class LoopMonitor:
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold_ms: float = LOOP_LAG_THRESHOLD_MS,
+                 stall_window: int = LOOP_STALL_WINDOW):
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self._samples = deque(maxlen=LAG_SAMPLE_WINDOW)
+        self._stalls = deque(maxlen=stall_window)
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.max_lag_ms = 0.0
+        self.stall_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._heartbeat_task is not None
+
+    def start(self) -> None:
+        if self.enabled or self.threshold_ms <= 0:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def _heartbeat(self) -> None:
+        # 每次唤醒比预期晚多少就是事件循环被占用的时间
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag_ms = max(0.0, (now - expected) * 1000)
+            self._beat = now
+            self._samples.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def _watch(self) -> None:
+        # 在独立线程里检查心跳，事件循环卡住时仍能抓到它正在执行的调用栈
+        threshold = self.threshold_ms / 1000 + self.interval
+        captured_beat = None
+        while not self._stopped.wait(min(self.interval, threshold) / 2):
+            beat = self._beat
+            stalled_for = time.monotonic() - beat
+            if stalled_for < threshold or beat == captured_beat:
+                continue
+            captured_beat = beat
+            try:
+                self._capture(stalled_for * 1000)
+            except Exception as e:
+                logger.warning(f"事件循环阻塞栈采集失败: {e}")
+
+    def _capture(self, stalled_ms: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT))
+        requests = [
+            {
+                'route': trace.route,
+                'elapsedMs': round(trace.elapsed_ms(), 2),
+                'phases': {name: round(duration, 2) for name, duration in list(trace.phases.items())},
+                'model': trace.attributes.get('model'),
+                'tokenId': trace.attributes.get('tokenId'),
+                'clientKey': trace.attributes.get('clientKey')
+            }
+            for trace in in_flight.active()
+        ]
+        self.stall_count += 1
+        self._stalls.append({
+            'capturedAt': time.time(),
+            'stalledMs': round(stalled_ms, 2),
+            'stack': stack,
+            'inFlight': requests
+        })
+        summary = ', '.join(f"{request['route']}({request['elapsedMs']}ms)" for request in requests[:10]) or '无'
+        logger.warning(f"事件循环已阻塞 {stalled_ms:.0f} ms，进行中的请求: {summary}\n{stack}")
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+        if self._watchdog:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._samples)
+        return {
+            'enabled': self.enabled,
+            'thresholdMs': self.threshold_ms,
+            'lastLagMs': round(self._samples[-1], 2) if self._samples else None,
+            'p50LagMs': round(samples[len(samples) // 2], 2) if samples else None,
+            'p99LagMs': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2) if samples else None,
+            'maxLagMs': round(self.max_lag_ms, 2),
+            'stalls': self.stall_count
+        }
+
+    def recent_stalls(self) -> List[Dict[str, Any]]:
+        return list(reversed(self._stalls))
+
+
+loop_monitor = LoopMonitor()
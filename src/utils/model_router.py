@@ -0,0 +1,83 @@
+"""
+Latency-aware virtual model routing for Qwen Code API Server
+"""
+import time
+from typing import Dict, Any, Optional
+
+from .request_trace import in_flight
+from .context_window import get_context_limit
+from ..config.settings import (
+    AUTO_MODEL_NAME,
+    AUTO_MODEL_TTFB_SLO_MS,
+    AUTO_MODEL_SMALL_PROMPT_TOKENS,
+    AUTO_MODEL_MAX_IN_FLIGHT
+)
+
+PLUS_MODEL = "qwen3-coder-plus"
+FLASH_MODEL = "qwen3-coder-flash"
+EWMA_ALPHA = 0.2
+# 超过该时间没有新样本的延迟估计视为过期，让被切走的模型有机会重新接流量
+EWMA_STALE_SECONDS = 30
+
+
+class ModelRouter:
+
+    def __init__(self, slo_ms: float = AUTO_MODEL_TTFB_SLO_MS,
+                 small_prompt_tokens: int = AUTO_MODEL_SMALL_PROMPT_TOKENS,
+                 max_in_flight: int = AUTO_MODEL_MAX_IN_FLIGHT):
+        self.slo_ms = slo_ms
+        self.small_prompt_tokens = small_prompt_tokens
+        self.max_in_flight = max_in_flight
+        self._ewma_ttfb: Dict[str, float] = {}
+        self._observed_at: Dict[str, float] = {}
+        self.routed: Dict[str, int] = {PLUS_MODEL: 0, FLASH_MODEL: 0}
+
+    def observe(self, model: str, ttfb_ms: float) -> None:
+        if model not in self.routed:
+            return
+        previous = self._ewma_ttfb.get(model)
+        self._ewma_ttfb[model] = ttfb_ms if previous is None else previous + EWMA_ALPHA * (ttfb_ms - previous)
+        self._observed_at[model] = time.monotonic()
+
+    def depth(self, model: str) -> int:
+        return sum(1 for trace in in_flight.active() if trace.attributes.get('model') == model)
+
+    def over_slo(self, model: str) -> bool:
+        ewma = self._ewma_ttfb.get(model)
+        if ewma is not None and time.monotonic() - self._observed_at[model] > EWMA_STALE_SECONDS:
+            ewma = None
+        return (ewma is not None and ewma > self.slo_ms) or self.depth(model) >= self.max_in_flight
+
+    def route(self, prompt_tokens: int) -> str:
+        # 短提示优先 flash，长上下文优先 plus；首选模型超出 SLO 或排队过深时切换到另一个
+        preferred, fallback = (FLASH_MODEL, PLUS_MODEL) if prompt_tokens <= self.small_prompt_tokens else (PLUS_MODEL, FLASH_MODEL)
+
+        fallback_limit = get_context_limit(fallback)
+        fallback_fits = fallback_limit is None or prompt_tokens <= fallback_limit
+        model = preferred
+        if fallback_fits and self.over_slo(preferred) and not self.over_slo(fallback):
+            model = fallback
+
+        self.routed[model] += 1
+        return model
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'model': AUTO_MODEL_NAME,
+            'sloMs': self.slo_ms,
+            'targets': {
+                model: {
+                    'ewmaTtfbMs': round(self._ewma_ttfb[model], 2) if model in self._ewma_ttfb else None,
+                    'inFlight': self.depth(model),
+                    'routed': routed
+                }
+                for model, routed in self.routed.items()
+            }
+        }
+
+
+def is_auto_model(model: Optional[str]) -> bool:
+    return bool(AUTO_MODEL_NAME) and model == AUTO_MODEL_NAME
+
+
+model_router = ModelRouter()
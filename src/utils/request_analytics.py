@@ -0,0 +1,280 @@
+"""
+Per-request analytics segments for Qwen Code API Server
+"""
+import os
+import glob
+import time
+import queue
+import struct
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from ..config.settings import (
+    ANALYTICS_DIR,
+    ANALYTICS_SEGMENT_MAX_BYTES,
+    ANALYTICS_SEGMENT_MAX_SECONDS,
+    ANALYTICS_RETENTION_DAYS,
+    WORKER_ID
+)
+
+logger = logging.getLogger(__name__)
+
+# 段文件头：魔数、格式版本、记录长度、创建时间
+SEGMENT_HEADER = struct.Struct('<4sHHd')
+SEGMENT_MAGIC = b'QRA1'
+SEGMENT_VERSION = 1
+# 定长记录，可直接按 numpy dtype / Arrow 定长列映射：
+# 开始时间, 总耗时, 首字节耗时, 提示 Token, 生成 Token, 上游状态码, 结果, 是否流式, 模型, Token ID, 客户端标识
+RECORD = struct.Struct('<dffIIHBB24s16s12s')
+RECORD_FIELDS = ('ts', 'durationMs', 'ttfbMs', 'promptTokens', 'completionTokens', 'upstreamStatus',
+                 'outcome', 'stream', 'model', 'tokenId', 'clientKey')
+OUTCOMES = ('ok', 'error', 'context_length_exceeded', 'cancelled', 'rejected')
+UNKNOWN_OUTCOME = 255
+GROUP_FIELDS = ('model', 'token', 'client', 'outcome', 'promptBucket')
+SEGMENT_PATTERN = 'requests-*.seg'
+# 记录按请求开始时间标记、在结束时写入，段文件里可能有早于段创建时间的长请求
+MAX_REQUEST_SECONDS = 3600
+WRITE_BATCH = 512
+
+
+def _text(value: Optional[str], size: int) -> bytes:
+    return (value or '').encode('utf-8')[:size]
+
+
+def _decode(value: bytes) -> str:
+    return value.rstrip(b'\0').decode('utf-8', 'ignore')
+
+
+def prompt_bucket(tokens: int) -> str:
+    # 按 2 的幂分桶，便于观察延迟随提示长度的变化
+    upper = 256
+    while tokens > upper:
+        upper *= 2
+    return f"<={upper}"
+
+
+def _summary(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {'avg': None, 'p50': None, 'p95': None, 'max': None}
+    values.sort()
+    return {
+        'avg': round(sum(values) / len(values), 2),
+        'p50': round(values[int(len(values) * 0.5)], 2),
+        'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+        'max': round(values[-1], 2)
+    }
+
+
+class RequestAnalytics:
+
+    def __init__(self, directory: str = ANALYTICS_DIR, segment_max_bytes: int = ANALYTICS_SEGMENT_MAX_BYTES,
+                 segment_max_seconds: float = ANALYTICS_SEGMENT_MAX_SECONDS,
+                 retention_days: float = ANALYTICS_RETENTION_DAYS, writer: int = WORKER_ID):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.retention_days = retention_days
+        # 多进程时每个工作进程写各自的段序列，文件名带进程编号，查询时合并读取
+        self.writer = writer
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._segment_started = 0.0
+        self.records_written = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self.enabled or not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name="request-analytics", daemon=True)
+        self._thread.start()
+        logger.info(f"请求分析日志已启用: {self.directory}")
+
+    def record(self, trace) -> None:
+        if self._thread is None:
+            return
+        attributes = trace.attributes
+        model = attributes.get('model')
+        if not model:
+            return
+
+        ttfb = attributes.get('firstTokenMs', trace.phases.get('upstream_ttfb'))
+        outcome = attributes.get('outcome')
+        # 调用方只做一次定长打包，文件写入全部在后台线程完成
+        self._queue.put(RECORD.pack(
+            trace.started_at,
+            trace.duration_ms,
+            ttfb if ttfb is not None else -1.0,
+            attributes.get('promptTokens') or 0,
+            attributes.get('completionTokens') or 0,
+            attributes.get('upstreamStatus') or 0,
+            OUTCOMES.index(outcome) if outcome in OUTCOMES else UNKNOWN_OUTCOME,
+            1 if attributes.get('stream') else 0,
+            _text(model, 24),
+            _text(attributes.get('tokenId'), 16),
+            _text(attributes.get('clientKey'), 12)
+        ))
+
+    def _open_segment(self) -> None:
+        if self._file:
+            self._file.close()
+        self._segment_started = time.time()
+        suffix = f"-{self.writer}" if self.writer else ""
+        path = os.path.join(self.directory, f"requests-{int(self._segment_started * 1000)}{suffix}.seg")
+        self._file = open(path, 'ab')
+        self._file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, RECORD.size, self._segment_started))
+        self._prune()
+
+    def _prune(self) -> None:
+        if self.retention_days <= 0:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        segments = [segment for segment in self.segments() if segment[2] == self.writer]
+        # 段文件覆盖到同一进程下一个段的开始时间，只有下一个段也早于保留期时才能删除
+        for (path, _, _), (_, next_started, _) in zip(segments, segments[1:]):
+            if next_started < cutoff:
+                os.remove(path)
+
+    def _needs_rotation(self) -> bool:
+        return (
+            self._file is None
+            or self._file.tell() >= self.segment_max_bytes
+            or (self.segment_max_seconds > 0 and time.time() - self._segment_started >= self.segment_max_seconds)
+        )
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = False
+                    break
+            try:
+                if batch:
+                    if self._needs_rotation():
+                        self._open_segment()
+                    self._file.write(b''.join(batch))
+                    # 每批写完即刷到操作系统，查询能读到完整记录
+                    self._file.flush()
+                    self.records_written += len(batch)
+            except Exception as e:
+                logger.error(f"请求分析日志写入失败: {e}")
+            if item is None:
+                break
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def segments(self) -> List[Tuple[str, float, int]]:
+        # (路径, 段开始时间, 写入进程编号)，旧版不带编号的文件视为进程 0
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, SEGMENT_PATTERN)):
+            started, _, writer = os.path.basename(path)[len('requests-'):-len('.seg')].partition('-')
+            try:
+                segments.append((path, int(started) / 1000, int(writer or 0)))
+            except ValueError:
+                continue
+        return sorted(segments, key=lambda segment: segment[1])
+
+    def scan(self, start: float, end: float):
+        segments = self.segments()
+        next_started: Dict[str, float] = {}
+        latest: Dict[int, float] = {}
+        for path, started, writer in reversed(segments):
+            next_started[path] = latest.get(writer, float('inf'))
+            latest[writer] = started
+        for path, started, _ in segments:
+            ends = next_started[path]
+            if ends <= start or started - MAX_REQUEST_SECONDS >= end:
+                continue
+            with open(path, 'rb') as f:
+                header = f.read(SEGMENT_HEADER.size)
+                if len(header) < SEGMENT_HEADER.size:
+                    continue
+                magic, version, record_size, _ = SEGMENT_HEADER.unpack(header)
+                if magic != SEGMENT_MAGIC or record_size != RECORD.size:
+                    logger.warning(f"跳过无法识别的分析段文件: {path}")
+                    continue
+                data = f.read()
+            # 正在写入的段末尾可能有半条记录
+            data = data[:len(data) - len(data) % RECORD.size]
+            for row in RECORD.iter_unpack(data):
+                if start <= row[0] < end:
+                    yield row
+
+    def query(self, start: float, end: float, group_by: List[str], filters: Dict[str, str]) -> Dict[str, Any]:
+        groups: Dict[Tuple, Dict[str, Any]] = {}
+        scanned = 0
+        for row in self.scan(start, end):
+            scanned += 1
+            ts, duration, ttfb, prompt, completion, status, outcome, stream, model, token_id, client_key = row
+            fields = {
+                'model': _decode(model),
+                'token': _decode(token_id),
+                'client': _decode(client_key),
+                'outcome': OUTCOMES[outcome] if outcome < len(OUTCOMES) else 'unknown',
+                'promptBucket': prompt_bucket(prompt)
+            }
+            if any(fields[name] != value for name, value in filters.items()):
+                continue
+
+            key = tuple(fields[name] for name in group_by)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {'count': 0, 'errors': 0, 'stream': 0, 'durationMs': [], 'ttfbMs': [],
+                                       'promptTokens': [], 'completionTokens': []}
+            group['count'] += 1
+            group['errors'] += outcome != 0
+            group['stream'] += stream
+            group['durationMs'].append(duration)
+            if ttfb >= 0:
+                group['ttfbMs'].append(ttfb)
+            group['promptTokens'].append(prompt)
+            group['completionTokens'].append(completion)
+
+        return {
+            'scanned': scanned,
+            'groups': [
+                {
+                    'key': dict(zip(group_by, key)),
+                    'count': group['count'],
+                    'errors': group['errors'],
+                    'stream': group['stream'],
+                    'durationMs': _summary(group['durationMs']),
+                    'ttfbMs': _summary(group['ttfbMs']),
+                    'promptTokens': _summary(group['promptTokens']),
+                    'completionTokens': _summary(group['completionTokens'])
+                }
+                for key, group in sorted(groups.items(), key=lambda item: -item[1]['count'])
+            ]
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'recordSize': RECORD.size,
+            'recordsWritten': self.records_written,
+            'pendingWrites': self._queue.qsize(),
+            'segments': len(self.segments()) if self.directory and os.path.isdir(self.directory) else 0
+        }
+
+
+request_analytics = RequestAnalytics()
@@ -0,0 +1,129 @@
+"""
+Per-request phase timing for Qwen Code API Server
+"""
+import time
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Callable
+
+from .access_log import access_log
+from .request_analytics import request_analytics
+from ..config.settings import SLOW_REQUEST_WINDOW
+
+
+class RequestTrace:
+
+    def __init__(self, route: str = "", priority: str = "interactive"):
+        self.route = route
+        self.priority = priority
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.attributes: Dict[str, Any] = {}
+        self.duration_ms: Optional[float] = None
+        self._finalizers: List[Callable[[], None]] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.duration_ms is not None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, (time.perf_counter() - start) * 1000)
+
+    def add_phase(self, name: str, duration_ms: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + duration_ms
+
+    def add_finalizer(self, callback: Callable[[], None]) -> None:
+        self._finalizers.append(callback)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def server_timing(self) -> str:
+        # Server-Timing 只能随响应头发出，流式响应的 relay 阶段只记录在慢请求日志中
+        entries = [f"{name};dur={duration:.2f}" for name, duration in self.phases.items()]
+        entries.append(f"total;dur={self.elapsed_ms():.2f}")
+        return ", ".join(entries)
+
+    def finish(self, outcome: str = "ok") -> None:
+        if self.finished:
+            return
+        self.duration_ms = self.elapsed_ms()
+        self.attributes.setdefault('outcome', outcome)
+        for callback in self._finalizers:
+            callback()
+        in_flight.discard(self)
+        slow_request_log.record(self)
+        access_log.record(self)
+        request_analytics.record(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'route': self.route,
+            'priority': self.priority,
+            'startedAt': self.started_at,
+            'durationMs': round(self.duration_ms if self.finished else self.elapsed_ms(), 2),
+            'phases': {name: round(duration, 2) for name, duration in self.phases.items()},
+            **self.attributes
+        }
+
+
+class SlowRequestLog:
+
+    def __init__(self, window: int = SLOW_REQUEST_WINDOW):
+        self._recent = deque(maxlen=window)
+
+    def record(self, trace: RequestTrace) -> None:
+        self._recent.append(trace.to_dict())
+
+    def slowest(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return sorted(self._recent, key=lambda item: item['durationMs'], reverse=True)[:limit]
+
+    def __len__(self) -> int:
+        return len(self._recent)
+
+
+class InFlightRequests:
+
+    def __init__(self):
+        self._active: Dict[int, RequestTrace] = {}
+        self._waiters: List[asyncio.Future] = []
+
+    def add(self, trace: RequestTrace) -> None:
+        self._active[id(trace)] = trace
+
+    def discard(self, trace: RequestTrace) -> None:
+        if self._active.pop(id(trace), None) is None:
+            return
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def count(self, priority: Optional[str] = None) -> int:
+        if priority is None:
+            return len(self._active)
+        return sum(1 for trace in self._active.values() if trace.priority == priority)
+
+    def active(self) -> List[RequestTrace]:
+        return list(self._active.values())
+
+    async def wait_below(self, limit: int) -> None:
+        # 返回后调用方需在下一次 await 之前登记请求，否则其他协程可能抢占名额
+        while len(self._active) >= limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+
+slow_request_log = SlowRequestLog()
+in_flight = InFlightRequests()
@@ -0,0 +1,174 @@
+"""
+On-demand sampling profiler for Qwen Code API Server
+"""
+import os
+import sys
+import time
+import marshal
+import asyncio
+import threading
+from collections import Counter
+from typing import Dict, Any, List, Tuple
+
+from ..config.settings import PROFILE_MAX_SECONDS
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(PACKAGE_DIR, 'api') + os.sep
+# 事件循环空闲时停留的位置，这些样本默认不计入结果
+IDLE_FRAMES = {
+    ('selectors', 'select'),
+    ('selectors', 'poll'),
+    ('base_events', 'run_forever'),
+    ('base_events', 'run_until_complete'),
+    ('runners', 'run')
+}
+IDLE_LABEL = 'idle'
+OTHER_LABEL = 'other'
+STACK_LIMIT = 128
+TOP_FUNCTIONS = 30
+
+
+def _module(filename: str) -> str:
+    if filename.startswith(PACKAGE_DIR + os.sep):
+        return os.path.splitext(os.path.relpath(filename, PACKAGE_DIR))[0].replace(os.sep, '.')
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _frame_name(code) -> str:
+    return f"{_module(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _attribute(stack: Tuple) -> str:
+    # 归属到最外层的路由处理函数；后台任务归属到最外层的本项目函数
+    for code in stack:
+        if code.co_filename.startswith(API_DIR):
+            return _frame_name(code)
+    for code in stack:
+        if code.co_filename.startswith(PACKAGE_DIR):
+            return _frame_name(code)
+    if not stack or (_module(stack[-1].co_filename), stack[-1].co_name) in IDLE_FRAMES:
+        return IDLE_LABEL
+    return OTHER_LABEL
+
+
+class Profile:
+
+    def __init__(self, stacks: Counter, interval: float, duration: float, include_idle: bool):
+        self.interval = interval
+        self.duration = duration
+        self.samples = sum(stacks.values())
+        self.idle_samples = 0
+        # (归属, 调用栈) -> 样本数，调用栈从外到内排列
+        self.stacks: Dict[Tuple[str, Tuple], int] = {}
+        for stack, count in stacks.items():
+            label = _attribute(stack)
+            if label == IDLE_LABEL:
+                self.idle_samples += count
+                if not include_idle:
+                    continue
+            key = (label, stack)
+            self.stacks[key] = self.stacks.get(key, 0) + count
+
+    def collapsed(self) -> str:
+        # Brendan Gregg 折叠栈格式，可直接交给 flamegraph.pl / speedscope
+        lines = Counter()
+        for (label, stack), count in self.stacks.items():
+            lines[';'.join([label] + [_frame_name(code) for code in stack])] += count
+        return ''.join(f"{line} {count}\n" for line, count in sorted(lines.items()))
+
+    def pstats(self) -> bytes:
+        # 按 cProfile 的 stats 结构换算：样本数作调用次数，样本数 × 采样间隔作耗时
+        stats: Dict[Tuple, List] = {}
+        for (label, stack), count in self.stacks.items():
+            elapsed = count * self.interval
+            keys = [('~', 0, f"<{label}>")] + [(code.co_filename, code.co_firstlineno, code.co_name) for code in stack]
+            seen = set()
+            for index, key in enumerate(keys):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                innermost = index == len(keys) - 1
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += elapsed
+                if innermost:
+                    entry[2] += elapsed
+                if index:
+                    edge = entry[4].setdefault(keys[index - 1], [0, 0, 0.0, 0.0])
+                    edge[0] += count
+                    edge[1] += count
+                    edge[3] += elapsed
+                    if innermost:
+                        edge[2] += elapsed
+        return marshal.dumps({
+            key: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+            for key, (cc, nc, tt, ct, callers) in stats.items()
+        })
+
+    def summary(self) -> Dict[str, Any]:
+        handlers = Counter()
+        self_counts = Counter()
+        total_counts = Counter()
+        for (label, stack), count in self.stacks.items():
+            handlers[label] += count
+            if stack:
+                self_counts[_frame_name(stack[-1])] += count
+            for name in {_frame_name(code) for code in stack}:
+                total_counts[name] += count
+        counted = sum(handlers.values()) or 1
+        return {
+            'durationMs': round(self.duration * 1000, 2),
+            'intervalMs': round(self.interval * 1000, 2),
+            'samples': self.samples,
+            'idleSamples': self.idle_samples,
+            'handlers': [
+                {'handler': label, 'samples': count, 'percent': round(count * 100 / counted, 2)}
+                for label, count in handlers.most_common()
+            ],
+            'topFunctions': [
+                {'function': name, 'selfSamples': count, 'totalSamples': total_counts[name]}
+                for name, count in self_counts.most_common(TOP_FUNCTIONS)
+            ]
+        }
+
+
+class SamplingProfiler:
+
+    def __init__(self, max_seconds: float = PROFILE_MAX_SECONDS):
+        self.max_seconds = max_seconds
+        self.running = False
+
+    async def profile(self, seconds: float, interval: float, include_idle: bool = False) -> Profile:
+        # 只在事件循环线程里检查和设置，不需要额外加锁
+        if self.running:
+            raise RuntimeError("已有采样分析正在进行")
+        self.running = True
+        try:
+            stacks, duration = await asyncio.to_thread(
+                self._sample, threading.get_ident(), min(seconds, self.max_seconds), interval
+            )
+        finally:
+            self.running = False
+        return Profile(stacks, interval, duration, include_idle)
+
+    def _sample(self, thread_id: int, seconds: float, interval: float) -> Tuple[Counter, float]:
+        # 在独立线程里定时读取事件循环线程的调用栈，被分析的代码不需要任何插桩
+        stacks = Counter()
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_tick = started
+        while next_tick < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < STACK_LIMIT:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            del frame
+            stack.reverse()
+            stacks[tuple(stack)] += 1
+            next_tick += interval
+            time.sleep(max(0.0, next_tick - time.perf_counter()))
+        return stacks, time.perf_counter() - started
+
+
+sampling_profiler = SamplingProfiler()
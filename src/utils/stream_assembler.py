@@ -0,0 +1,86 @@
+"""
+Assemble streamed chat completion chunks into a single response
+"""
+import time
+from typing import Dict, Any, List, Optional
+
+
+class ChatCompletionAssembler:
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.created: Optional[int] = None
+        self.model: Optional[str] = None
+        self.system_fingerprint: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+        self.chunks = 0
+        self._choices: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, chunk: Dict[str, Any]) -> None:
+        self.chunks += 1
+        self.id = self.id or chunk.get('id')
+        self.created = self.created or chunk.get('created')
+        self.model = self.model or chunk.get('model')
+        self.system_fingerprint = self.system_fingerprint or chunk.get('system_fingerprint')
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+
+        for choice in chunk.get('choices') or []:
+            state = self._choices.setdefault(choice.get('index', 0), {
+                'role': 'assistant', 'content': [], 'reasoning_content': [], 'tool_calls': {}, 'finish_reason': None
+            })
+            delta = choice.get('delta') or {}
+            if delta.get('role'):
+                state['role'] = delta['role']
+            if delta.get('content'):
+                state['content'].append(delta['content'])
+            if delta.get('reasoning_content'):
+                state['reasoning_content'].append(delta['reasoning_content'])
+            for tool_call in delta.get('tool_calls') or []:
+                self._merge_tool_call(state['tool_calls'], tool_call)
+            if choice.get('finish_reason'):
+                state['finish_reason'] = choice['finish_reason']
+
+    @staticmethod
+    def _merge_tool_call(tool_calls: Dict[int, Dict[str, Any]], delta: Dict[str, Any]) -> None:
+        # 工具调用按 index 分片下发，名称与参数需要逐段拼接
+        call = tool_calls.setdefault(delta.get('index', len(tool_calls)), {
+            'id': None, 'type': 'function', 'function': {'name': '', 'arguments': ''}
+        })
+        if delta.get('id'):
+            call['id'] = delta['id']
+        if delta.get('type'):
+            call['type'] = delta['type']
+        function = delta.get('function') or {}
+        if function.get('name'):
+            call['function']['name'] += function['name']
+        if function.get('arguments'):
+            call['function']['arguments'] += function['arguments']
+
+    @property
+    def content(self) -> str:
+        return ''.join(''.join(state['content']) for state in self._choices.values())
+
+    def result(self) -> Dict[str, Any]:
+        choices: List[Dict[str, Any]] = []
+        for index in sorted(self._choices):
+            state = self._choices[index]
+            message: Dict[str, Any] = {'role': state['role'], 'content': ''.join(state['content'])}
+            if state['reasoning_content']:
+                message['reasoning_content'] = ''.join(state['reasoning_content'])
+            if state['tool_calls']:
+                message['tool_calls'] = [state['tool_calls'][key] for key in sorted(state['tool_calls'])]
+            choices.append({'index': index, 'message': message, 'finish_reason': state['finish_reason']})
+
+        result = {
+            'id': self.id,
+            'object': 'chat.completion',
+            'created': self.created or int(time.time()),
+            'model': self.model,
+            'choices': choices
+        }
+        if self.system_fingerprint:
+            result['system_fingerprint'] = self.system_fingerprint
+        if self.usage is not None:
+            result['usage'] = self.usage
+        return result
@@ -2,12 +2,14 @@
 Timezone utilities for Qwen Code API Server
 """
 import os
+from functools import lru_cache
 from datetime import datetime, date, timezone, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 
 from ..config.settings import TZ
 
 
+@lru_cache(maxsize=None)
 def get_local_timezone() -> timezone:
     if TZ == "UTC":
         return timezone.utc
@@ -67,6 +69,28 @@ def timestamp_to_local_datetime(timestamp: int) -> datetime:
     return utc_to_local(utc_dt)
 
 
+def local_bucket_start(timestamp: float, resolution: str) -> int:
+    # 分钟桶按绝对时间对齐，小时与天按本地时区对齐，和按日期统计的口径一致
+    if resolution == 'minute':
+        return int(timestamp // 60 * 60)
+    local_dt = datetime.fromtimestamp(timestamp, get_local_timezone())
+    if resolution == 'hour':
+        local_dt = local_dt.replace(minute=0, second=0, microsecond=0)
+    else:
+        local_dt = local_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(local_dt.timestamp())
+
+
+def local_day_range(day: str) -> Tuple[int, int]:
+    # 本地日期对应的 [当天零点, 次日零点) 时间戳，夏令时切换日不一定是 24 小时
+    start = int(datetime.fromisoformat(day).replace(tzinfo=get_local_timezone()).timestamp())
+    return start, local_bucket_start(start + 36 * 3600, 'day')
+
+
+def local_bucket_date(bucket: int) -> str:
+    return datetime.fromtimestamp(bucket, get_local_timezone()).date().isoformat()
+
+
 def get_timezone_offset_hours() -> float:
     local_tz = get_local_timezone()
     now = datetime.now(local_tz)
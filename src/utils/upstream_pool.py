@@ -0,0 +1,150 @@
+"""
+Warm upstream connection pool for Qwen Code API Server
+"""
+import time
+import asyncio
+import logging
+import aiohttp
+from typing import Dict, Any, Optional
+
+from ..config.settings import (
+    QWEN_API_ENDPOINT,
+    UPSTREAM_KEEPALIVE_TIMEOUT,
+    UPSTREAM_WARM_CONNECTIONS,
+    UPSTREAM_PING_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+PING_TIMEOUT = 5
+PING_CONTEXT = {'ping': True}
+
+
+class UpstreamPool:
+
+    def __init__(self, endpoint: str = QWEN_API_ENDPOINT, warm_connections: int = UPSTREAM_WARM_CONNECTIONS,
+                 keepalive_timeout: float = UPSTREAM_KEEPALIVE_TIMEOUT, ping_interval: float = UPSTREAM_PING_INTERVAL):
+        self.endpoint = endpoint
+        self.warm_connections = warm_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.ping_interval = ping_interval
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._ping_task: Optional[asyncio.Task] = None
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.pings = 0
+        self.ping_failures = 0
+        self.consecutive_ping_failures = 0
+        self.last_ping_at: Optional[float] = None
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        # 保活请求不计入复用率，只统计真实转发的请求
+        async def on_connection_create_end(session, context, params):
+            if context.trace_request_ctx is not PING_CONTEXT:
+                self.connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            if context.trace_request_ctx is not PING_CONTEXT:
+                self.connections_reused += 1
+
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=50,
+                ttl_dns_cache=300,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout,
+                enable_cleanup_closed=True
+            )
+            timeout = aiohttp.ClientTimeout(total=30, connect=5)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                connector_owner=True,
+                trace_configs=[self._trace_config()]
+            )
+        return self._session
+
+    async def _ping(self, session: aiohttp.ClientSession) -> None:
+        timeout = aiohttp.ClientTimeout(total=PING_TIMEOUT)
+        async with session.head(self.endpoint, timeout=timeout, trace_request_ctx=PING_CONTEXT) as response:
+            await response.release()
+
+    async def warm(self) -> int:
+        # 并发发出 HEAD 请求，每个请求占用一条独立连接，结束后全部归还到空闲池
+        session = await self.get_session()
+        count = max(1, self.warm_connections - self.in_use())
+        results = await asyncio.gather(*(self._ping(session) for _ in range(count)), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+
+        self.pings += count
+        self.ping_failures += len(failures)
+        self.last_ping_at = time.time()
+        if len(failures) == count:
+            self.consecutive_ping_failures += 1
+            raise failures[0]
+        self.consecutive_ping_failures = 0
+        return count - len(failures)
+
+    def start(self) -> None:
+        if self.warm_connections <= 0 or self.ping_interval <= 0:
+            return
+        if self._ping_task is None or self._ping_task.done():
+            self._ping_task = asyncio.create_task(self._ping_loop())
+
+    async def _ping_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                await self.warm()
+            except Exception as e:
+                logger.warning(f"上游连接保活失败: {e}")
+
+    def idle(self) -> int:
+        connector = self._session.connector if self._session and not self._session.closed else None
+        if connector is None:
+            return 0
+        return sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+
+    def in_use(self) -> int:
+        connector = self._session.connector if self._session and not self._session.closed else None
+        if connector is None:
+            return 0
+        return len(getattr(connector, '_acquired', ()))
+
+    def stats(self) -> Dict[str, Any]:
+        connects = self.connections_created + self.connections_reused
+        return {
+            'warmTarget': self.warm_connections,
+            'idle': self.idle(),
+            'inUse': self.in_use(),
+            'connectionsCreated': self.connections_created,
+            'connectionsReused': self.connections_reused,
+            'reuseRatio': round(self.connections_reused / connects, 4) if connects else None,
+            'pings': self.pings,
+            'pingFailures': self.ping_failures,
+            'consecutivePingFailures': self.consecutive_ping_failures,
+            'lastPingAt': self.last_ping_at
+        }
+
+    async def close(self) -> None:
+        if self._ping_task:
+            self._ping_task.cancel()
+            try:
+                await self._ping_task
+            except asyncio.CancelledError:
+                pass
+            self._ping_task = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+upstream_pool = UpstreamPool()
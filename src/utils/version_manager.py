@@ -19,12 +19,16 @@ class VersionManager:
         self.db = db
         self._cached_version: Optional[str] = None
         self._cache_timestamp: Optional[float] = None
+        # 启动时的版本号在后台刷新成功之前一直有效，请求路径不会去等待注册表超时
+        self._awaiting_refresh = False
         self._lock = asyncio.Lock()
     
     async def get_version(self) -> str:
         if self._is_cache_valid():
             return self._cached_version
-        
+        return await self._fetch_version()
+    
+    async def _fetch_version(self) -> str:
         try:
             version = await asyncio.wait_for(
                 self._get_version_with_retry(), 
@@ -65,11 +69,17 @@ class VersionManager:
         
         return self.DEFAULT_VERSION
     
+    def load_persisted_version(self) -> str:
+        # 启动时直接使用数据库中的版本号（没有时用默认版本号），注册表请求放到后台执行
+        self._cached_version = self.db.get_app_version() or self.DEFAULT_VERSION
+        self._cache_timestamp = time.time()
+        self._awaiting_refresh = True
+        return self._cached_version
+    
     async def refresh_version(self) -> str:
+        # 获取失败时保留当前缓存，不清空后让后续请求各自重试注册表
         async with self._lock:
-            self._cached_version = None
-            self._cache_timestamp = None
-            return await self.get_version()
+            return await self._fetch_version()
     
     async def get_user_agent_async(self) -> str:
         try:
@@ -96,6 +106,8 @@ class VersionManager:
     def _is_cache_valid(self) -> bool:
         if not self._cached_version or not self._cache_timestamp:
             return False
+        if self._awaiting_refresh:
+            return True
         return time.time() - self._cache_timestamp < self.CACHE_TTL
     
     async def _fetch_version_from_registry(self) -> Optional[str]:
@@ -120,6 +132,7 @@ class VersionManager:
     async def _update_cache_and_storage(self, version: str):
         self._cached_version = version
         self._cache_timestamp = time.time()
+        self._awaiting_refresh = False
         self.db.save_app_version(version)
 
 
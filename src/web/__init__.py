@@ -2,5 +2,6 @@
 Web interface module for Qwen Code API Server
 """
 from .web_routes import router as web_router
+from .static_assets import preload_static_assets
 
-__all__ = ['web_router']
\ No newline at end of file
+__all__ = ['web_router', 'preload_static_assets']
\ No newline at end of file
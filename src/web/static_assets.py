@@ -0,0 +1,191 @@
+"""
+In-memory precompressed static assets for the web interface
+"""
+import os
+import re
+import gzip
+import asyncio
+import hashlib
+import threading
+import mimetypes
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+MIN_COMPRESS_SIZE = 1024
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+_STATIC_URL = re.compile(r'(["\'])/static/([^"\'?#]+)\1')
+
+
+@dataclass
+class StaticAsset:
+    content: bytes
+    media_type: str
+    digest: str
+    encoded: Dict[str, bytes] = field(default_factory=dict)
+
+    @classmethod
+    def build(cls, content: bytes, media_type: str) -> 'StaticAsset':
+        asset = cls(content, media_type, hashlib.sha256(content).hexdigest()[:16])
+        if len(content) >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                asset.encoded['br'] = brotli.compress(content, quality=11)
+            asset.encoded['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+        return asset
+
+    def etag(self, encoding: Optional[str] = None) -> str:
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+    def select_encoding(self, weights: Dict[str, float]) -> Optional[str]:
+        best, best_weight = None, 0.0
+        # 权重相同时优先 br；q=0 表示客户端明确拒绝该编码
+        for encoding in ('br', 'gzip'):
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if encoding in self.encoded and weight > best_weight:
+                best, best_weight = encoding, weight
+        return best
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        weights = _parse_accept_encoding(request.headers.get('accept-encoding', ''))
+        encoding = self.select_encoding(weights)
+        if encoding is None and _rejects_identity(weights):
+            # 客户端拒绝未压缩内容（identity;q=0）：未预压缩的小文件当场压缩，仍无可接受的编码时返回 406
+            if weights.get('gzip', weights.get('*', 0.0)) <= 0:
+                return Response(status_code=406, headers={'Vary': 'Accept-Encoding'})
+            encoding = 'gzip'
+        etag = self.etag(encoding)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding'
+        }
+
+        if _etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=headers)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        body = self.content
+        if encoding:
+            body = self.encoded.get(encoding) or gzip.compress(self.content, compresslevel=9, mtime=0)
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+
+def _parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    return weights
+
+
+def _rejects_identity(weights: Dict[str, float]) -> bool:
+    # 未提及 identity 时它总是可接受的，除非 * 的权重为 0
+    return weights.get('identity', weights.get('*', 1.0)) <= 0
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+
+def _load_static_assets() -> Dict[str, StaticAsset]:
+    assets = {}
+    if not os.path.isdir(STATIC_DIR):
+        return assets
+
+    for root, _, files in os.walk(STATIC_DIR):
+        for name in files:
+            full_path = os.path.join(root, name)
+            relative_path = os.path.relpath(full_path, STATIC_DIR).replace(os.sep, '/')
+            media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            with open(full_path, 'rb') as f:
+                assets[relative_path] = StaticAsset.build(f.read(), media_type)
+    return assets
+
+
+_static_assets: Optional[Dict[str, StaticAsset]] = None
+_template_assets: Dict[str, StaticAsset] = {}
+# 最高级别的 br/gzip 压缩耗时较长，只在线程中执行一次
+_build_lock = threading.RLock()
+
+
+def get_static_asset(path: str) -> Optional[StaticAsset]:
+    global _static_assets
+    if _static_assets is None:
+        with _build_lock:
+            if _static_assets is None:
+                _static_assets = _load_static_assets()
+    return _static_assets.get(path)
+
+
+def get_template_asset(template_path: str) -> StaticAsset:
+    asset = _template_assets.get(template_path)
+    if asset is None:
+        with _build_lock:
+            asset = _template_assets.get(template_path)
+            if asset is None:
+                with open(os.path.join(BASE_DIR, template_path), 'r', encoding='utf-8') as f:
+                    html_content = f.read()
+                html_content = _STATIC_URL.sub(_versioned_url, html_content)
+                asset = StaticAsset.build(html_content.encode('utf-8'), 'text/html; charset=utf-8')
+                _template_assets[template_path] = asset
+    return asset
+
+
+async def load_static_asset(path: str) -> Optional[StaticAsset]:
+    if _static_assets is None:
+        return await asyncio.to_thread(get_static_asset, path)
+    return _static_assets.get(path)
+
+
+async def load_template_asset(template_path: str) -> StaticAsset:
+    asset = _template_assets.get(template_path)
+    if asset is None:
+        asset = await asyncio.to_thread(get_template_asset, template_path)
+    return asset
+
+
+async def preload_static_assets(template_path: str) -> int:
+    # 启动后在后台完成全部压缩，首个页面请求不必等待
+    await asyncio.to_thread(get_static_asset, '')
+    await load_template_asset(template_path)
+    return len(_static_assets)
+
+
+def _versioned_url(match: 're.Match') -> str:
+    # 模板中的静态资源地址附加内容哈希，便于浏览器长期缓存
+    quote, path = match.group(1), match.group(2)
+    asset = get_static_asset(path)
+    if asset is None:
+        return match.group(0)
+    return f'{quote}/static/{path}?v={asset.digest}{quote}'
@@ -2,22 +2,34 @@
 Web interface module for Qwen Code API Server
 """
 from fastapi import APIRouter, Request
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
-import os
+from fastapi.responses import HTMLResponse, Response
 
-router = APIRouter()
+from .static_assets import (
+    load_static_asset,
+    load_template_asset,
+    IMMUTABLE_CACHE_CONTROL,
+    REVALIDATE_CACHE_CONTROL
+)
+from ..config import HTML_TEMPLATE_PATH
 
-static_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'static')
+router = APIRouter()
 
 
 @router.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    template_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'templates', 'index.html')
-    
     try:
-        with open(template_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        return HTMLResponse(content=html_content)
+        asset = await load_template_asset(HTML_TEMPLATE_PATH)
     except FileNotFoundError:
-        return HTMLResponse(content="<h1>Template not found</h1><p>Please check the template path.</p>", status_code=404)
\ No newline at end of file
+        return HTMLResponse(content="<h1>Template not found</h1><p>Please check the template path.</p>", status_code=404)
+    return asset.response(request, REVALIDATE_CACHE_CONTROL)
+
+
+@router.api_route("/static/{file_path:path}", methods=["GET", "HEAD"])
+async def read_static(file_path: str, request: Request):
+    asset = await load_static_asset(file_path)
+    if asset is None:
+        return Response(status_code=404)
+
+    # 带内容哈希的地址永不变化，可以长期缓存
+    versioned = request.query_params.get('v') == asset.digest
+    return asset.response(request, IMMUTABLE_CACHE_CONTROL if versioned else REVALIDATE_CACHE_CONTROL)
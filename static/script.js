@@ -10,6 +10,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const tokenStatus = document.getElementById('token-status');
     const refreshTokenBtn = document.getElementById('refresh-token-btn');
     const deleteAllTokensBtn = document.getElementById('delete-all-tokens-btn');
+    const exportTokensBtn = document.getElementById('export-tokens-btn');
     const refreshStatus = document.getElementById('refresh-status');
     const messageInput = document.getElementById('message');
     const modelSelect = document.getElementById('model');
@@ -84,6 +85,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     loadAvailableDates();
                     checkTokenUsage(todayString);
                     setupEventListeners();
+                    startDashboardEvents();
                 } else {
                     // 密码无效，清除 localStorage
                     localStorage.removeItem('qwen_password');
@@ -216,6 +218,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 loadAvailableDates();
                 checkTokenUsage(todayString);
                 setupEventListeners();
+                startDashboardEvents();
 
                 setTimeout(() => {
                     loginStatus.style.display = 'none';
@@ -274,9 +277,52 @@ document.addEventListener('DOMContentLoaded', function() {
         manualOpenBtn.disabled = true;
     }
     
+    function isBulkTokenFile(name) {
+        return /\.(jsonl|zip|tar|tgz|tar\.gz)$/i.test(name);
+    }
+    
+    async function handleBulkFileUpload(file) {
+        showStatus(uploadStatus, '正在批量导入并校验 Token...', 'info');
+        try {
+            const response = await fetch('/api/upload-tokens', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'Authorization': 'Bearer ' + userPassword,
+                },
+                body: file,
+            });
+            
+            const data = await response.json();
+            
+            if (response.ok) {
+                let message = '成功导入 ' + data.imported + ' 个 Token';
+                if (data.validation) {
+                    message += '，校验通过 ' + data.validation.valid + ' 个，失效 ' + data.validation.invalid + ' 个';
+                }
+                if (data.errors && data.errors.length) {
+                    message += '，跳过 ' + data.errors.length + ' 条无效记录';
+                }
+                showStatus(uploadStatus, message, 'success');
+                checkTokenStatus();
+            } else {
+                showStatus(uploadStatus, data.error || data.detail || '导入失败', 'error');
+            }
+        } catch (error) {
+            showStatus(uploadStatus, '文件处理错误: ' + error.message, 'error');
+        } finally {
+            resetFileInput();
+        }
+    }
+    
     async function handleFileUpload(file) {
         if (!uploadStatus) return;
         
+        if (isBulkTokenFile(file.name)) {
+            await handleBulkFileUpload(file);
+            return;
+        }
+        
         if (file.name !== 'oauth_creds.json') {
             showStatus(uploadStatus, '请上传 oauth_creds.json 文件', 'error');
             resetFileInput();
@@ -415,11 +461,102 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // 通过 fetch 读取 SSE，便于携带 Authorization 头
+    async function streamServerEvents(url, onEvent, signal) {
+        const response = await fetch(url, {
+            headers: { 'Authorization': 'Bearer ' + userPassword },
+            signal: signal
+        });
+        if (!response.ok || !response.body) {
+            throw new Error('SSE连接失败: ' + response.status);
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let eventName = 'message';
+                const dataLines = [];
+                block.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).trim());
+                    }
+                });
+                if (dataLines.length) {
+                    onEvent(eventName, JSON.parse(dataLines.join('\n')));
+                }
+            }
+        }
+    }
+    
+    let dashboardEvents = null;
+    let tokenStatusTimer = null;
+    
+    function scheduleTokenStatus() {
+        // 批量导入等操作会连续触发事件，合并为一次查询
+        if (tokenStatusTimer) return;
+        tokenStatusTimer = setTimeout(() => {
+            tokenStatusTimer = null;
+            checkTokenStatus();
+        }, 300);
+    }
+    
+    function handleDashboardEvent(eventName, data) {
+        if (eventName === 'tokens' || eventName === 'refresh') {
+            scheduleTokenStatus();
+        } else if (eventName === 'usage') {
+            applyUsageDelta(data);
+        }
+    }
+    
+    function startDashboardEvents() {
+        if (dashboardEvents) return;
+        
+        const controller = new AbortController();
+        dashboardEvents = controller;
+        streamServerEvents('/api/events', handleDashboardEvent, controller.signal).catch(error => {
+            if (!controller.signal.aborted) {
+                console.error('面板事件流中断:', error);
+            }
+        }).finally(() => {
+            if (dashboardEvents !== controller || controller.signal.aborted) return;
+            // 服务端排空或重启后稍等再重连，重连时补一次全量状态
+            dashboardEvents = null;
+            setTimeout(() => {
+                startDashboardEvents();
+                checkTokenStatus();
+                if (usageView) checkTokenUsage(usageView.date);
+            }, 5000);
+        });
+    }
+    
     function startOAuthPolling() {
         if (!oauthStateId) return;
         
-        pollOAuthStatus();
-        oauthPollTimer = setInterval(pollOAuthStatus, 3000);
+        const controller = new AbortController();
+        oauthPollTimer = controller;
+        streamServerEvents('/api/oauth-events?stateId=' + encodeURIComponent(oauthStateId), (eventName, data) => {
+            handleOAuthStatus(data, true);
+        }, controller.signal).catch(error => {
+            if (controller.signal.aborted) return;
+            // 事件流不可用时退回到定时查询
+            console.error('OAuth事件流中断:', error);
+            if (oauthPollTimer === controller && oauthStateId) {
+                oauthPollTimer = setInterval(pollOAuthStatus, 3000);
+            }
+        });
     }
     
     function startOAuthCountdown() {
@@ -481,35 +618,43 @@ document.addEventListener('DOMContentLoaded', function() {
             });
             
             const data = await response.json();
-            
-            if (response.ok) {
-                if (data.success) {
-                    showStatus(oauthStatus, '🎉 OAuth 认证成功！Token 已自动保存', 'success');
-                    resetOAuthLogin();
-                    // 延迟500ms再检查token状态，确保数据库已更新
-                    setTimeout(checkTokenStatus, 500);
-                } else if (data.status === 'pending') {
-                    if (data.warning) {
-                        showStatus(oauthStatus, '⚠️ ' + data.warning, 'info');
-                    }
-                    if (!oauthCountdownTimer && oauthExpiresAt) {
-                        startOAuthCountdown();
-                    }
-                } else {
-                    showStatus(oauthStatus, data.error || 'OAuth 认证失败', 'error');
-                    resetOAuthLogin();
+            handleOAuthStatus(data, response.ok);
+        } catch (error) {
+            console.error('Failed to poll OAuth status:', error);
+        }
+    }
+    
+    function handleOAuthStatus(data, ok) {
+        if (!oauthStateId || !oauthStatus) return;
+        
+        if (ok) {
+            if (data.success) {
+                showStatus(oauthStatus, '🎉 OAuth 认证成功！Token 已自动保存', 'success');
+                resetOAuthLogin();
+                // 延迟500ms再检查token状态，确保数据库已更新
+                setTimeout(checkTokenStatus, 500);
+            } else if (data.status === 'pending') {
+                if (data.warning) {
+                    showStatus(oauthStatus, '⚠️ ' + data.warning, 'info');
+                }
+                if (!oauthCountdownTimer && oauthExpiresAt) {
+                    startOAuthCountdown();
                 }
             } else {
-                showStatus(oauthStatus, data.error || '轮询失败', 'error');
+                showStatus(oauthStatus, data.error || 'OAuth 认证失败', 'error');
                 resetOAuthLogin();
             }
-        } catch (error) {
-            console.error('Failed to load available dates:', error);
+        } else {
+            showStatus(oauthStatus, data.error || '轮询失败', 'error');
+            resetOAuthLogin();
         }
     }
     
     function resetOAuthLogin() {
-        if (oauthPollTimer) {
+        if (oauthPollTimer instanceof AbortController) {
+            oauthPollTimer.abort();
+            oauthPollTimer = null;
+        } else if (oauthPollTimer) {
             clearInterval(oauthPollTimer);
             oauthPollTimer = null;
         }
@@ -620,6 +765,10 @@ document.addEventListener('DOMContentLoaded', function() {
                 e.preventDefault();
                 refreshSingleToken(tokenId);
             }
+        } else if (target.classList.contains('btn-page')) {
+            e.preventDefault();
+            tokenPage = parseInt(target.getAttribute('data-page'), 10) || 1;
+            checkTokenStatus();
         } else if (target.classList.contains('btn-delete')) {
             const tokenId = decodeURIComponent(target.getAttribute('data-token-id') || '');
             if (tokenId) {
@@ -636,16 +785,62 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
     
+    document.addEventListener('change', function(e) {
+        if (e.target.id === 'token-filter') {
+            tokenFilter = e.target.value;
+            tokenPage = 1;
+            checkTokenStatus();
+        }
+    });
+    
+    const TOKEN_PAGE_SIZE = 50;
+    let tokenPage = 1;
+    let tokenFilter = 'all';
+    let tokenStatusEtag = null;
+    let tokenStatusCache = null;
+    
+    function renderTokenPager(data) {
+        let filterHtml = '<select id="token-filter" class="token-filter">';
+        [['all', '全部'], ['healthy', '有效'], ['cooling', '冷却中'], ['expired', '已过期']].forEach(function(option) {
+            const count = option[0] === 'all' ? data.tokenCount : (data.counts ? data.counts[option[0]] : 0);
+            filterHtml += '<option value="' + option[0] + '"' + (option[0] === tokenFilter ? ' selected' : '') + '>' + option[1] + ' (' + count + ')</option>';
+        });
+        filterHtml += '</select>';
+        
+        let pagerHtml = '<div class="token-pager">' + filterHtml;
+        if (data.pages > 1) {
+            pagerHtml += '<button class="btn-page" data-page="' + (data.page - 1) + '"' + (data.page <= 1 ? ' disabled' : '') + '>上一页</button>';
+            pagerHtml += '<span>第 ' + data.page + ' / ' + data.pages + ' 页</span>';
+            pagerHtml += '<button class="btn-page" data-page="' + (data.page + 1) + '"' + (data.page >= data.pages ? ' disabled' : '') + '>下一页</button>';
+        }
+        pagerHtml += '</div>';
+        return pagerHtml;
+    }
+    
     async function checkTokenStatus() {
         if (!tokenStatus || !refreshTokenBtn) return;
         
         try {
-            const response = await fetch('/api/token-status', {
-                headers: {
-                    'Authorization': 'Bearer ' + userPassword
-                }
-            });
+            const query = 'status=' + tokenFilter + '&page=' + tokenPage + '&pageSize=' + TOKEN_PAGE_SIZE;
+            const headers = {
+                'Authorization': 'Bearer ' + userPassword
+            };
+            if (tokenStatusEtag && tokenStatusCache && tokenStatusCache.query === query) {
+                headers['If-None-Match'] = tokenStatusEtag;
+            }
+            const response = await fetch('/api/token-status?' + query, { headers: headers });
+            // 304 表示 Token 池没有变化，沿用上次结果
+            if (response.status === 304) return;
             const data = await response.json();
+            if (response.ok) {
+                // 当前页在删除后可能已不存在，回退到最后一页
+                if (data.pages > 0 && tokenPage > data.pages) {
+                    tokenPage = data.pages;
+                    return checkTokenStatus();
+                }
+                tokenStatusEtag = response.headers.get('ETag');
+                tokenStatusCache = { query: query };
+            }
             
             if (response.ok && data.hasToken) {
                 let tokenListHtml = '';
@@ -654,8 +849,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     data.tokens.forEach(function(token) {
                         const expiresAt = token.expiresAtDisplay || (token.expiresAt ? new Date(token.expiresAt).toLocaleString() : '未知');
                         const uploadedAt = token.uploadedAtDisplay || (token.uploadedAt ? new Date(token.uploadedAt).toLocaleString() : '未知');
-                        const status = token.isExpired ? '已过期' : '有效';
-                        const statusClass = token.isExpired ? 'status-expired' : 'status-valid';
+                        const status = token.isExpired ? '已过期' : (token.isCooling ? '冷却中' : '有效');
+                        const statusClass = token.isExpired ? 'status-expired' : (token.isCooling ? 'status-cooling' : 'status-valid');
                         const refreshInfo = token.wasRefreshed ? ' (已自动刷新)' : (token.refreshFailed ? ' (刷新失败)' : '');
                         tokenListHtml += '<div class="token-card" data-token-id="' + encodeURIComponent(token.id) + '">';
                         tokenListHtml += '<div class="token-header">';
@@ -683,10 +878,18 @@ document.addEventListener('DOMContentLoaded', function() {
                 
                 let headerHtml = '<div class="token-summary-badges">';
                 headerHtml += `<div class="token-status status-info">🔢 Token总数: ${data.tokenCount}</div>`;
-                headerHtml += '<div class="token-status status-valid">📊 状态: 有效</div>';
+                if (data.counts) {
+                    headerHtml += `<div class="token-status status-valid">📊 有效: ${data.counts.healthy}</div>`;
+                    if (data.counts.cooling) {
+                        headerHtml += `<div class="token-status status-cooling">⏸ 冷却中: ${data.counts.cooling}</div>`;
+                    }
+                    if (data.counts.expired) {
+                        headerHtml += `<div class="token-status status-expired">⌛ 已过期: ${data.counts.expired}</div>`;
+                    }
+                }
                 headerHtml += '</div>';
 
-                tokenStatus.innerHTML = headerHtml + tokenListHtml;
+                tokenStatus.innerHTML = headerHtml + renderTokenPager(data) + tokenListHtml;
                 tokenStatus.style.display = 'block';
                 
                 const tokenStatusButtons = document.querySelector('.token-status-buttons');
@@ -739,6 +942,32 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    if (exportTokensBtn) {
+        exportTokensBtn.addEventListener('click', async function() {
+            try {
+                const response = await fetch('/api/export-tokens', {
+                    headers: {
+                        'Authorization': 'Bearer ' + userPassword,
+                    },
+                });
+                
+                if (!response.ok) {
+                    addStatusMessage('导出失败', 'error', 5000);
+                    return;
+                }
+                
+                const url = URL.createObjectURL(await response.blob());
+                const link = document.createElement('a');
+                link.href = url;
+                link.download = 'tokens.jsonl';
+                link.click();
+                URL.revokeObjectURL(url);
+            } catch (error) {
+                addStatusMessage('网络错误: ' + error.message, 'error', 5000);
+            }
+        });
+    }
+    
     if (deleteAllTokensBtn) {
         deleteAllTokensBtn.addEventListener('click', async function() {
             showConfirmDialog(
@@ -819,49 +1048,94 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    let usageView = null;
+
+    function applyUsageDelta(delta) {
+        if (!availableDates.has(delta.date)) {
+            availableDates.add(delta.date);
+            if (isDatePickerOpen) {
+                renderCalendar();
+            }
+        }
+        if (!usageView || usageView.date !== delta.date) return;
+
+        const data = usageView.data;
+        data.total_tokens_today += delta.tokens;
+        data.total_calls_today += delta.calls;
+        const usage = data.models[delta.model] || (data.models[delta.model] = { total_tokens: 0, call_count: 0 });
+        usage.total_tokens += delta.tokens;
+        usage.call_count += delta.calls;
+        renderTokenUsage(data);
+    }
+
+    function nextDateString(dateString) {
+        const [yyyy, mm, dd] = dateString.split('-').map(Number);
+        const next = new Date(yyyy, mm - 1, dd + 1);
+        return `${next.getFullYear()}-${String(next.getMonth() + 1).padStart(2, '0')}-${String(next.getDate()).padStart(2, '0')}`;
+    }
+
     async function checkTokenUsage(date = null) {
         if (!totalTokensToday || !modelUsageDetails || !tokenUsageStatus) return;
 
+        date = date || usageDateInput.value;
         try {
-            const url = date ? `/api/statistics/usage?date=${date}` : '/api/statistics/usage';
-            const response = await fetch(url, {
+            // 当天的天粒度时间序列即为分模型用量，与可用日期同样来自汇总表
+            const params = new URLSearchParams({ start: date, end: nextDateString(date), resolution: 'day', groupBy: 'model' });
+            const response = await fetch('/api/statistics/series?' + params, {
                 headers: {
                     'Authorization': 'Bearer ' + userPassword
                 }
             });
-            const data = await response.json();
+            const result = await response.json();
 
             if (response.ok) {
-                document.getElementById('total-tokens-today').textContent = data.total_tokens_today.toLocaleString();
-                document.getElementById('total-calls-today').textContent = data.total_calls_today.toLocaleString();
-
-                let detailsHtml = '';
-                if (Object.keys(data.models).length > 0) {
-                    detailsHtml = '<div class="token-list">';
-                    for (const [model, usage] of Object.entries(data.models)) {
-                        detailsHtml += `
-                            <div class="token-card usage-stats-card">
-                                <div class="usage-model-name">${model}</div>
-                                <div class="usage-stats-badges">
-                                    <div class="token-status status-tokens">Tokens: ${usage.total_tokens.toLocaleString()}</div>
-                                    <div class="token-status status-calls">调用: ${usage.call_count.toLocaleString()}</div>
-                                </div>
-                            </div>
-                        `;
-                    }
-                    detailsHtml += '</div>';
-                } else {
-                    detailsHtml = '<p>暂无分模型用量数据。</p>';
-                }
-                modelUsageDetails.innerHTML = detailsHtml;
-                tokenUsageStatus.style.display = 'none';
+                const data = {
+                    date: date,
+                    total_tokens_today: result.totals.tokens,
+                    total_calls_today: result.totals.calls,
+                    models: {}
+                };
+                result.series.forEach(entry => {
+                    data.models[entry.key.model] = {
+                        total_tokens: entry.points.reduce((sum, point) => sum + point[1], 0),
+                        call_count: entry.points.reduce((sum, point) => sum + point[2], 0)
+                    };
+                });
+                usageView = { date: date, data: data };
+                renderTokenUsage(data);
             } else {
-                showStatus(tokenUsageStatus, data.error || '获取用量失败', 'error');
+                showStatus(tokenUsageStatus, result.error || result.detail || '获取用量失败', 'error');
             }
         } catch (error) {
             showStatus(tokenUsageStatus, '网络错误: ' + error.message, 'error');
         }
     }
+
+    function renderTokenUsage(data) {
+        document.getElementById('total-tokens-today').textContent = data.total_tokens_today.toLocaleString();
+        document.getElementById('total-calls-today').textContent = data.total_calls_today.toLocaleString();
+
+        let detailsHtml = '';
+        if (Object.keys(data.models).length > 0) {
+            detailsHtml = '<div class="token-list">';
+            for (const [model, usage] of Object.entries(data.models)) {
+                detailsHtml += `
+                    <div class="token-card usage-stats-card">
+                        <div class="usage-model-name">${model}</div>
+                        <div class="usage-stats-badges">
+                            <div class="token-status status-tokens">Tokens: ${usage.total_tokens.toLocaleString()}</div>
+                            <div class="token-status status-calls">调用: ${usage.call_count.toLocaleString()}</div>
+                        </div>
+                    </div>
+                `;
+            }
+            detailsHtml += '</div>';
+        } else {
+            detailsHtml = '<p>暂无分模型用量数据。</p>';
+        }
+        modelUsageDetails.innerHTML = detailsHtml;
+        tokenUsageStatus.style.display = 'none';
+    }
     
     async function refreshSingleToken(tokenId) {
         const card = document.querySelector('[data-token-id="' + encodeURIComponent(tokenId) + '"]');
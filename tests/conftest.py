@@ -0,0 +1,10 @@
+"""Test configuration for Qwen Code API Server"""
+
+import os
+import sys
+import tempfile
+
+# 数据库路径在导入 src 之前确定，测试不触碰 data/ 下的真实数据
+os.environ['DATABASE_URL'] = os.path.join(tempfile.mkdtemp(), 'tokens.db')
+os.environ['API_PASSWORD'] = 'test'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
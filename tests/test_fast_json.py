@@ -0,0 +1,18 @@
+"""JSON helper tests for Qwen Code API Server"""
+
+import json
+
+from src.utils.fast_json import rewrite_object
+
+
+def test_rewrite_object_overrides_top_level_fields():
+    raw = '{"model":"a","messages":[{"role":"user","content":"你好"}],"stream":true}'.encode('utf-8')
+    result = json.loads(rewrite_object(raw, {'model': 'b', 'stream': False}))
+    assert result == {'model': 'b', 'stream': False, 'messages': [{'role': 'user', 'content': '你好'}]}
+
+
+def test_rewrite_object_escaped_keys():
+    raw = b'{"\\u006dodel":"a","\\u4e2d\\u6587":1,"caf\\u00e9":2,"messages":[]}'
+    result = rewrite_object(raw, {'model': 'b'})
+    assert json.loads(result) == {'model': 'b', '中文': 1, 'café': 2, 'messages': []}
+    assert result.count(b'odel"') == 1
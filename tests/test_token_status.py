@@ -0,0 +1,37 @@
+"""Token status endpoint tests for Qwen Code API Server"""
+
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+
+from src.api.routes import db, router
+from src.models.data_models import TokenData
+
+AUTH = {'Authorization': 'Bearer test'}
+
+
+def _get(headers):
+    app = FastAPI()
+    app.include_router(router, prefix="/api")
+
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.get('/api/token-status', headers=headers)
+
+    return asyncio.run(request())
+
+
+def test_usage_flush_changes_etag():
+    db.save_token('usage-etag', TokenData(access_token='a', refresh_token='r'))
+    first = _get(AUTH)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert _get({**AUTH, 'If-None-Match': etag}).status_code == 304
+
+    db.apply_usage_batch({}, {'usage-etag': 3})
+
+    second = _get({**AUTH, 'If-None-Match': etag})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != etag